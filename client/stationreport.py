@@ -8,6 +8,8 @@ import requests
 import argparse
 import datetime
 import time
+import json
+import gzip
 import sys, os
 
 sensor = None
@@ -16,6 +18,16 @@ sensormodule = None
 # Used for testing
 test_app = None
 
+# Readings that haven't gotten to the server yet, oldest first,
+# as { "station": name, "time": "YYYY-MM-DD HH:MM:SS.ffffff",
+#      "values": payload }.
+# They're sent along with the next report (see post_batch()).
+backlog = []
+
+# How many readings to keep while the server can't be reached.
+# A reading every 30 seconds, from a few stations, is a few hours' worth.
+MAX_BACKLOG = 2000
+
 
 def initialize(sensorname):
     global sensormodule
@@ -65,27 +77,99 @@ def stationreport(servername, stationname, port=5000, verbose=False,
     if verbose:
         print("Payload to send to the server:", payload)
 
+    # With microseconds, so readings that are sent twice
+    # (e.g. the server saved them but the response got lost)
+    # can be told apart from new ones.
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    records = []
+
+    # Was there a payload from the initial read_all()?
+    if payload:
+        records.append({ "station": stationname, "time": now,
+                         "values": payload })
+
+    # If a station has sub-stations, there are separate reports for them.
+    # For instance, the observerscraper can collect data from
+    # an outdoor2 and an indoor1 sensor.
+    if hasattr(sensor, 'substations') and sensor.substations:
+        print("Substations:", sensor.substations)
+        start = 1 if payload else 0
+        for st in sensor.substations[start:]:
+            payload = sensor.read_substation(st)
+            if payload:
+                records.append({ "station": st, "time": now,
+                                 "values": payload })
+
+    # Send them all, and anything that didn't get sent before,
+    # in one request.
+    backlog.extend(records)
+    del backlog[:-MAX_BACKLOG]
+
     # Ready to contact the server.
     try:
-        # Was there a payload from the initial read_all()?
-        if payload:
-            r = post_report(servername, stationname, payload, port)
-
-        # If a station has sub-stations, post separate reports for them.
-        # For instance, the observerscraper can collect data from
-        # an outdoor2 and an indoor1 sensor.
-        if hasattr(sensor, 'substations') and sensor.substations:
-            print("Substations:", sensor.substations)
-            start = 1 if payload else 0
-            for st in sensor.substations[start:]:
-                payload = sensor.read_substation(st)
-                post_report(servername, st, payload, port=port)
-                if verbose:
-                    print("%s: Posted substation report for %s"
-                          % (datetime.datetime.now(), st))
+        r = post_batch(servername, port)
+        if r is not None and r.status_code == 404:
+            # An older server, without /report_batch: just send
+            # the current readings, one at a time.
+            for record in records:
+                post_report(servername, record["station"],
+                            record["values"], port)
+            backlog.clear()
+        elif r is not None and r.status_code == 200:
+            if verbose:
+                print("%s: Posted %d reports: %s"
+                      % (datetime.datetime.now(), len(backlog), r.text))
+            try:
+                rejected = json.loads(r.text).get("rejected")
+            except ValueError:
+                rejected = None
+            if rejected:
+                print("Server rejected %d reports, e.g. %s"
+                      % (len(rejected), rejected[0]["error"]),
+                      file=sys.stderr)
+            backlog.clear()
+        elif r is not None and 400 <= r.status_code < 500:
+            # Sending the same readings again won't help,
+            # and would hold up everything after them.
+            print("Server refused %d reports, dropping them: %d %s"
+                  % (len(backlog), r.status_code, r.text.strip()),
+                  file=sys.stderr)
+            backlog.clear()
+        elif r is not None:
+            print("Server couldn't take %d reports: %d %s"
+                  % (len(backlog), r.status_code, r.text.strip()),
+                  file=sys.stderr)
 
     except requests.exceptions.ConnectionError:
         print("Couldn't post report. Is %s up?" % servername)
+        if len(backlog) > len(records):
+            print("%d readings waiting to be sent" % len(backlog))
+
+
+def post_batch(server, port):
+    """Send all the readings in the backlog to the server,
+       gzipped JSON to /report_batch.
+       Return the response, or None if it timed out.
+       Leaves the backlog alone: that's up to the caller.
+    """
+    data = gzip.compress(json.dumps(backlog).encode())
+    headers = { "Content-Type": "application/json",
+                "Content-Encoding": "gzip" }
+
+    # If this is from a unit test, don't make a net request:
+    if test_app:
+        return test_app.post('/report_batch', data=data, headers=headers)
+
+    if port:
+        url = "http://%s:%d/report_batch" % (server, port)
+    else:
+        url = "http://%s/report_batch" % server
+
+    try:
+        return requests.post(url, data=data, headers=headers, timeout=10)
+    except requests.exceptions.Timeout:
+        print("Timed out after 10 seconds:", url, file=sys.stderr)
+        return None
 
 
 def post_report(server, stationname, payload, port):
@@ -3,11 +3,15 @@
 # Most useful tutorial: https://plotly.com/python/line-charts/
 
 import sys, os
-import csv
 from datetime import datetime, timedelta
+from itertools import groupby
 
 import plotly.graph_objects as go
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "server"))
+import resample
+
 DATADIR = os.path.expanduser("~/moontrade/watchweather-data/")
 
 
@@ -35,7 +39,7 @@ def read_highs_lows(stationname, start_date, end_date, field):
        and save the daily highs and lows.
        stationname is the string used in the CSV filenames.
        start_date and end_date are datetime.datetime.
-       fields is a list of named fields to be read from the CSV.
+       field is the named field to be read from the CSV.
        Return a dict of ...
     """
 
@@ -47,41 +51,27 @@ def read_highs_lows(stationname, start_date, end_date, field):
     minindex = field + " min"
     maxindex = field + " max"
 
-    thedate = start_date
-    while thedate < end_date:
-        year = thedate.year
-        if year not in year_data:
+    for year in range(start_date.year, end_date.year + 1):
+        if datetime(year, 1, 1) < end_date:
             year_data[year] = { minindex: [None]*366, maxindex: [None]*366 }
 
-        filename = thedate.strftime("Outdoor-%Y-%m-%d.csv")
-        low = sys.float_info.max
-        high = sys.float_info.min
-        try:
-            with open(os.path.join(DATADIR, filename)) as datafp:
-                reader = csv.DictReader(datafp)
-                for row in reader:
-                    try:
-                        # DictReader reads in strings, not floats
-                        val = float(row[field])
-                        low = min(low, val)
-                        high = max(high, val)
-                    except (ValueError, TypeError):
-                        # print(f"Missing %s data on %s"
-                        #       % (field, thedate.strftime('%y-%m-%d')))
-                        # print(row)
-                        continue
-
-            # Done reading the day's data. Save it.
-            daynum = day_numbers[(thedate.month, thedate.day)]
-            if low < sys.float_info.max:
-                year_data[year][minindex][daynum] = low
-            if high > sys.float_info.min:
-                year_data[year][maxindex][daynum] = high
-
-        except FileNotFoundError:
-            pass
-
-        thedate += timedelta(days=1)
+    # Read just the one field, a day at a time,
+    # from only the days that have data.
+    readings = resample.iter_readings(DATADIR, stationname, [ field ],
+                                      start_date, end_date)
+    for day, dayreadings in groupby(readings, key=lambda r: r[0].date()):
+        vals = [ val for t, val in dayreadings if val is not None ]
+        if not vals:
+            # print(f"Missing %s data on %s"
+            #       % (field, day.strftime('%y-%m-%d')))
+            continue
+
+        # Done reading the day's data. Save it.
+        daynum = day_numbers[(day.month, day.day)]
+        year_data[day.year][minindex][daynum] = min(vals)
+        high = max(vals)
+        if high > sys.float_info.min:
+            year_data[day.year][maxindex][daynum] = high
 
     return date_labels, year_data
 
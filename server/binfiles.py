@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Binary day files, an optional companion to the CSV day files
+# written by stations.update_station().
+#
+# Stationname-YYYY-MM-DD.bin holds the same data as
+# Stationname-YYYY-MM-DD.csv, as fixed-width records:
+# the time as float64 seconds since timeparse.EPOCH, then a float64
+# for each field (NaN if the report didn't have it), so they can be
+# read with numpy.memmap without parsing any text. (float32 would
+# halve the size, but 21.3 would come back as 21.299999237.)
+# The fields are the configured field order (stations.get_field_order())
+# when the file was started; a file whose fields don't match it any more
+# is rewritten from the CSV.
+#
+# The file starts with a header:
+#     MAGIC, a little-endian uint32 length, then that many bytes of JSON
+#     { "fields": [ field, field, ... ] }, padded with spaces
+#     so the records start on a HEADER_ALIGN boundary.
+#
+# A .bin file is only used if it's at least as new as its .csv,
+# and has this version's MAGIC; otherwise (e.g. the CSV was copied in
+# from another machine) the CSV is read instead.
+
+import os, sys
+import re
+import json
+import struct
+
+import numpy as np
+
+from timeparse import to_seconds, from_seconds, parse_date
+
+
+MAGIC = b"WWBIN\x00\x02\x00"
+
+HEADER_ALIGN = 64
+
+EXT = ".bin"
+
+
+def binfile_path(csvpath):
+    """The binary file corresponding to a CSV day file
+       (or a compressed one, .csv.gz).
+    """
+    if csvpath.endswith(".gz"):
+        csvpath = csvpath[:-3]
+    return os.path.splitext(csvpath)[0] + EXT
+
+
+def current_binfile(csvpath):
+    """The binary file for csvpath, if there is one that's
+       at least as new as the CSV file, in this version's format;
+       otherwise None.
+    """
+    binpath = binfile_path(csvpath)
+    try:
+        binmtime = os.stat(binpath).st_mtime
+        with open(binpath, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                return None
+    except FileNotFoundError:
+        return None
+    # The CSV file may have been compressed (see datafiles.py),
+    # which keeps its mtime.
+    for path in (csvpath, csvpath + ".gz"):
+        try:
+            if os.stat(path).st_mtime > binmtime:
+                return None
+            break
+        except FileNotFoundError:
+            pass
+    return binpath
+
+
+def record_dtype(fields):
+    return np.dtype([ ('time', '<f8') ] + [ (f, '<f8') for f in fields ])
+
+
+def make_header(fields):
+    """The header bytes for a file holding the given fields."""
+    js = json.dumps({ "fields": fields }).encode()
+    pad = -(len(MAGIC) + 4 + len(js)) % HEADER_ALIGN
+    js += b' ' * pad
+    return MAGIC + struct.pack('<I', len(js)) + js
+
+
+def read_header(binpath):
+    """Return (fields, offset of the first record).
+       Raises ValueError if binpath isn't a binary day file,
+       FileNotFoundError if it doesn't exist.
+    """
+    with open(binpath, 'rb') as fp:
+        start = fp.read(len(MAGIC) + 4)
+        if len(start) < len(MAGIC) + 4 or not start.startswith(MAGIC):
+            raise ValueError("%s isn't a binary day file" % binpath)
+        jslen = struct.unpack('<I', start[len(MAGIC):])[0]
+        js = fp.read(jslen)
+    if len(js) < jslen:
+        raise ValueError("%s: truncated header" % binpath)
+    return json.loads(js)["fields"], len(MAGIC) + 4 + jslen
+
+
+def make_record(fields, station_data):
+    """The bytes of one record for a report, a dict that includes
+       'time' (a datetime) and whichever fields it has.
+    """
+    vals = []
+    for field in fields:
+        try:
+            vals.append(float(station_data[field]))
+        except (KeyError, ValueError, TypeError):
+            vals.append(np.nan)
+    return struct.pack('<d%dd' % len(fields),
+                       to_seconds(station_data['time']), *vals)
+
+
+def open_records(binpath):
+    """Map a binary day file's records.
+       Return (fields, records), where records is a numpy record array
+       (a read-only memmap, unless there are no records yet).
+       A partly written record at the end is ignored.
+    """
+    fields, offset = read_header(binpath)
+    dtype = record_dtype(fields)
+    nrecs = (os.path.getsize(binpath) - offset) // dtype.itemsize
+    if nrecs <= 0:
+        return fields, np.zeros(0, dtype=dtype)
+    return fields, np.memmap(binpath, dtype=dtype, mode='r',
+                             offset=offset, shape=(nrecs,))
+
+
+def load_columns(binpath, fields=None):
+    """Like resample.load_day_columns(), but from a binary day file:
+       return (times, { field: values }) as float64 arrays,
+       times sorted, with NaN for missing values.
+    """
+    filefields, recs = open_records(binpath)
+    if fields is None:
+        fields = filefields
+
+    times = np.array(recs['time'], dtype=np.float64)
+    good = ~np.isnan(times)
+
+    columns = {}
+    for field in fields:
+        if field in filefields:
+            col = np.array(recs[field], dtype=np.float64)[good]
+        else:
+            col = np.full(np.count_nonzero(good), np.nan)
+        columns[field] = col
+    times = times[good]
+
+    # Records are appended in time order, but in case the clock
+    # ever jumped backward:
+    if len(times) > 1 and np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        for field in columns:
+            columns[field] = columns[field][order]
+
+    return times, columns
+
+
+def _valstr(v):
+    # str() gives the shortest string that round-trips,
+    # so a value written as 59.4 reads back as "59.4".
+    # Integers are written without the ".0", as in the CSV files.
+    if np.isnan(v):
+        return ''
+    s = str(v)
+    if s.endswith('.0'):
+        return s[:-2]
+    return s
+
+
+def _timestr(secs):
+    return str(from_seconds(float(secs)))
+
+
+def read_last_row(binpath):
+    """Like datafiles.read_last_row(), from a binary day file:
+       return (header, row) with the values as strings, '' if missing.
+    """
+    fields, recs = open_records(binpath)
+    header = [ 'time' ] + fields
+    if not len(recs):
+        return header, None
+    rec = recs[-1]
+    row = { 'time': _timestr(rec['time']) }
+    for field in fields:
+        row[field] = _valstr(rec[field])
+    return header, row
+
+
+def iter_rows(binpath):
+    """Like a csv.DictReader for the CSV day file: return an iterator
+       giving a dict of strings for each record.
+       The file is opened right away, so any errors happen here
+       rather than partway through the iteration.
+    """
+    fields, recs = open_records(binpath)
+    return _iter_rows(fields, recs)
+
+
+def _iter_rows(fields, recs):
+    for rec in recs:
+        if np.isnan(rec['time']):
+            continue
+        row = { 'time': _timestr(rec['time']) }
+        for field in fields:
+            row[field] = _valstr(rec[field])
+        yield row
+
+
+def write_file(binpath, fields, times, columns):
+    """Write a complete binary day file from arrays like those
+       load_columns() returns, replacing any existing file.
+    """
+    recs = np.zeros(len(times), dtype=record_dtype(fields))
+    recs['time'] = times
+    for field in fields:
+        recs[field] = columns[field]
+
+    tmppath = binpath + ".tmp"
+    with open(tmppath, 'wb') as fp:
+        fp.write(make_header(fields))
+        fp.write(recs.tobytes())
+    os.replace(tmppath, binpath)
+
+
+def convert(csvpath, fields=None):
+    """Write the binary file for a CSV day file.
+       fields defaults to every numeric column in the CSV.
+       Return the list of fields written.
+    """
+    # resample reads binary files through this module,
+    # so import it here rather than at the top.
+    import resample
+
+    times, columns = resample.load_csv_columns(csvpath, fields)
+    if fields is None:
+        fields = list(columns)
+    write_file(binfile_path(csvpath), fields, times, columns)
+    return fields
+
+
+def backfill(savedir, stationname=None):
+    """Write binary files for every CSV day file in savedir that
+       doesn't have an up-to-date one. stationname may limit it
+       to one station.
+    """
+    for filename in sorted(os.listdir(savedir)):
+        m = re.match(r'(.*)-(\d\d\d\d-\d\d-\d\d)\.csv(\.gz)?$', filename)
+        if not m:
+            continue
+        if stationname and m.group(1) != stationname:
+            continue
+        try:
+            parse_date(m.group(2))
+        except ValueError:
+            continue
+        csvpath = os.path.join(savedir, "%s-%s.csv" % (m.group(1),
+                                                       m.group(2)))
+        if current_binfile(csvpath):
+            continue
+        print("Converting", filename, file=sys.stderr)
+        try:
+            convert(csvpath)
+        except (OSError, ValueError) as e:
+            print("Couldn't convert %s: %s" % (filename, e), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        backfill(sys.argv[1], sys.argv[2])
+    elif len(sys.argv) > 1:
+        backfill(sys.argv[1])
+    else:
+        backfill(os.path.expanduser("~/.cache/watchserver"))
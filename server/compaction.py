@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Bookkeeping for compact_stations() (in stations.py), which summarizes
+# past years' day files into
+#     Stationname-YYYY-MM-hourly.csv, a row per hour for a month, and
+#     Stationname-YYYY-daily.csv, a row per day for a year,
+# then moves the day files to savedir/archived.
+#
+# The work is split into units of one station's month, which don't
+# depend on each other, so they can run in separate processes.
+# Each summary file is written to a temporary file that's renamed
+# into place, so an interrupted run never leaves a half-written one,
+# and rows for the days being compacted replace any rows already
+# there for those days, so compacting a day again does no harm.
+#
+# The manifest, savedir/compacted.json, records the days each
+# finished unit covered:
+#     { "Stationname-YYYY-MM": [ "YYYY-MM-DD", ... ] }
+# A unit is only added to it once its summaries are written, and
+# the day files are only archived after that. So a rerun after an
+# interruption skips the days that were finished and just archives
+# their files, and compacts the rest.
+#
+# The server also compacts each month of the current year shortly
+# after it ends (RollingCompactor), so plots and reports over the
+# year can use the summaries, but leaves the day files where they are.
+# It works in the background a day at a time, resting between days
+# so it never takes more than a small share of the server's time,
+# and its progress is shown at /api/compaction. After each check
+# it also compresses finished day files and expires old data
+# (see retention.py), the same way.
+
+import os, sys
+import json
+import time
+import threading
+from datetime import datetime, date, timedelta
+
+import datafiles
+
+
+MANIFEST = "compacted.json"
+
+# How often the rolling compactor looks for months that have ended,
+CHECK_SECONDS = 60 * 60
+# and how long it waits after a month ends before compacting it,
+# so the stations' last reports of the month have been written.
+MONTH_DELAY = timedelta(hours=2)
+
+_lock = threading.Lock()
+
+# Held while anything is writing summary files, so compact_stations()
+# and the rolling compactor don't both write the same ones.
+work_lock = threading.Lock()
+
+
+def manifest_path(savedir):
+    return os.path.join(savedir, MANIFEST)
+
+
+def unit_key(stationname, year, month):
+    """The manifest key for one station's month."""
+    return "%s-%04d-%02d" % (stationname, year, month)
+
+
+def write_atomic(path, lines):
+    """Write lines (strings without newlines) to path by way of
+       a temporary file, so readers see the old file or the new one
+       but never part of one.
+    """
+    tmppath = path + ".tmp"
+    with open(tmppath, 'w') as fp:
+        for line in lines:
+            print(line, file=fp)
+    os.replace(tmppath, path)
+
+
+def load_manifest(savedir):
+    """{ unit key: set of ISO date strings } for the finished units."""
+    try:
+        with open(manifest_path(savedir)) as fp:
+            manifest = json.load(fp)
+        return { key: set(days) for key, days in manifest.items() }
+    except FileNotFoundError:
+        return {}
+    except (ValueError, AttributeError, TypeError) as e:
+        # Everything will be recompacted, which is slow but harmless.
+        print("Ignoring bad compaction manifest %s: %s"
+              % (manifest_path(savedir), e), file=sys.stderr)
+        return {}
+
+
+def finish_unit(savedir, key, days):
+    """Record in the manifest file that days (dates) of a unit
+       are compacted.
+    """
+    with _lock:
+        manifest = load_manifest(savedir)
+        manifest.setdefault(key, set()).update(d.isoformat() for d in days)
+        write_atomic(manifest_path(savedir),
+                     [ json.dumps({ k: sorted(manifest[k])
+                                    for k in sorted(manifest) },
+                                  indent=1) ])
+
+
+def merge_summary(path, header, rows, days):
+    """Write a summary file with header and rows (CSV lines, starting
+       with a "YYYY-MM-DD HH" time), replacing any rows the file
+       already has for days (dates) and keeping the rest, in time order.
+    """
+    daystrs = set(d.isoformat() for d in days)
+    lines = []
+    try:
+        with open(path) as fp:
+            next(fp, None)
+            for line in fp:
+                line = line.rstrip('\n')
+                if line and line[:10] not in daystrs:
+                    lines.append(line)
+    except FileNotFoundError:
+        pass
+
+    lines.extend(rows)
+    # sort is stable, so repeated rows for a time stay in order.
+    lines.sort(key=lambda line: line.split(',', 1)[0])
+    write_atomic(path, [ ','.join(header) ] + lines)
+
+
+def pending_units(savedir, now):
+    """Days the rolling compactor should compact, as
+       { (stationname, year, month): [ days ] }: the days with day files
+       that aren't in the manifest yet, in the months that ended at least
+       MONTH_DELAY before now (a datetime), starting from January of
+       the year of the last one that ended.
+    """
+    # The first day of the month that hasn't ended (or only just has)
+    last = (now - MONTH_DELAY).date().replace(day=1)
+    first = date((last - timedelta(days=1)).year, 1, 1)
+
+    manifest = load_manifest(savedir)
+    units = {}
+    with os.scandir(savedir) as entries:
+        for entry in entries:
+            parsed = datafiles.parse_day_filename(entry.name)
+            if not parsed:
+                continue
+            stationname, day = parsed
+            if not first <= day < last:
+                continue
+            if day.isoformat() in manifest.get(
+                    unit_key(stationname, day.year, day.month), ()):
+                continue
+            # A day can have both a .csv and a .csv.gz file
+            units.setdefault((stationname, day.year, day.month),
+                             set()).add(day)
+
+    return { unit: sorted(units[unit]) for unit in sorted(units) }
+
+
+class RollingCompactor:
+    """Compact months as they end, in a background thread:
+       see the comments at the top.
+       compact(stationname, days) does the compacting, for a list of
+       days in one month; duty is the largest fraction of the time
+       to spend compacting.
+       housekeeping(rest), if given, is run after each check, e.g. to
+       expire old data: see retention.expire() for rest.
+    """
+
+    def __init__(self, savedir, compact, duty=0.1, housekeeping=None):
+        self.savedir = savedir
+        self.compact = compact
+        self.duty = min(max(duty, 0.01), 1)
+        self.housekeeping = housekeeping
+
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # Protects progress
+        self.lock = threading.Lock()
+        self.progress = {
+            # idle, compacting or stopped
+            "state": "idle",
+            # Days left to compact: { unit key: number of days }
+            "pending": {},
+            # The day being compacted, Stationname-YYYY-MM-DD
+            "current": None,
+            # How many days have been compacted since the server started
+            "compacted": 0,
+            "last_check": None,
+            "last_error": None,
+            # How many days housekeeping has done something with
+            "expired": 0,
+        }
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run, name="compactor",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop after the day that's being compacted, if any."""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def status(self):
+        """A copy of the progress, for showing."""
+        with self.lock:
+            status = dict(self.progress)
+            status["pending"] = dict(self.progress["pending"])
+            return status
+
+    def _set(self, **kwargs):
+        with self.lock:
+            self.progress.update(kwargs)
+
+    def run_once(self, now=None):
+        """Compact everything that's pending as of now (a datetime,
+           by default the current time). Return how many days it compacted.
+        """
+        if not now:
+            now = datetime.now()
+        units = pending_units(self.savedir, now)
+        self._set(state="compacting" if units else "idle",
+                  last_check=now.strftime("%Y-%m-%d %H:%M:%S"),
+                  pending={ unit_key(*unit): len(days)
+                            for unit, days in units.items() })
+
+        ndays = 0
+        for unit, days in units.items():
+            key = unit_key(*unit)
+            for day in days:
+                if self.stopping.is_set():
+                    return ndays
+                self._set(current="%s-%s" % (unit[0], day.isoformat()))
+                started = time.monotonic()
+                try:
+                    with work_lock:
+                        self.compact(unit[0], [ day ])
+                except Exception as e:
+                    # It'll be tried again at the next check.
+                    print("Couldn't compact %s: %s" % (key, e),
+                          file=sys.stderr)
+                    self._set(last_error="%s: %s" % (key, e))
+                    break
+
+                ndays += 1
+                with self.lock:
+                    self.progress["compacted"] += 1
+                    self.progress["pending"][key] -= 1
+                    if not self.progress["pending"][key]:
+                        del self.progress["pending"][key]
+
+                self.rest(started)
+
+        self._set(state="idle", current=None)
+        return ndays
+
+    def rest(self, started):
+        """After some work that started at time.monotonic() started,
+           wait long enough to stay under the duty fraction.
+           Return False if it's time to stop.
+        """
+        elapsed = time.monotonic() - started
+        return not self.stopping.wait(elapsed * (1 - self.duty) / self.duty)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.run_once()
+                if self.housekeeping:
+                    nexpired = self.housekeeping(self.rest)
+                    with self.lock:
+                        self.progress["expired"] += nexpired
+            except Exception as e:
+                print("Rolling compaction failed:", e, file=sys.stderr)
+                self._set(state="idle", current=None, last_error=str(e))
+            self.stopping.wait(CHECK_SECONDS)
+        self._set(state="stopped", current=None)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Which days each station has day files for, so readers can go
+# straight to the days that exist instead of trying to open a file
+# for every day in a range and catching FileNotFoundError.
+# That matters for stations that only report now and then,
+# or plots over years.
+#
+# The savedir is scanned once, the first time it's needed, and then
+# kept up to date as reports come in (CSVStorage.append) and as
+# compact_stations() archives files. A server restarting from
+# a snapshot (see stations.load_snapshot()) starts from the days
+# saved in it instead, plus any files written since, so it doesn't
+# have to scan at all. Day files copied into savedir from elsewhere
+# won't be seen until rescan(), or a restart without the snapshot.
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+import datafiles
+
+
+class Coverage:
+    """The dates that have day files, per station, in one savedir,
+       plus the first and last report times where they're known.
+       parse(filename) says which station and date a file is for,
+       or None if it isn't a day file.
+    """
+
+    def __init__(self, savedir, parse=datafiles.parse_day_filename):
+        self.savedir = savedir
+        self.parse = parse
+        self.lock = threading.RLock()
+
+        # { stationname: set of dates }, None until scanned
+        self.days = None
+
+        # { stationname: datetime } of the last report, once
+        # a report has come in since the scan.
+        self.last_time = {}
+
+    def rescan(self):
+        days = {}
+        try:
+            with os.scandir(self.savedir) as it:
+                for entry in it:
+                    parsed = self.parse(entry.name)
+                    if parsed:
+                        days.setdefault(parsed[0], set()).add(parsed[1])
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            self.days = days
+            self.last_time = {}
+
+    def seed(self, days):
+        """Start from days, { stationname: set of dates }, e.g. from
+           a snapshot, rather than scanning savedir,
+           unless it's been scanned already.
+        """
+        with self.lock:
+            if self.days is None:
+                self.days = days
+                self.last_time = {}
+
+    def snapshot(self):
+        """{ stationname: sorted list of dates }, to seed() another time,
+           or None if savedir hasn't been scanned.
+        """
+        with self.lock:
+            if self.days is None:
+                return None
+            return { st: sorted(self.days[st]) for st in self.days }
+
+    def _station_days(self, stationname):
+        if self.days is None:
+            self.rescan()
+        return self.days.get(stationname, ())
+
+    def stations(self):
+        """Return { stationname: date of its newest day file }."""
+        if self.days is None:
+            self.rescan()
+        with self.lock:
+            return { st: max(self.days[st]) for st in self.days
+                     if self.days[st] }
+
+    def last_day(self, stationname):
+        """The date of the station's newest day file, or None."""
+        with self.lock:
+            days = self._station_days(stationname)
+            return max(days) if days else None
+
+    def has_day(self, stationname, day):
+        return day in self._station_days(stationname)
+
+    def days_between(self, stationname, start_date=None, end_date=None):
+        """A sorted list of the station's days with files,
+           start_date <= day <= end_date (either may be None).
+        """
+        with self.lock:
+            days = self._station_days(stationname)
+            return sorted(d for d in days
+                          if (start_date is None or d >= start_date)
+                          and (end_date is None or d <= end_date))
+
+    def extent(self, stationname):
+        """(first, last) datetimes of the station's data, or None.
+           first is the start of the first day with a file; last is
+           the last report if one's come in since the scan, otherwise
+           the start of the last day with a file.
+        """
+        with self.lock:
+            days = self._station_days(stationname)
+            if not days:
+                return None
+            first = datetime.combine(min(days), datetime.min.time())
+            last = self.last_time.get(stationname)
+            if not last:
+                last = datetime.combine(max(days), datetime.min.time())
+            return first, last
+
+    def add_report(self, stationname, t):
+        """A report for time t (a datetime) has been saved."""
+        self._station_days(stationname)
+        with self.lock:
+            self.days.setdefault(stationname, set()).add(t.date())
+            if t > self.last_time.get(stationname, t - timedelta(1)):
+                self.last_time[stationname] = t
+
+    def add_day(self, stationname, day):
+        self._station_days(stationname)
+        with self.lock:
+            self.days.setdefault(stationname, set()).add(day)
+
+    def remove_days(self, stationname, days):
+        """Those days' files are gone, e.g. archived or expired."""
+        self._station_days(stationname)
+        with self.lock:
+            if stationname in self.days:
+                self.days[stationname].difference_update(days)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Helpers for reading the CSV day files written by stations.update_station().
+#
+# Day files for past days may be compressed with gzip,
+# Stationname-YYYY-MM-DD.csv.gz. Everything here takes the .csv path,
+# and uses the .csv.gz file if the .csv file isn't there.
+
+import os, sys
+import csv
+import gzip
+import re
+import shutil
+from datetime import date
+
+import binfiles
+import timeindex
+from timeparse import parse_date
+
+
+GZ_EXT = ".gz"
+
+# Day files are named Stationname-YYYY-MM-DD.csv, or .csv.gz
+DAYFILE_RE = re.compile(r'(.*)-(\d\d\d\d-\d\d-\d\d)\.csv(\.gz)?$')
+
+
+def day_path(savedir, stationname, day):
+    """The CSV file for a station's reports on a given day.
+       day may be a date or a datetime.
+    """
+    return os.path.join(savedir,
+                        "%s-%s.csv" % (stationname, day.strftime("%Y-%m-%d")))
+
+
+def parse_day_filename(filename):
+    """Return (stationname, date) for a day file's name (without the
+       directory), or None if it isn't one.
+    """
+    m = DAYFILE_RE.match(filename)
+    if not m:
+        return None
+    try:
+        return m.group(1), parse_date(m.group(2))
+    except ValueError:
+        return None
+
+
+# How much to read at a time when seeking backward from the end of a file.
+TAIL_BLOCKSIZE = 4096
+
+
+def read_last_row(filename):
+    """Read just the header and the last complete row of a CSV file,
+       seeking backward from the end rather than reading the whole file.
+       A final line without a newline is assumed to be still
+       being written, and is ignored.
+       Return (header, row): header is a list of column names,
+       row is a dict like csv.DictReader would give, or None if
+       there are no complete rows.
+       If there's an up-to-date binary file (see binfiles.py),
+       the row comes from that instead.
+       Raises FileNotFoundError if there's no such file.
+    """
+    binpath = binfiles.current_binfile(filename)
+    if binpath:
+        try:
+            return binfiles.read_last_row(binpath)
+        except (OSError, ValueError) as e:
+            print("Can't read %s, using the CSV: %s" % (binpath, e),
+                  file=sys.stderr)
+
+    if not filename.endswith(GZ_EXT) and not os.path.exists(filename) \
+       and os.path.exists(filename + GZ_EXT):
+        filename += GZ_EXT
+    if filename.endswith(GZ_EXT):
+        # Compressed files can't seek backward, so read it all.
+        return _read_last_row_gz(filename)
+
+    with open(filename, 'rb') as fp:
+        headerline = fp.readline()
+        if not headerline.endswith(b'\n'):
+            return [], None
+        header = next(csv.reader([ headerline.decode().rstrip('\r\n') ]))
+        datastart = len(headerline)
+
+        fp.seek(0, os.SEEK_END)
+        end = fp.tell()
+
+        # Read blocks backward until there's a complete, non-blank line.
+        tail = b''
+        pos = end
+        line = None
+        while pos > datastart and line is None:
+            readsize = min(TAIL_BLOCKSIZE, pos - datastart)
+            pos -= readsize
+            fp.seek(pos)
+            tail = fp.read(readsize) + tail
+
+            lines = tail.split(b'\n')
+            # Whatever follows the last newline is a partially written
+            # line (or nothing), and unless this is the start of the
+            # data, the first line may be cut off.
+            lines.pop()
+            if pos > datastart and lines:
+                lines.pop(0)
+            for l in reversed(lines):
+                if l.strip():
+                    line = l.decode().rstrip('\r')
+                    break
+
+    if line is None:
+        return header, None
+
+    values = next(csv.reader([ line ]))
+    row = {}
+    for i, field in enumerate(header):
+        row[field] = values[i] if i < len(values) else None
+    return header, row
+
+
+def read_rows(filename):
+    """Yield each row of a CSV day file as a dict of strings,
+       like csv.DictReader, or the same from its binary file
+       if there's an up-to-date one.
+       Raises FileNotFoundError if there's no such file.
+    """
+    binpath = binfiles.current_binfile(filename)
+    if binpath:
+        try:
+            rows = binfiles.iter_rows(binpath)
+        except (OSError, ValueError) as e:
+            print("Can't read %s, using the CSV: %s" % (binpath, e),
+                  file=sys.stderr)
+        else:
+            yield from rows
+            return
+
+    with open_day_file(filename) as fp:
+        yield from csv.DictReader(fp)
+
+
+def _read_last_row_gz(filename):
+    header = []
+    row = None
+    with gzip.open(filename, 'rt', newline='') as fp:
+        reader = csv.reader(fp)
+        for values in reader:
+            if not header:
+                header = values
+            elif values:
+                row = values
+
+    if row is None:
+        return header, None
+    return header, { field: row[i] if i < len(row) else None
+                     for i, field in enumerate(header) }
+
+
+def open_day_file(filename):
+    """Open a CSV day file for reading as text, or its compressed
+       version if the CSV file has been compressed.
+       filename may be the .csv or the .csv.gz path.
+       Raises FileNotFoundError if there's no such file.
+    """
+    if filename.endswith(GZ_EXT):
+        return gzip.open(filename, 'rt', newline='')
+    try:
+        return open(filename, newline='')
+    except FileNotFoundError:
+        return gzip.open(filename + GZ_EXT, 'rt', newline='')
+
+
+def stat_day_file(filename):
+    """os.stat() for a CSV day file, or its compressed version."""
+    try:
+        return os.stat(filename)
+    except FileNotFoundError:
+        if filename.endswith(GZ_EXT):
+            raise
+        return os.stat(filename + GZ_EXT)
+
+
+def compress_day_file(filename):
+    """Replace a CSV day file with a gzipped copy, filename.gz.
+       The compressed file gets the CSV file's modification time,
+       so caches keyed on it stay valid.
+    """
+    gzpath = filename + GZ_EXT
+    tmppath = gzpath + ".tmp"
+    try:
+        with open(filename, 'rb') as infp, gzip.open(tmppath, 'wb') as outfp:
+            shutil.copyfileobj(infp, outfp)
+        shutil.copystat(filename, tmppath)
+        os.replace(tmppath, gzpath)
+    except OSError as e:
+        print("Couldn't compress %s: %s" % (filename, e), file=sys.stderr)
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        return
+    # Readers fall back to the .gz as soon as the .csv is gone.
+    os.unlink(filename)
+    timeindex.forget(filename)
+
+
+def uncompress_day_file(filename):
+    """Undo compress_day_file(), e.g. to append to a past day's file."""
+    gzpath = filename + GZ_EXT
+    tmppath = filename + ".tmp"
+    with gzip.open(gzpath, 'rb') as infp, open(tmppath, 'wb') as outfp:
+        shutil.copyfileobj(infp, outfp)
+    shutil.copystat(gzpath, tmppath)
+    os.replace(tmppath, filename)
+    os.unlink(gzpath)
+
+
+def compress_closed(savedir, stationname=None, before=None):
+    """Compress every CSV day file in savedir for a day before
+       the date before (default today).
+       stationname may limit it to one station.
+    """
+    if not before:
+        before = date.today()
+    for filename in sorted(os.listdir(savedir)):
+        if not filename.endswith(".csv"):
+            continue
+        parsed = parse_day_filename(filename)
+        if not parsed:
+            continue
+        if stationname and parsed[0] != stationname:
+            continue
+        if parsed[1] >= before:
+            continue
+        compress_day_file(os.path.join(savedir, filename))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        compress_closed(sys.argv[1])
+    else:
+        compress_closed(os.path.expanduser("~/.cache/watchserver"))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# A persistent cache of per-day summaries for each station,
+# so that summaries over long periods (e.g. /cumulative/station/year)
+# don't have to open and parse a year's worth of day files each time.
+#
+# For each day, the cache keeps the same per-field
+#     [ count, sum, low, high, last ]
+# lists as a day rollup (see rollups.py): so the day's highs and lows,
+# and the last value, which for rain_daily is the day's rainfall.
+#
+# Entries are keyed by the raw file's path, mtime and size, so a day
+# file that changes (or is replaced, e.g. by rsync) gets re-summarized.
+# A day file that gets compressed keeps its mtime (see
+# datafiles.compress_day_file()), so its entry carries over to the
+# .csv.gz file. The current day is never cached, since it's still growing.
+#
+# The lock is only held while using the cache itself, not while
+# reading day files, so one long summary doesn't hold up the others.
+#
+# The cache is stored in {savedir}/summaries/Stationname.json
+
+import os, sys
+import json
+import threading
+from datetime import date
+
+import rollups
+import datafiles
+
+
+CACHE_VERSION = 1
+
+# _cache[(savedir, stationname)] = {
+#     "YYYY-MM-DD": { "path": ..., "mtime": ..., "size": ...,
+#                     "fields": {...} } }
+_cache = {}
+
+_lock = threading.Lock()
+
+
+def cache_path(savedir, stationname):
+    return os.path.join(savedir, "summaries", "%s.json" % stationname)
+
+
+def _load(savedir, stationname):
+    try:
+        with open(cache_path(savedir, stationname)) as fp:
+            js = json.load(fp)
+        if js.get("version") == CACHE_VERSION:
+            return js["days"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def _save(savedir, stationname, days):
+    path = cache_path(savedir, stationname)
+    tmppath = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmppath, "w") as fp:
+            json.dump({ "version": CACHE_VERSION, "days": days }, fp)
+        os.replace(tmppath, path)
+    except OSError as e:
+        print("Couldn't save day summaries to %s: %s" % (path, e),
+              file=sys.stderr)
+
+
+def _station_cache(savedir, stationname):
+    with _lock:
+        key = (savedir, stationname)
+        if key not in _cache:
+            _cache[key] = _load(savedir, stationname)
+        return _cache[key]
+
+
+def _stat(rawfile):
+    """The path of the day file that's actually there for rawfile,
+       which may be compressed, and its os.stat().
+    """
+    try:
+        return rawfile, os.stat(rawfile)
+    except FileNotFoundError:
+        if rawfile.endswith(datafiles.GZ_EXT):
+            raise
+        return rawfile + datafiles.GZ_EXT, \
+            os.stat(rawfile + datafiles.GZ_EXT)
+
+
+def _current(entry, path, st):
+    """Is a cache entry for the file at path, with os.stat() st,
+       or for the same file before it was compressed?
+    """
+    if not entry or entry["mtime"] != st.st_mtime:
+        return False
+    if entry["path"] == path:
+        return entry["size"] == st.st_size
+    return entry["path"] + datafiles.GZ_EXT == path
+
+
+def day_summaries(savedir, stationname, days, rawfile_for):
+    """Summaries for a list of days for one station.
+       rawfile_for(day) gives the path of the raw file for a day.
+       Return { day: { field: [ count, sum, low, high, last ] } },
+       with None for days that have no data.
+    """
+    today = date.today()
+    summaries = {}
+
+    cached = _station_cache(savedir, stationname)
+    # New entries, to add to the cache at the end
+    updates = {}
+
+    for day in days:
+        rawfile = rawfile_for(day)
+
+        if day >= today:
+            # Still growing: get it from the rollups (or raw file).
+            buckets = rollups.day_buckets(savedir, stationname, day,
+                                          'day', rawfile)
+            summaries[day] = buckets[-1][1] if buckets else None
+            continue
+
+        try:
+            path, st = _stat(rawfile)
+        except FileNotFoundError:
+            summaries[day] = None
+            continue
+
+        daystr = day.strftime("%Y-%m-%d")
+        entry = cached.get(daystr)
+        if _current(entry, path, st):
+            summaries[day] = entry["fields"]
+            if entry["path"] != path:
+                # It's been compressed since.
+                updates[daystr] = dict(entry, path=path, size=st.st_size)
+            continue
+
+        buckets = rollups.day_buckets(savedir, stationname, day,
+                                      'day', rawfile)
+        fields = buckets[-1][1] if buckets else {}
+        updates[daystr] = { "path": path,
+                            "mtime": st.st_mtime, "size": st.st_size,
+                            "fields": fields }
+        summaries[day] = fields
+
+    if updates:
+        with _lock:
+            cached.update(updates)
+            _save(savedir, stationname, cached)
+
+    return summaries
+
+
+def day_last_values(savedir, stationname, days, rawfile_for):
+    """The last value of each numeric field for a list of days,
+       e.g. the day's total for fields like rain_daily.
+       Uses the cached summary for a day if it's up to date,
+       otherwise just reads the last row of the day's file.
+       Return { day: { field: float } }, with None for days with no data.
+    """
+    lastvals = {}
+
+    cached = _station_cache(savedir, stationname)
+
+    for day in days:
+        rawfile = rawfile_for(day)
+        try:
+            path, st = _stat(rawfile)
+        except FileNotFoundError:
+            lastvals[day] = None
+            continue
+
+        entry = cached.get(day.strftime("%Y-%m-%d"))
+        if _current(entry, path, st):
+            lastvals[day] = { f: entry["fields"][f][rollups.LAST]
+                              for f in entry["fields"] }
+            continue
+
+        header, row = datafiles.read_last_row(rawfile)
+        if not row:
+            lastvals[day] = None
+            continue
+        vals = {}
+        for f in row:
+            try:
+                vals[f] = float(row[f])
+            except (ValueError, TypeError):
+                pass
+        lastvals[day] = vals
+
+    return lastvals
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Append report lines to the CSV day files, keeping one open file
+# per station rather than opening and closing the file for every report.
+#
+# Lines are buffered, and written when a station has flush_lines lines
+# waiting, when the oldest waiting line is flush_seconds old, when
+# the day changes, when flush() is called (e.g. before reading a file
+# back in), or when the process exits. If a write fails (e.g. the disk
+# is full), the file is cut back to where it was and the lines are kept,
+# to try again at the next flush, even if the station has gone on
+# to another day's file meanwhile.
+# With fsync set, every write is also fsync()ed, so a power failure
+# can't lose anything that was written.
+# After each write, the file's time index (timeindex.py) is brought
+# up to date with the new lines.
+#
+# Settings come from the [writer] section of the server config file.
+#
+# With binary=True, the header and lines are bytes, and are written
+# as they are, with no newlines added: that's for the binary day files
+# in binfiles.py.
+
+import os, sys
+import atexit
+import threading
+import time
+
+import serverconfig
+import datafiles
+import timeindex
+
+
+class DayFileWriter:
+    """Buffered appender for the per-station, per-day CSV files."""
+
+    def __init__(self, flush_lines=None, flush_seconds=None, fsync=None,
+                 binary=False):
+        if flush_lines is None:
+            flush_lines = serverconfig.getint("writer", "flush_lines", 16)
+        if flush_seconds is None:
+            flush_seconds = serverconfig.getfloat("writer", "flush_seconds",
+                                                  30.)
+        if fsync is None:
+            fsync = serverconfig.getboolean("writer", "fsync", False)
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.binary = binary
+
+        # self.files[stationname] = { 'path': path, 'fp': open file,
+        #                             'lines': [ lines not yet written ],
+        #                             'since': time of the oldest line }
+        # fp is None after a failed write, until the next try.
+        self.files = {}
+
+        # Files that were closed (e.g. at the end of the day)
+        # before all their lines could be written, the same way.
+        self.unwritten = []
+        self.lock = threading.RLock()
+        self.timer = None
+
+        atexit.register(self.close)
+
+    def append(self, stationname, path, header, line):
+        """Append one line (without a newline) to a station's file,
+           starting a new file with the header line if path
+           isn't the file currently open for this station,
+           e.g. because it's a new day.
+        """
+        with self.lock:
+            self._retry_unwritten()
+
+            f = self.files.get(stationname)
+            if f and f['path'] != path:
+                self._close_one(stationname)
+                f = None
+
+            if not f:
+                # A late report for a day whose file has been compressed?
+                if not os.path.exists(path) \
+                   and os.path.exists(path + datafiles.GZ_EXT):
+                    datafiles.uncompress_day_file(path)
+                there_already = os.path.exists(path) \
+                    and os.path.getsize(path) > 0
+                f = { 'path': path, 'fp': self._open(path), 'lines': [],
+                      'since': None }
+                self.files[stationname] = f
+                if not there_already:
+                    f['lines'].append(header)
+
+            if f['since'] is None:
+                f['since'] = time.monotonic()
+            f['lines'].append(line)
+
+            if len(f['lines']) >= self.flush_lines:
+                self._flush_one(f)
+            else:
+                self._schedule()
+
+    def flush(self, stationname=None):
+        """Write out anything waiting, for one station or all of them."""
+        with self.lock:
+            self._retry_unwritten()
+            if stationname:
+                if stationname in self.files:
+                    self._flush_one(self.files[stationname])
+                return
+            for f in self.files.values():
+                self._flush_one(f)
+
+    def is_open(self, path):
+        """Is some station writing to path, or waiting to?"""
+        with self.lock:
+            return any(f['path'] == path for f in self.files.values()) \
+                or any(f['path'] == path for f in self.unwritten)
+
+    def close(self, stationname=None):
+        """Flush and close the open files, for one station
+           (e.g. before its file is rewritten) or all of them.
+        """
+        with self.lock:
+            if stationname:
+                if stationname in self.files:
+                    self._close_one(stationname)
+                return
+            for stationname in list(self.files):
+                self._close_one(stationname)
+            self._retry_unwritten()
+            for f in self.unwritten:
+                print("Lost %d lines for %s" % (len(f['lines']), f['path']),
+                      file=sys.stderr)
+            self.unwritten = []
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+    def _open(self, path):
+        if self.binary:
+            # Unbuffered, so a failed write can be undone
+            # in _write_binary().
+            return open(path, 'ab', buffering=0)
+        return open(path, 'a')
+
+    def _flush_one(self, f):
+        """Write a file's waiting lines. Return False if they couldn't
+           be written, in which case they're still waiting.
+        """
+        if not f['lines']:
+            return True
+        start = None
+        try:
+            if not f['fp']:
+                f['fp'] = self._open(f['path'])
+            start = os.fstat(f['fp'].fileno()).st_size
+            if self.binary:
+                self._write_binary(f['fp'], b''.join(f['lines']))
+            else:
+                f['fp'].write('\n'.join(f['lines']) + '\n')
+                f['fp'].flush()
+            if self.fsync:
+                os.fsync(f['fp'].fileno())
+        except OSError as e:
+            print("Couldn't write %d lines to %s, will try again: %s"
+                  % (len(f['lines']), f['path'], e), file=sys.stderr)
+            self._abandon_write(f, start)
+            self._schedule()
+            return False
+        f['lines'] = []
+        f['since'] = None
+        if not self.binary:
+            timeindex.update(f['path'])
+        return True
+
+    @staticmethod
+    def _abandon_write(f, start):
+        """After a failed write, drop the open file, with anything
+           it still has buffered, and cut the file back to start
+           so the lines can be written again from there.
+        """
+        fp, f['fp'] = f['fp'], None
+        if fp:
+            try:
+                fp.close()
+            except OSError:
+                pass
+        if start is not None:
+            try:
+                os.truncate(f['path'], start)
+            except OSError:
+                pass
+
+    def _retry_unwritten(self):
+        for f in list(self.unwritten):
+            if not self._flush_one(f):
+                continue
+            self.unwritten.remove(f)
+            try:
+                f['fp'].close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _write_binary(fp, data):
+        # Binary files are fixed-size records, so a partial write
+        # would garble everything after it: if the whole thing
+        # can't be written, cut the file back to where it was.
+        start = fp.seek(0, os.SEEK_END)
+        try:
+            view = memoryview(data)
+            while view:
+                n = fp.write(view)
+                view = view[n:]
+        except OSError:
+            fp.truncate(start)
+            raise
+
+    def _close_one(self, stationname):
+        f = self.files.pop(stationname)
+        if not self._flush_one(f):
+            self.unwritten.append(f)
+            return
+        try:
+            f['fp'].close()
+        except OSError as e:
+            print("Couldn't close %s: %s" % (f['path'], e), file=sys.stderr)
+
+    def _schedule(self):
+        """Make sure there's a timer that will flush waiting lines."""
+        if self.timer or self.flush_seconds <= 0:
+            return
+        self.timer = threading.Timer(self.flush_seconds, self._flush_stale)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _flush_stale(self):
+        """Timer callback: flush anything that's been waiting too long."""
+        with self.lock:
+            self.timer = None
+            self._retry_unwritten()
+            now = time.monotonic()
+            waiting = bool(self.unwritten)
+            for f in self.files.values():
+                if f['since'] is None:
+                    continue
+                if now - f['since'] >= self.flush_seconds:
+                    self._flush_one(f)
+                else:
+                    waiting = True
+            if waiting:
+                self._schedule()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# A feed of what's happening to the stations, for pages that update
+# themselves as reports come in instead of reloading every minute:
+# see /events in watchserver.py, and templates/stations.html.
+#
+# Events are kept in a ring buffer, numbered as they come in, and every
+# reader waits on the same Condition: there's no queue or thread
+# per reader, and publishing an event is just an append and a
+# notify_all, so it never waits for readers, however slow they are.
+# Each reader keeps track of the last event it's seen, and takes
+# whatever's newer from the buffer when it wakes up. A reader that's
+# fallen so far behind that the events it hasn't seen have dropped off
+# the end of the buffer is told to start over, rather than holding
+# anything up.
+
+import threading
+from collections import deque
+
+
+class EventFeed:
+    """The last size events, as (id, kind, data), where data is
+       a string (e.g. JSON), made once however many readers there are.
+    """
+
+    def __init__(self, size=256):
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.cond = threading.Condition()
+
+    def publish(self, kind, data):
+        """Add an event. Return its id."""
+        with self.cond:
+            self.last_id += 1
+            self.events.append((self.last_id, kind, data))
+            self.cond.notify_all()
+            return self.last_id
+
+    def wait(self, after_id, timeout=None):
+        """Wait up to timeout seconds for events newer than after_id.
+           Return a list of (id, kind, data), empty if none came,
+           or None if some have been missed (they're no longer in
+           the buffer, or after_id is from before the server restarted)
+           and the reader needs to start over from last_id.
+        """
+        with self.cond:
+            if after_id > self.last_id:
+                return None
+            self.cond.wait_for(lambda: self.last_id > after_id, timeout)
+            if self.last_id == after_id:
+                return []
+            if self.events[0][0] > after_id + 1:
+                return None
+            return [ ev for ev in self.events if ev[0] > after_id ]
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Save reports in the background, so a station posting a report
+# doesn't have to wait for the disk (an SD card on a Raspberry Pi
+# can take seconds to write when it's busy).
+#
+# /report puts each report on a bounded queue and returns right away;
+# a writer thread takes them off in batches, as many as are waiting,
+# and saves each batch in one go (see stations.save_reports()).
+# If the writer falls so far behind that the queue fills up,
+# put() raises queue.Full and /report answers 503 with Retry-After,
+# rather than making stations wait.
+#
+# stop() saves everything that's been queued before it returns,
+# and it's also run at exit.
+#
+# Settings, in ~/.config/watchweather/server.conf:
+#
+# [ingest]
+# queue_size = 1000
+# batch_size = 100
+
+import sys
+import atexit
+import queue
+import threading
+
+
+# Put on the queue by stop() to tell the writer to finish.
+_STOP = object()
+
+
+class IngestQueue:
+    """Items waiting to be saved by save_batch(list of items),
+       in a thread of its own.
+    """
+
+    def __init__(self, save_batch, queue_size=1000, batch_size=100):
+        self.save_batch = save_batch
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+
+        self.saved = 0
+        self.batches = 0
+        self.errors = 0
+
+        atexit.register(self.stop)
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run,
+                                       name="ingest", daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        """Queue an item to be saved.
+           Raises queue.Full if there are too many waiting already,
+           or RuntimeError if the writer isn't running.
+        """
+        if not self.thread:
+            raise RuntimeError("Not taking reports")
+        self.queue.put_nowait(item)
+
+    def join(self):
+        """Wait until everything queued so far has been saved."""
+        self.queue.join()
+
+    def stop(self):
+        """Save everything that's waiting, then stop the writer."""
+        thread = self.thread
+        if not thread:
+            return
+        self.thread = None
+        # Blocks while the queue is full, but the writer is emptying it.
+        self.queue.put(_STOP)
+        thread.join()
+
+    def _run(self):
+        while True:
+            batch = [ self.queue.get() ]
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is _STOP
+            items = batch[:-1] if stopping else batch
+            try:
+                if items:
+                    self.save_batch(items)
+                    self.saved += len(items)
+                    self.batches += 1
+            except Exception as e:
+                self.errors += 1
+                print("Couldn't save %d reports: %s" % (len(items), e),
+                      file=sys.stderr)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+            if stopping:
+                return
+
+    def status(self):
+        return { "running": bool(self.thread),
+                 "queued": self.queue.qsize(),
+                 "queue_size": self.queue.maxsize,
+                 "saved": self.saved,
+                 "batches": self.batches,
+                 "errors": self.errors }
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# A cache of pages the server has made, in memory, so a page that's
+# loaded again and again (a year's /cumulative report, a month of
+# /api/series data for a plot) isn't made again until something
+# it shows has changed.
+#
+# Each page is kept with the stations it shows data from and the
+# range of days it covers; when a station reports (see
+# stations.note_changed()), only the pages that cover that station
+# and day are dropped. So a plot of last month can be kept until
+# it falls out of the cache, while the pages showing today get
+# dropped as reports come in.
+#
+# Pages can also have a time to live, for anything else they depend on.
+# The cache is bounded by the total size of the pages it keeps,
+# dropping the least recently used first.
+#
+# Settings, in ~/.config/watchweather/server.conf:
+#
+# [pagecache]
+# max_mb = 32
+# ttl = 300
+#
+# max_mb = 0 turns it off.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedPage:
+    """A page in a PageCache, and what it shows."""
+
+    def __init__(self, page, size, stationnames, days, expires):
+        self.page = page
+        self.size = size
+        self.stationnames = stationnames
+        self.days = days
+        self.expires = expires
+
+    def covers(self, stationname, day):
+        if stationname is not None and self.stationnames is not None \
+           and stationname not in self.stationnames:
+            return False
+        if day is None or self.days is None:
+            return True
+        first, last = self.days
+        return (first is None or day >= first) \
+            and (last is None or day <= last)
+
+
+class PageCache:
+    """Pages, LRU, up to max_bytes of them in all.
+       ttl is the default time to live, in seconds, for pages that
+       cover the present; pages that only cover the past don't expire.
+    """
+
+    def __init__(self, max_bytes, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # { key: CachedPage }, least recently used first
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """The page cached for key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry.expires is not None \
+               and time.monotonic() >= entry.expires:
+                self._drop(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.page
+
+    def put(self, key, page, size, stationnames=None, days=None,
+            historic=False, ttl=None):
+        """Cache page, which takes about size bytes, under key.
+           stationnames is the stations whose data it shows,
+           or None for all of them; days is (first, last) dates
+           it covers (either may be None for open-ended), or None
+           for any. historic means it only shows days that are over,
+           so it doesn't expire; otherwise it's kept for ttl seconds
+           (default self.ttl).
+        """
+        if size > self.max_bytes:
+            return
+        if historic:
+            expires = None
+        else:
+            expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = CachedPage(
+                page, size,
+                None if stationnames is None else frozenset(stationnames),
+                days, expires)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self.nbytes -= self.entries.pop(key).size
+
+    def invalidate(self, stationname=None, day=None):
+        """A station's data for a day has changed: drop the pages
+           that show it. None for either means any.
+        """
+        with self.lock:
+            for key in [ key for key, entry in self.entries.items()
+                         if entry.covers(stationname, day) ]:
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """How the cache is doing, as a dictionary."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return { "entries": len(self.entries),
+                     "bytes": self.nbytes,
+                     "max_bytes": self.max_bytes,
+                     "hits": self.hits,
+                     "misses": self.misses,
+                     "hit_rate": self.hits / lookups if lookups else None,
+                     "evictions": self.evictions,
+                     "invalidations": self.invalidations }
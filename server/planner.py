@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Decide where to read each part of a time range from.
+#
+# compact_stations() (in stations.py) replaces a past year's raw
+# day files with summaries, and moves the day files to savedir/archived:
+#     Stationname-YYYY-MM-hourly.csv, a row per hour for a month,
+#     Stationname-YYYY-daily.csv, a row per day for a year,
+# where each row has the lows and highs of the main fields
+# (see stat_hdrs in compact_stations()).
+#
+# For each day in a range, plan() picks the cheapest source that has it:
+# the raw day files (with their rollups) if they're still there,
+# since they're exact; then the rollups of a day whose raw file has
+# expired (see retention.py), which still have each minute;
+# otherwise the daily summaries for buckets of a day or more and
+# the hourly summaries for anything shorter,
+# or whichever of those has the day if the other doesn't.
+# CSVStorage stitches the pieces together, so plots and reports
+# over compacted years don't need the archived files.
+#
+# Summary rows are turned into rollup buckets (see rollups.py),
+#     [ count, sum, low, high, last ]
+# with a count of 1. The summaries only keep lows and highs,
+# so a field's value for the hour or day is the middle of its range,
+# which is close enough for plots over months or years.
+
+import os, sys
+import csv
+import threading
+from datetime import datetime, date
+
+import rollups
+from timeparse import to_seconds, from_seconds
+
+
+# Summary column(s) each raw field comes from
+SUMMARY_FIELDS = {
+    "temperature": ("min_temperature", "max_temperature"),
+    "humidity": ("min_humidity", "max_humidity"),
+    "gust_speed": ("max_wind",),
+    "max_gust": ("max_gust",),
+    "absolute_pressure": ("min_pressure", "max_pressure"),
+    "uv": ("max_uv",),
+    "solar_radiation": ("max_solar_radiation",),
+}
+
+# The rain column is the last rain_hourly of each hour in the
+# hourly summaries, and the last rain_daily of each day in the daily ones.
+RAIN_FIELDS = { 'hour': "rain_hourly", 'day': "rain_daily" }
+
+# Parsed summary files: { path: (mtime, size, { start_secs: fields }) }
+_cache = {}
+
+_lock = threading.Lock()
+
+
+def summary_path(savedir, stationname, level, day):
+    """The summary file that would have day: level 'hour' or 'day'."""
+    if level == 'hour':
+        filename = "%s-%04d-%02d-hourly.csv" % (stationname,
+                                               day.year, day.month)
+    else:
+        filename = "%s-%04d-daily.csv" % (stationname, day.year)
+    return os.path.join(savedir, filename)
+
+
+def _value(s):
+    """A summary value as a float, or None for missing.
+       compact_stations() writes a field with no data as
+       its StatField's starting low or high, +-sys.maxsize.
+    """
+    try:
+        val = float(s)
+    except (ValueError, TypeError):
+        return None
+    if val != val or abs(val) >= sys.maxsize:
+        return None
+    return val
+
+
+def _bucket_fields(row, level):
+    """Rollup bucket fields for one summary row."""
+    fields = {}
+    for field, columns in SUMMARY_FIELDS.items():
+        vals = [ _value(row.get(c)) for c in columns ]
+        vals = [ v for v in vals if v is not None ]
+        if not vals:
+            continue
+        mid = (min(vals) + max(vals)) / 2
+        fields[field] = [ 1, mid, min(vals), max(vals), mid ]
+    rain = _value(row.get("rain"))
+    if rain is not None:
+        fields[RAIN_FIELDS[level]] = [ 1, rain, rain, rain, rain ]
+    return fields
+
+
+def _load(path, level):
+    """{ start_secs: bucket fields } for a summary file, empty if
+       there's no such file.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+
+    with _lock:
+        cached = _cache.get(path)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached[2]
+
+    buckets = {}
+    with open(path, newline='') as fp:
+        for row in csv.DictReader(fp):
+            # Times are "YYYY-MM-DD HH"; for the daily summaries
+            # that's the hour of the day's first report.
+            try:
+                t = datetime.strptime(row["time"], "%Y-%m-%d %H")
+            except (ValueError, TypeError, KeyError):
+                continue
+            if level == 'day':
+                t = t.replace(hour=0)
+            # Rows can be repeated; the last one is the most complete.
+            buckets[to_seconds(t)] = _bucket_fields(row, level)
+
+    with _lock:
+        _cache[path] = (st.st_mtime, st.st_size, buckets)
+    return buckets
+
+
+def _level_buckets(savedir, stationname, level, day):
+    start = to_seconds(datetime(day.year, day.month, day.day))
+    summaries = _load(summary_path(savedir, stationname, level, day), level)
+    return [ [ t, summaries[t] ] for t in sorted(summaries)
+             if start <= t < start + rollups.LEVELS['day'] ]
+
+
+def day_buckets(savedir, stationname, day, level):
+    """Rollup buckets for a day from the summary files:
+       hour buckets (level 'hour') if there's an hourly summary
+       for the day, otherwise one day bucket, or the other way around
+       for level 'day'. Returns [] if no summary has the day.
+    """
+    if level == 'hour':
+        return _level_buckets(savedir, stationname, 'hour', day) \
+            or _level_buckets(savedir, stationname, 'day', day)
+
+    buckets = _level_buckets(savedir, stationname, 'day', day)
+    if buckets:
+        return buckets
+
+    # Add up the day's hours.
+    hours = _level_buckets(savedir, stationname, 'hour', day)
+    if not hours:
+        return []
+    fields = {}
+    for start, hourfields in hours:
+        rollups.merge(fields, hourfields)
+    rain = [ h[1][RAIN_FIELDS['hour']][rollups.SUM] for h in hours
+             if RAIN_FIELDS['hour'] in h[1] ]
+    if rain:
+        fields[RAIN_FIELDS['day']] = [ 1, sum(rain), min(rain), max(rain),
+                                       sum(rain) ]
+    fields.pop(RAIN_FIELDS['hour'], None)
+    return [ [ hours[0][0] - hours[0][0] % rollups.LEVELS['day'], fields ] ]
+
+
+def summary_days(savedir, stationname, start_date, end_date):
+    """The set of days from start_date through end_date
+       that are in a summary file.
+    """
+    days = set()
+    for level in ('day', 'hour'):
+        paths = set()
+        day = start_date
+        while day <= end_date:
+            paths.add(summary_path(savedir, stationname, level, day))
+            if level == 'day':
+                day = date(day.year + 1, 1, 1)
+            elif day.month == 12:
+                day = date(day.year + 1, 1, 1)
+            else:
+                day = date(day.year, day.month + 1, 1)
+        for path in paths:
+            for t in _load(path, level):
+                d = from_seconds(t).date()
+                if start_date <= d <= end_date:
+                    days.add(d)
+    return days
+
+
+def plan(days, has_raw, summarized, level, has_rollups=None):
+    """Decide where to read each of days from.
+       has_raw(day) says whether there's a raw day file for the day,
+       and has_rollups(day), if given, whether there are rollups for it;
+       summarized is the set of days that are in a summary file;
+       level is the summary level to use, 'hour' or 'day'.
+       Return a list of (source, [ days ]) runs in order, where
+       source is 'raw', 'rollups' (for a day with rollups but
+       no raw file) or the summary level.
+    """
+    runs = []
+    for day in days:
+        if has_raw(day):
+            source = 'raw'
+        elif has_rollups and has_rollups(day):
+            source = 'rollups'
+        elif day not in summarized:
+            source = 'raw'
+        else:
+            source = level
+        if runs and runs[-1][0] == source:
+            runs[-1][1].append(day)
+        else:
+            runs.append((source, [ day ]))
+    return runs
+
+
+def stitch(parts, valtypes):
+    """Join resampled data (as from stations.read_csv_data_resample())
+       for consecutive parts of a range into one. Where parts overlap,
+       the earlier part wins.
+    """
+    retdata = { 't': [] }
+    for vt in valtypes:
+        retdata[vt] = []
+    for part in parts:
+        for i, t in enumerate(part['t']):
+            if retdata['t'] and t <= retdata['t'][-1]:
+                continue
+            retdata['t'].append(t)
+            for vt in valtypes:
+                retdata[vt].append(part[vt][i])
+    return retdata
+
+
+def overlay(parts, valtypes):
+    """Join resampled data on the same grid (as from
+       resample.resample_grid()) for parts of a range into one:
+       each bucket's value is the first part's that isn't None.
+    """
+    retdata = { 't': parts[0]['t'] }
+    for vt in valtypes:
+        retdata[vt] = [ next((v for v in vals if v is not None), None)
+                        for vals in zip(*(part[vt] for part in parts)) ]
+    return retdata
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# What the server knows about the stations right now, shared between
+# request threads (mod_wsgi runs several: see README.md), the ingest
+# writer thread and the background compactor.
+#
+# A Registry is copy-on-write: its contents are an immutable snapshot,
+# and every change makes a new snapshot and swaps it in. So readers
+# don't need a lock: a page takes snapshot() once and uses that
+# for the whole page, and nothing can change or disappear under it,
+# however many reports come in or stations get pruned meanwhile.
+# Writers take a lock, so changes can't get lost by overlapping.
+#
+# Copying on every change is fine for a few dozen stations;
+# reads far outnumber writes anyway.
+#
+# The values should be treated as immutable too: replace a station's
+# dictionary rather than changing it.
+
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+
+
+class Registry(Mapping):
+    """A dictionary that can be read from any thread without locking.
+       Reading it like a dict reads the current snapshot; to read
+       several things that have to agree with each other,
+       use snapshot().
+    """
+
+    def __init__(self, data=None):
+        self._lock = threading.Lock()
+        self._snapshot = MappingProxyType(dict(data or {}))
+
+        # Goes up by one with every change.
+        self.version = 0
+
+    def snapshot(self):
+        """The current contents, as a read-only mapping
+           that won't ever change.
+        """
+        return self._snapshot
+
+    def update(self, changes=(), remove=()):
+        """Set the keys in changes (a mapping or (key, value) pairs),
+           and remove the keys in remove, all at once.
+           Return the new snapshot.
+        """
+        with self._lock:
+            data = dict(self._snapshot)
+            data.update(changes)
+            for key in remove:
+                data.pop(key, None)
+            self._snapshot = MappingProxyType(data)
+            self.version += 1
+            return self._snapshot
+
+    def set(self, key, value):
+        return self.update({ key: value })
+
+    def remove(self, *keys):
+        return self.update(remove=keys)
+
+    def replace(self, data):
+        """Replace everything with data."""
+        with self._lock:
+            self._snapshot = MappingProxyType(dict(data))
+            self.version += 1
+            return self._snapshot
+
+    # The rest of the Mapping interface, from the current snapshot
+
+    def __getitem__(self, key):
+        return self._snapshot[key]
+
+    def __iter__(self):
+        return iter(self._snapshot)
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __contains__(self, key):
+        return key in self._snapshot
+
+    def __repr__(self):
+        return "Registry(%r)" % dict(self._snapshot)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# Resample the CSV logs written by stations.update_station()
+# using numpy, rather than feeding rows one at a time through
+# csv.DictReader and StatField.accumulate().
+#
+# Each day file is loaded a column at a time into numpy arrays,
+# every row is assigned a bucket number, and the per-bucket
+# statistics are computed with vectorized binning, a day at a time.
+
+import sys
+import csv
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import binfiles
+import datafiles
+import timeindex
+from timeparse import to_seconds, from_seconds, parse_times_epoch
+
+
+def column_to_floats(col):
+    """Convert a list of strings to a float64 array,
+       with NaN for anything that isn't a number (usually '').
+    """
+    try:
+        return np.array(col, dtype=np.float64)
+    except ValueError:
+        pass
+
+    def tofloat(s):
+        try:
+            return float(s)
+        except ValueError:
+            return np.nan
+
+    return np.array([ tofloat(s) for s in col ], dtype=np.float64)
+
+
+def load_day_columns(filename, fields=None, start=None, end=None):
+    """Read the time column plus the named fields from one day file.
+       Return (times, { field: values }), where times is a float64
+       array of seconds since timeparse.EPOCH, sorted, and each values array
+       is float64 with NaN where a value is missing.
+       Fields not in the file's header come back as all NaN.
+       If fields is None, read every column in the file.
+       filename is the CSV file, but if there's an up-to-date
+       binary file for it (see binfiles.py), that's read instead.
+       If start or end (seconds since timeparse.EPOCH) are given,
+       only the rows needed for that range may be read, using the
+       file's time index (see timeindex.py): every row with
+       start <= t <= end plus the first row after end, maybe with
+       a few more on either side.
+       Raises FileNotFoundError if there's no such file.
+    """
+    binpath = binfiles.current_binfile(filename)
+    if binpath:
+        try:
+            return binfiles.load_columns(binpath, fields)
+        except (OSError, ValueError) as e:
+            print("Can't read %s, using the CSV: %s" % (binpath, e),
+                  file=sys.stderr)
+
+    return load_csv_columns(filename, fields, start, end)
+
+
+def load_csv_columns(filename, fields=None, start=None, end=None):
+    """load_day_columns() for the CSV file, ignoring any binary file."""
+    lines = None
+    if start is not None or end is not None:
+        lines = timeindex.read_lines(filename, start, end)
+
+    if lines is not None:
+        reader = csv.reader(lines)
+        header = next(reader, [])
+        rows = [ row for row in reader if row and row[0] ]
+    else:
+        with datafiles.open_day_file(filename) as fp:
+            reader = csv.reader(fp)
+            header = next(reader, [])
+            rows = [ row for row in reader if row and row[0] ]
+
+    if fields is None:
+        fields = [ f for f in header if f and f != 'time' ]
+
+    if 'time' not in header:
+        rows = []
+    nrows = len(rows)
+
+    def column(name):
+        if name not in header:
+            return None
+        idx = header.index(name)
+        return [ row[idx] if len(row) > idx else '' for row in rows ]
+
+    # Some historic files have decimal seconds; parse_times_epoch
+    # handles those, and gives NaN for anything unparseable.
+    times = parse_times_epoch(column('time') or [])
+    good = ~np.isnan(times)
+    times = times[good]
+
+    columns = {}
+    for field in fields:
+        col = column(field)
+        if col is None:
+            columns[field] = np.full(nrows, np.nan)[good]
+        else:
+            columns[field] = column_to_floats(col)[good]
+
+    # The files are written in time order, but in case the clock
+    # ever jumped backward, make sure the binning sees sorted times.
+    if len(times) > 1 and np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        for field in columns:
+            columns[field] = columns[field][order]
+
+    return times, columns
+
+
+def readings(times, columns, fields, start, end):
+    """Yield a tuple (time, value, value, ...) for each row with
+       start <= time < end (seconds since timeparse.EPOCH),
+       from arrays like load_day_columns() returns, with a value
+       for each of fields: time is a datetime, values are floats,
+       or None if missing.
+    """
+    keep = (times >= start) & (times < end)
+    # tolist() makes python floats; NaN != NaN.
+    values = [ [ None if v != v else v for v in columns[f][keep].tolist() ]
+               for f in fields ]
+    yield from zip(map(from_seconds, times[keep].tolist()), *values)
+
+
+def iter_readings(savedir, stationname, fields, start_time, end_time):
+    """Storage.iter_readings() straight from the day files
+       in savedir, for scripts that just want to read them
+       without setting up a Storage: days with no file are skipped.
+    """
+    start = to_seconds(start_time)
+    end = to_seconds(end_time)
+    day = start_time.date()
+    while day <= end_time.date():
+        try:
+            times, columns = load_day_columns(
+                datafiles.day_path(savedir, stationname, day),
+                fields, start, end)
+        except FileNotFoundError:
+            times = []
+        if len(times):
+            yield from readings(times, columns, fields, start, end)
+        day += timedelta(days=1)
+
+
+def resample_days(chunks, valtypes,
+                  start_time, end_time, time_incr, stat='mean'):
+    """Resample data from a sequence of day files.
+       chunks should yield (day, times, { field: values }) for each
+       day that has data, in order, with times and values as from
+       load_day_columns(). Every field in valtypes must be there.
+       stat may be 'mean', 'min', 'max' or 'count'.
+
+       The bucketing follows the row-by-row reader this replaced:
+       each row can close at most one interval, the interval start
+       resets to midnight when a new day's file is opened, and the
+       last bucket holds the first row at or after end_time.
+
+       Only one day's rows are kept at a time: each day's rows are
+       folded into running per-bucket totals.
+
+       Return: {
+           't':        [list of datetimes],
+           'valtype1': [list of floats], ...
+       }
+    """
+    start = to_seconds(start_time)
+    end = to_seconds(end_time)
+    incr = time_incr.total_seconds()
+
+    t0 = start
+    t1 = start + incr
+
+    # Labels (interval start times) of the buckets closed so far,
+    # and the number of the bucket currently being filled.
+    labels = []
+    bucket = 0
+
+    # Per-bucket counts and sums (or lows or highs) for each field
+    counts = { vt: np.zeros(0, dtype=np.int64) for vt in valtypes }
+    totals = { vt: np.zeros(0) for vt in valtypes }
+
+    def add_day(rowids, columns):
+        """Fold one day's rows, with their bucket numbers
+           (-1 for rows not used), into counts and totals.
+        """
+        nbuckets = bucket + 1
+        for vt in valtypes:
+            vals = columns[vt]
+            keep = (rowids >= 0) & ~np.isnan(vals)
+            bids = rowids[keep]
+            vals = vals[keep]
+
+            grow = nbuckets - len(counts[vt])
+            counts[vt] = np.r_[counts[vt], np.zeros(grow, dtype=np.int64)] \
+                + np.bincount(bids, minlength=nbuckets)
+            if stat in ('mean', 'count'):
+                totals[vt] = np.r_[totals[vt], np.zeros(grow)] \
+                    + np.bincount(bids, weights=vals, minlength=nbuckets)
+                continue
+
+            # min or max. Bucket numbers never decrease from row to row,
+            # so each bucket is a contiguous run and reduceat works.
+            result = np.full(nbuckets, np.nan)
+            if len(bids):
+                starts = np.flatnonzero(np.r_[True, bids[1:] != bids[:-1]])
+                ufunc = np.minimum if stat == 'min' else np.maximum
+                result[bids[starts]] = ufunc.reduceat(vals, starts)
+            combine = np.fmin if stat == 'min' else np.fmax
+            totals[vt] = combine(np.r_[totals[vt], np.full(grow, np.nan)],
+                                 result)
+
+    done = False
+    for day, times, columns in chunks:
+        nrows = len(times)
+
+        t0 = max(to_seconds(datetime.combine(day, datetime.min.time())),
+                 start)
+        rowids = np.full(nrows, -1, dtype=np.int64)
+
+        i = 0
+        while i < nrows:
+            # Skip rows before the current interval.
+            j = int(np.searchsorted(times, t0, side='left'))
+            if j > i:
+                if times[j-1] > end:
+                    done = True
+                    break
+                i = j
+                if i >= nrows:
+                    break
+
+            # The next row that closes the interval,
+            # and the first row past the end time.
+            c = max(i, int(np.searchsorted(times, t1, side='left')))
+            e = max(i, int(np.searchsorted(times, end, side='right')))
+            if e < c:
+                rowids[i:e+1] = bucket
+                done = True
+                break
+
+            rowids[i:c] = bucket
+            if c >= nrows:
+                i = nrows
+                break
+
+            # Row c closes the interval, and starts the next one.
+            labels.append(t0)
+            bucket += 1
+            t0 += incr
+            t1 = min(t0 + incr, end)
+            rowids[c] = bucket
+            i = c + 1
+            if times[c] > end:
+                done = True
+                break
+
+        add_day(rowids, columns)
+
+        if done:
+            break
+
+        # Finished the file: move on to the next interval.
+        t0 += incr
+
+    nbuckets = bucket + 1
+    results = {}
+    for vt in valtypes:
+        grow = nbuckets - len(counts[vt])
+        vtcounts = np.r_[counts[vt], np.zeros(grow, dtype=np.int64)]
+        if stat == 'count':
+            vals = vtcounts.astype(np.float64)
+        elif stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vals = np.r_[totals[vt], np.zeros(grow)] / vtcounts
+        else:
+            vals = np.r_[totals[vt], np.full(grow, np.nan)]
+        results[vt] = (vtcounts, vals)
+
+    # Save the final bucket if it got any data.
+    if valtypes and results[valtypes[0]][0][bucket]:
+        labels.append(t0)
+
+    retdata = { 't': [ from_seconds(t) for t in labels ] }
+    nlabels = len(labels)
+    for vt in valtypes:
+        counts, vals = results[vt]
+        retdata[vt] = [ float(vals[i]) if counts[i] else None
+                        for i in range(nlabels) ]
+        if stat == 'count':
+            retdata[vt] = [ int(counts[i]) for i in range(nlabels) ]
+
+    return retdata
+
+
+def resample_grid(chunks, valtypes, start_time, end_time, time_incr,
+                  stat='mean'):
+    """Resample onto a fixed grid: bucket k has the rows with
+       start_time + k * time_incr <= t < start_time + (k+1) * time_incr,
+       and every bucket up to end_time is in the result, with None for
+       a bucket with no data, so results for different stations
+       line up with each other.
+       chunks and stat are as for resample_days().
+       Return: {
+           't':        [list of datetimes],
+           'valtype1': [list of floats or None], ...
+       }
+    """
+    start = to_seconds(start_time)
+    end = to_seconds(end_time)
+    incr = time_incr.total_seconds()
+    nbuckets = max(int(np.ceil((end - start) / incr)), 0)
+
+    counts = { vt: np.zeros(nbuckets, dtype=np.int64) for vt in valtypes }
+    if stat in ('mean', 'count'):
+        totals = { vt: np.zeros(nbuckets) for vt in valtypes }
+    else:
+        totals = { vt: np.full(nbuckets, np.nan) for vt in valtypes }
+
+    for day, times, columns in chunks:
+        keep = (times >= start) & (times < end)
+        ids = ((times[keep] - start) // incr).astype(np.int64)
+        for vt in valtypes:
+            vals = columns[vt][keep]
+            good = ~np.isnan(vals)
+            bids = ids[good]
+            vals = vals[good]
+            counts[vt] += np.bincount(bids, minlength=nbuckets)
+            if stat in ('mean', 'count'):
+                totals[vt] += np.bincount(bids, weights=vals,
+                                          minlength=nbuckets)
+            elif stat == 'min':
+                np.fmin.at(totals[vt], bids, vals)
+            else:
+                np.fmax.at(totals[vt], bids, vals)
+
+    retdata = { 't': [ from_seconds(start + k * incr)
+                       for k in range(nbuckets) ] }
+    for vt in valtypes:
+        if stat == 'count':
+            retdata[vt] = counts[vt].tolist()
+            continue
+        vals = totals[vt]
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vals = vals / counts[vt]
+        retdata[vt] = [ float(v) if n else None
+                        for v, n in zip(vals, counts[vt]) ]
+    return retdata
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# How long to keep each station's data, at each resolution.
+#
+# There are three tiers:
+#     raw:    the day files (Stationname-YYYY-MM-DD.csv), a row per report,
+#             in savedir or savedir/archived
+#     minute: the rollups (see rollups.py), which keep each minute
+#     hourly: the hourly and daily summaries that compaction writes
+#             (see compaction.py), which are kept forever.
+# When a day is too old for a tier, it's first made sure to be in
+# the next one down, then its files for the tier are removed:
+# so an expiring raw day gets its rollups and summaries written
+# if they aren't there already, and an expiring minute day
+# has to be in the summaries. Readers use whatever's left
+# (see planner.py).
+#
+# Nothing expires unless there's a [retention] section in
+# ~/.config/watchweather/server.conf:
+#
+# [retention]
+# raw_days = 60
+# minute_days = 730
+#
+# Either can be "forever". A station can have its own settings
+# in a section of its own, which override [retention] for it:
+#
+# [retention Stationname]
+# raw_days = 14
+#
+# The server enforces them in the background, along with
+# compacting months as they end (see compaction.RollingCompactor).
+# Only the CSV day files expire, not the SQLite backend.
+
+import os, sys
+import time
+from datetime import date, timedelta
+
+import datafiles
+import binfiles
+import rollups
+import planner
+import timeindex
+import compaction
+import serverconfig
+
+
+# How long each tier is kept by default, in days, once there's
+# a [retention] section.
+DEFAULT_DAYS = { 'raw': 60, 'minute': 2 * 365 }
+
+SECTION = "retention"
+
+
+def enabled():
+    return serverconfig.parser().has_section(SECTION)
+
+
+def tier_days(stationname):
+    """{ tier: days to keep, or None for forever } for a station."""
+    tiers = {}
+    for tier, default in DEFAULT_DAYS.items():
+        key = tier + "_days"
+        val = serverconfig.get(SECTION + ' ' + stationname, key,
+                               serverconfig.get(SECTION, key, str(default)))
+        if val.strip().lower() in ("", "forever"):
+            tiers[tier] = None
+            continue
+        try:
+            # Today's file is still being written.
+            tiers[tier] = max(int(val), 1)
+        except ValueError:
+            print("Bad %s for %s in %s: %s; keeping everything"
+                  % (key, stationname, serverconfig.CONFIGFILE, val),
+                  file=sys.stderr)
+            tiers[tier] = None
+    return tiers
+
+
+def _raw_files(savedir, stationname, day):
+    """The existing raw files for a day, CSV first."""
+    csvfiles = []
+    otherfiles = []
+    for directory in (savedir, os.path.join(savedir, "archived")):
+        path = datafiles.day_path(directory, stationname, day)
+        for f in (path, path + datafiles.GZ_EXT):
+            if os.path.exists(f):
+                csvfiles.append(f)
+        if os.path.exists(binfiles.binfile_path(path)):
+            otherfiles.append(binfiles.binfile_path(path))
+    return csvfiles, otherfiles
+
+
+def _archived_days(savedir):
+    """{ stationname: set of days } of the day files in savedir/archived.
+    """
+    days = {}
+    try:
+        with os.scandir(os.path.join(savedir, "archived")) as entries:
+            for entry in entries:
+                parsed = datafiles.parse_day_filename(entry.name)
+                if parsed:
+                    days.setdefault(parsed[0], set()).add(parsed[1])
+    except FileNotFoundError:
+        pass
+    return days
+
+
+def expire(store, compact, today=None, rest=None):
+    """Enforce the retention tiers on store, a CSVStorage.
+       compact(stationname, days) writes the summaries for days
+       in one month from their day files (stations.compact_days()).
+       rest(started), if given, is called after each day's work
+       with the time.monotonic() it started, to keep this from
+       taking too much of the server's time; if it returns False,
+       stop.
+       Return the number of days that were moved down a tier.
+    """
+    if not today:
+        today = date.today()
+    savedir = store.savedir
+    archived = _archived_days(savedir)
+
+    stationnames = set(store.coverage.stations()) \
+        | set(store.rollup_coverage.stations()) | set(archived)
+
+    nexpired = 0
+    for stationname in sorted(stationnames):
+        tiers = tier_days(stationname)
+
+        raw_expiring = []
+        if tiers['raw'] is not None:
+            cutoff = today - timedelta(days=tiers['raw'])
+            raw_expiring = sorted(
+                d for d in set(store.coverage.days_between(stationname))
+                | archived.get(stationname, set()) if d < cutoff)
+
+        minute_expiring = []
+        if tiers['minute'] is not None:
+            cutoff = today - timedelta(days=tiers['minute'])
+            # Only for days whose raw files are gone: otherwise
+            # the rollups are just a faster way of reading them.
+            minute_expiring = [
+                d for d in store.rollup_coverage.days_between(stationname)
+                if d < cutoff and d not in raw_expiring
+                and not store.coverage.has_day(stationname, d)
+                and d not in archived.get(stationname, ()) ]
+
+        if not raw_expiring and not minute_expiring:
+            continue
+
+        alldays = raw_expiring + minute_expiring
+        summarized = planner.summary_days(savedir, stationname,
+                                          min(alldays), max(alldays))
+
+        for day in raw_expiring:
+            started = time.monotonic()
+            with compaction.work_lock:
+                if _expire_raw(store, compact, stationname, day,
+                               tiers['minute'] is None
+                               or day >= today - timedelta(
+                                   days=tiers['minute']),
+                               summarized):
+                    nexpired += 1
+            if rest and rest(started) is False:
+                return nexpired
+
+        for day in minute_expiring:
+            if day not in summarized:
+                # Nothing to fall back on, so keep it.
+                continue
+            started = time.monotonic()
+            with compaction.work_lock:
+                rollups.remove_day(savedir, stationname, day)
+                store.rollup_coverage.remove_days(stationname, [ day ])
+            nexpired += 1
+            if rest and rest(started) is False:
+                return nexpired
+
+    return nexpired
+
+
+def _expire_raw(store, compact, stationname, day, keep_minutes,
+                summarized):
+    """Remove a day's raw files, after writing its rollups
+       if keep_minutes, and its summaries.
+       Return True if it did.
+    """
+    savedir = store.savedir
+    csvfiles, otherfiles = _raw_files(savedir, stationname, day)
+    if not csvfiles:
+        return False
+
+    if keep_minutes:
+        rollups.roll_up_day(savedir, stationname, day, csvfiles[0])
+        store.rollup_coverage.add_day(stationname, day)
+
+    if day not in summarized:
+        # compact() only reads the day files in savedir, not archived ones,
+        # but archived days should have been summarized when they
+        # were archived.
+        if store.coverage.has_day(stationname, day):
+            compact(stationname, [ day ])
+        if day not in planner.summary_days(savedir, stationname, day, day):
+            print("Not expiring %s %s: it isn't in the summaries"
+                  % (stationname, day), file=sys.stderr)
+            return False
+        summarized.add(day)
+
+    print("Expiring raw data for", stationname, day, file=sys.stderr)
+    store.coverage.remove_days(stationname, [ day ])
+    for f in csvfiles:
+        timeindex.forget(f)
+        os.unlink(f)
+    for f in otherfiles:
+        os.unlink(f)
+    if not keep_minutes:
+        rollups.remove_day(savedir, stationname, day)
+        store.rollup_coverage.remove_days(stationname, [ day ])
+    return True
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+# Keep minute, hour and day rollups of each station's reports,
+# so that plots and summaries over long time ranges don't have to
+# re-read every 30-second row from the raw CSV day files.
+#
+# For every numeric field, each rollup bucket keeps
+#     [ count, sum, min, max, last ]
+# Buckets are kept in memory while they're open, and appended as
+# JSON lines to files in {savedir}/rollups once they close:
+#     {savedir}/rollups/Stationname-YYYY-MM-DD-minute.jsonl
+#     {savedir}/rollups/Stationname-YYYY-MM-DD-hour.jsonl
+#     {savedir}/rollups/Stationname-YYYY-MM-DD-day.jsonl
+#
+# Rollups are only written as reports come in. Readers fall back to
+# the raw day file for any day whose rollups are missing or older than
+# the raw file (e.g. data rsynced from another server, or a server that
+# was stopped before the day's last buckets closed).
+# Once a raw day file has expired (see retention.py), its rollups
+# are what's left of the day at better than hourly resolution.
+# To fill in rollups for historic data, run this file as a script.
+
+import os, sys
+import re
+import json
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+
+import resample
+import datafiles
+from timeparse import to_seconds, from_seconds, parse_time, parse_date
+
+
+# Bucket sizes in seconds
+LEVELS = { 'minute': 60, 'hour': 3600, 'day': 86400 }
+
+# Index of each statistic in a bucket's per-field list
+COUNT, SUM, LOW, HIGH, LAST = range(5)
+
+MINUTEFILE_RE = re.compile(r'(.*)-(\d\d\d\d-\d\d-\d\d)-minute\.jsonl$')
+
+# Open buckets for each station:
+# _open[stationname] = { 'date': date,
+#                        'minute': [ start_secs, { field: [...] } ],
+#                        'hour': ..., 'day': ... }
+_open = {}
+
+_lock = threading.Lock()
+
+
+def rollup_dir(savedir):
+    return os.path.join(savedir, "rollups")
+
+
+def rollup_path(savedir, stationname, day, level):
+    return os.path.join(rollup_dir(savedir), "%s-%s-%s.jsonl"
+                        % (stationname, day.strftime("%Y-%m-%d"), level))
+
+
+def parse_rollup_filename(filename):
+    """Return (stationname, date) for a minute rollup file's name
+       (without the directory), or None if it isn't one.
+    """
+    m = MINUTEFILE_RE.match(filename)
+    if not m:
+        return None
+    try:
+        return m.group(1), parse_date(m.group(2))
+    except ValueError:
+        return None
+
+
+def remove_day(savedir, stationname, day):
+    """Remove all the rollup files for a day."""
+    for level in LEVELS:
+        try:
+            os.unlink(rollup_path(savedir, stationname, day, level))
+        except FileNotFoundError:
+            pass
+
+
+def bucket_start(secs, level):
+    """Start (in seconds) of the bucket containing secs."""
+    return secs - secs % LEVELS[level]
+
+
+def fold(fields, vals):
+    """Fold a dict of { field: float } into a bucket's fields."""
+    for f in vals:
+        v = vals[f]
+        stats = fields.get(f)
+        if stats is None:
+            fields[f] = [ 1, v, v, v, v ]
+        else:
+            stats[COUNT] += 1
+            stats[SUM] += v
+            stats[LOW] = min(stats[LOW], v)
+            stats[HIGH] = max(stats[HIGH], v)
+            stats[LAST] = v
+
+
+def merge(fields, other):
+    """Merge the fields of a later bucket, other, into fields."""
+    for f in other:
+        o = other[f]
+        stats = fields.get(f)
+        if stats is None:
+            fields[f] = list(o)
+        else:
+            stats[COUNT] += o[COUNT]
+            stats[SUM] += o[SUM]
+            stats[LOW] = min(stats[LOW], o[LOW])
+            stats[HIGH] = max(stats[HIGH], o[HIGH])
+            stats[LAST] = o[LAST]
+
+
+def numeric_values(station_data):
+    """The numeric fields from a report, as floats."""
+    vals = {}
+    for f in station_data:
+        v = station_data[f]
+        if f == 'time' or type(v) is bool:
+            continue
+        if isinstance(v, (int, float)) and v == v:
+            vals[f] = float(v)
+    return vals
+
+
+def summarize_columns(times, columns, level):
+    """Roll up arrays, as returned by resample.load_day_columns(),
+       into buckets of the given level.
+       Return a list of [ start_secs, { field: [...] } ] in time order.
+    """
+    if not len(times):
+        return []
+
+    ids = times // LEVELS[level]
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    buckets = [ [ float(ids[i] * LEVELS[level]), {} ] for i in starts ]
+    rownums = np.arange(len(times))
+
+    for f in columns:
+        vals = columns[f]
+        valid = ~np.isnan(vals)
+        if not valid.any():
+            continue
+        counts = np.add.reduceat(valid.astype(np.int64), starts)
+        sums = np.add.reduceat(np.where(valid, vals, 0.), starts)
+        lows = np.fmin.reduceat(vals, starts)
+        highs = np.fmax.reduceat(vals, starts)
+        lastrows = np.maximum.reduceat(np.where(valid, rownums, -1), starts)
+        for i, bucket in enumerate(buckets):
+            if counts[i]:
+                bucket[1][f] = [ int(counts[i]), float(sums[i]),
+                                 float(lows[i]), float(highs[i]),
+                                 float(vals[lastrows[i]]) ]
+    return buckets
+
+
+def _format_line(bucket):
+    return json.dumps({ "time": from_seconds(bucket[0]).strftime(
+                            "%Y-%m-%d %H:%M:%S"),
+                        "fields": bucket[1] })
+
+
+def _append(savedir, stationname, level, bucket):
+    day = from_seconds(bucket[0]).date()
+    with open(rollup_path(savedir, stationname, day, level), "a") as fp:
+        print(_format_line(bucket), file=fp)
+
+
+def _rewrite(savedir, stationname, day, level, buckets):
+    path = rollup_path(savedir, stationname, day, level)
+    tmppath = path + ".tmp"
+    with open(tmppath, "w") as fp:
+        for bucket in buckets:
+            print(_format_line(bucket), file=fp)
+    os.replace(tmppath, path)
+
+
+def _rebuild(savedir, stationname, day, rawfile, keep_open):
+    """Rewrite the rollup files for one day from its raw file.
+       If keep_open, the last bucket at each level isn't written,
+       and the open buckets are returned, to be added to as
+       more reports come in.
+    """
+    os.makedirs(rollup_dir(savedir), exist_ok=True)
+    try:
+        times, columns = resample.load_day_columns(rawfile)
+    except FileNotFoundError:
+        times, columns = np.zeros(0), {}
+
+    state = { 'date': day }
+    for level in LEVELS:
+        buckets = summarize_columns(times, columns, level)
+        if keep_open:
+            state[level] = buckets.pop() if buckets else None
+        _rewrite(savedir, stationname, day, level, buckets)
+    return state
+
+
+def is_open(stationname, day):
+    """Does this process already have open rollups for stationname and day?
+       If not, the next add_report() will rebuild them from the raw file.
+    """
+    with _lock:
+        state = _open.get(stationname)
+        return bool(state) and state['date'] == day
+
+
+def add_report(savedir, stationname, station_data, rawfile):
+    """Update the rollups with a report that has just been appended
+       to rawfile. station_data is the parsed report, including 'time'.
+    """
+    t = station_data['time']
+    secs = to_seconds(t)
+    day = t.date()
+    vals = numeric_values(station_data)
+
+    with _lock:
+        state = _open.get(stationname)
+
+        if state and state['date'] != day:
+            # A new day: close out everything from the old one.
+            for level in LEVELS:
+                if state[level]:
+                    _append(savedir, stationname, level, state[level])
+            state = None
+
+        if not state:
+            # First report this day that this process has seen.
+            # The raw file already includes this report, so starting
+            # from it catches anything written before a restart.
+            _open[stationname] = _rebuild(savedir, stationname, day, rawfile,
+                                          keep_open=True)
+            return
+
+        for level in LEVELS:
+            start = bucket_start(secs, level)
+            bucket = state[level]
+            if bucket and bucket[0] != start:
+                _append(savedir, stationname, level, bucket)
+                bucket = None
+            if not bucket:
+                bucket = [ start, {} ]
+                state[level] = bucket
+            fold(bucket[1], vals)
+
+
+def read_buckets(savedir, stationname, day, level, rawfile):
+    """Return the list of [ start_secs, { field: [...] } ] buckets
+       for one station and day, or None if the rollups for that day
+       can't be trusted and the raw file should be read instead.
+    """
+    path = rollup_path(savedir, stationname, day, level)
+
+    with _lock:
+        state = _open.get(stationname)
+        if state and state['date'] == day:
+            # This process has been writing this day's rollups,
+            # so the file plus the open bucket is everything.
+            openbucket = state[level]
+            if openbucket:
+                openbucket = [ openbucket[0],
+                               { f: list(openbucket[1][f])
+                                 for f in openbucket[1] } ]
+        elif day >= date.today():
+            return None
+        else:
+            openbucket = None
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                return None
+            try:
+                if mtime < datafiles.stat_day_file(rawfile).st_mtime:
+                    return None
+            except FileNotFoundError:
+                # The raw file has expired, so the rollups
+                # are all there is.
+                pass
+
+    buckets = []
+    try:
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    js = json.loads(line)
+                    start = to_seconds(parse_time(js["time"]))
+                except (ValueError, KeyError):
+                    continue
+                # After an interrupted write, the same bucket could
+                # show up twice; merge rather than double-count.
+                if buckets and buckets[-1][0] == start:
+                    merge(buckets[-1][1], js["fields"])
+                else:
+                    buckets.append([ start, js["fields"] ])
+    except FileNotFoundError:
+        if not openbucket:
+            return None
+
+    if openbucket:
+        buckets.append(openbucket)
+    return buckets
+
+
+def day_buckets(savedir, stationname, day, level, rawfile):
+    """Rollup buckets for a day, from the rollup files if they're
+       up to date, otherwise computed from the raw file.
+       Returns [] if there's no data for the day.
+    """
+    buckets = read_buckets(savedir, stationname, day, level, rawfile)
+    if buckets is not None:
+        return buckets
+    try:
+        times, columns = resample.load_day_columns(rawfile)
+    except FileNotFoundError:
+        return []
+    return summarize_columns(times, columns, level)
+
+
+def level_for(start_time, time_incr):
+    """Which rollup level can serve buckets of time_incr
+       starting at start_time? None if none of them can.
+    """
+    incr = time_incr.total_seconds()
+    offset = to_seconds(start_time)
+    for level in ('day', 'hour'):
+        secs = LEVELS[level]
+        if incr >= secs and incr % secs == 0 and offset % secs == 0:
+            return level
+    return None
+
+
+def resample_rollups(savedir, stationname, valtypes,
+                     start_time, end_time, time_incr, rawfile_for,
+                     days=None):
+    """Resample valtypes to buckets of time_incr from the rollups.
+       rawfile_for(day) gives the path of the raw file for a day.
+       days, if given, is the list of days that have data;
+       otherwise every day in the range is tried.
+       Returns the same format as stations.read_csv_data_resample():
+       one entry per bucket that has any data, labeled with the
+       bucket's start time, with the mean of each field.
+    """
+    level = level_for(start_time, time_incr)
+    if not level:
+        raise ValueError("No rollup level for %s buckets starting at %s"
+                         % (time_incr, start_time))
+
+    if days is None:
+        days = []
+        day = start_time.date()
+        while day <= end_time.date():
+            days.append(day)
+            day += timedelta(days=1)
+
+    def buckets():
+        for day in days:
+            yield from day_buckets(savedir, stationname, day, level,
+                                   rawfile_for(day))
+
+    return resample_buckets(buckets(), valtypes,
+                            start_time, end_time, time_incr)
+
+
+def resample_buckets(buckets, valtypes, start_time, end_time, time_incr,
+                     grid=False):
+    """Combine rollup-style [ start_secs, { field: [...] } ] buckets
+       into buckets of time_incr starting at start_time:
+       each goes into the time_incr bucket its start falls in.
+       Returns the same format as resample_rollups(), or with grid,
+       as resample.resample_grid(): every bucket from start_time
+       up to end_time, with None where there's no data.
+    """
+    start = to_seconds(start_time)
+    end = to_seconds(end_time)
+    incr = time_incr.total_seconds()
+
+    # out[k] = { field: [ count, sum ] } for bucket start + k * incr
+    out = {}
+    for bstart, fields in buckets:
+        if bstart < start or bstart > end or (grid and bstart == end):
+            continue
+        k = int((bstart - start) // incr)
+        outfields = out.setdefault(k, {})
+        for vt in valtypes:
+            if vt in fields:
+                stats = outfields.setdefault(vt, [ 0, 0. ])
+                stats[0] += fields[vt][COUNT]
+                stats[1] += fields[vt][SUM]
+
+    if grid:
+        keys = range(max(int(np.ceil((end - start) / incr)), 0))
+    else:
+        keys = sorted(out)
+
+    retdata = { 't': [] }
+    for vt in valtypes:
+        retdata[vt] = []
+    for k in keys:
+        retdata['t'].append(from_seconds(start + k * incr))
+        if k not in out:
+            for vt in valtypes:
+                retdata[vt].append(None)
+            continue
+        for vt in valtypes:
+            if vt in out[k]:
+                retdata[vt].append(out[k][vt][1] / out[k][vt][0])
+            else:
+                retdata[vt].append(None)
+    return retdata
+
+
+def roll_up_day(savedir, stationname, day, rawfile):
+    """Write the rollup files for a closed day from rawfile,
+       unless they're already up to date.
+       Return True if they had to be written.
+    """
+    try:
+        mtime = datafiles.stat_day_file(rawfile).st_mtime
+        if all(os.stat(rollup_path(savedir, stationname, day, level))
+               .st_mtime >= mtime for level in LEVELS):
+            return False
+    except FileNotFoundError:
+        pass
+    _rebuild(savedir, stationname, day, rawfile, keep_open=False)
+    return True
+
+
+def backfill(savedir, stationname=None):
+    """Write rollups for every closed day file in savedir that doesn't
+       have up-to-date ones. stationname may limit it to one station.
+    """
+    today = date.today()
+    for filename in sorted(os.listdir(savedir)):
+        parsed = datafiles.parse_day_filename(filename)
+        if not parsed:
+            continue
+        station, day = parsed
+        if stationname and station != stationname:
+            continue
+        if day >= today:
+            continue
+        rawfile = datafiles.day_path(savedir, station, day)
+        if read_buckets(savedir, station, day, 'day', rawfile) is not None:
+            continue
+        print("Rolling up", filename, file=sys.stderr)
+        _rebuild(savedir, station, day, rawfile, keep_open=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        backfill(sys.argv[1])
+    else:
+        backfill(os.path.expanduser("~/.cache/watchserver"))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Server settings, read from ~/.config/watchweather/server.conf,
+# an INI-style file, e.g.
+#
+# [writer]
+# flush_lines = 16
+# flush_seconds = 30
+# fsync = no
+#
+# Everything has a default, so the file is optional.
+
+import os, sys
+import configparser
+
+
+CONFIGFILE = os.path.expanduser("~/.config/watchweather/server.conf")
+
+_parser = None
+
+
+def parser():
+    """The ConfigParser for the config file, read the first time it's needed.
+    """
+    global _parser
+
+    if _parser is None:
+        _parser = configparser.ConfigParser()
+        try:
+            _parser.read(CONFIGFILE)
+        except configparser.Error as e:
+            print("Ignoring bad config file %s: %s" % (CONFIGFILE, e),
+                  file=sys.stderr)
+    return _parser
+
+
+def _get(getter, section, key, fallback):
+    try:
+        return getter(section, key, fallback=fallback)
+    except ValueError as e:
+        print("Bad value for %s in [%s] in %s: %s"
+              % (key, section, CONFIGFILE, e), file=sys.stderr)
+        return fallback
+
+
+def get(section, key, fallback=None):
+    return _get(parser().get, section, key, fallback)
+
+
+def getint(section, key, fallback=None):
+    return _get(parser().getint, section, key, fallback)
+
+
+def getfloat(section, key, fallback=None):
+    return _get(parser().getfloat, section, key, fallback)
+
+
+def getboolean(section, key, fallback=None):
+    return _get(parser().getboolean, section, key, fallback)
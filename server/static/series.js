@@ -0,0 +1,144 @@
+// Fetch station data from /api/series and plot it with Chart.js.
+//
+// The data comes in the packed binary format (format=f32), so it can
+// go straight into typed arrays without any parsing: the times as
+// a Float64Array of Unix milliseconds, then a Float32Array for
+// each field, with NaN where there's no data.
+
+// Fetch a station's fields over a time range.
+// start and end are as in the plot URLs (yyyy-mm-ddTHH:MM);
+// res is a resolution like "1h", or "daily" (see /api/series).
+// Returns a Promise of { t: Float64Array, values: { field: Float32Array } }
+function fetchSeries(station, fields, start, end, res, grid) {
+    return fetchPacked([ station ], fields, start, end, res, grid)
+        .then(function(allseries) { return allseries[station]; });
+}
+
+// Fetch several stations' fields onto one grid of res from start,
+// in a single request. Returns a Promise of { station: series },
+// each series as from fetchSeries(), all sharing the same t.
+function fetchStationSeries(stations, fields, start, end, res) {
+    return fetchPacked(stations, fields, start, end, res, true);
+}
+
+function fetchPacked(stations, fields, start, end, res, grid) {
+    var params = new URLSearchParams({
+        fields: fields.join(','),
+        start: start,
+        end: end,
+        res: res,
+        format: 'f32'
+    });
+    if (grid)
+        params.set('grid', '1');
+
+    var what = stations.join(', ');
+    return fetch('/api/series/' + stations.map(encodeURIComponent).join(',')
+                 + '?' + params)
+        .then(function(response) {
+            if (!response.ok)
+                throw new Error("Couldn't fetch data for " + what);
+            var names = response.headers.get('X-Series-Fields').split(',');
+            return response.arrayBuffer().then(function(buf) {
+                // 8 bytes for each time, then 4 for each value,
+                // each station's fields in turn
+                var ncols = stations.length * names.length;
+                var n = buf.byteLength / (8 + 4 * ncols);
+                var t = new Float64Array(buf, 0, n);
+                var allseries = {};
+                stations.forEach(function(station, s) {
+                    var series = { t: t, values: {} };
+                    for (var i = 0; i < names.length; ++i)
+                        series.values[names[i]] = new Float32Array(
+                            buf, 8 * n + 4 * n * (s * names.length + i), n);
+                    allseries[station] = series;
+                });
+                return allseries;
+            });
+        });
+}
+
+// Make a chart in canvas canvasid, and fill it in once its data arrives.
+// Each of datasets is { series: Promise from fetchSeries(), field: name,
+// label: string, type: 'line' or 'bar', color: string },
+// the first of them on top; the x axis comes from the first one's times.
+// roundoff is what to round the y axis limits to;
+// ymin, if set, is the bottom of the y axis.
+function plotSeries(canvasid, datasets, roundoff, ymin) {
+    var ctx = document.querySelector('#' + canvasid).getContext('2d');
+    var chart = new Chart(ctx, {
+        data: {
+            labels: [],
+            datasets: datasets.map(function(d) {
+                return {
+                    type: d.type || 'line',
+                    label: d.label,
+                    data: [],
+                    pointRadius: 0,
+                    // borderColor: the color of the line
+                    borderColor: d.type == 'bar' ? 'black' : d.color,
+                    backgroundColor: d.color
+                };
+            })
+        },
+        options: {
+          scales: {
+            x: {
+              type: 'timeseries',
+              time: {
+                unit: 'day',
+                displayFormats: {
+                  hour: 'D-M-Y'         // could append  H:00:00
+                },
+                tooltipFormat: 'D-M-Y'  // <-- same format for tooltip
+              }
+            },
+            y: {}
+          },
+
+          plugins: {
+            legend: {
+              labels: {
+                usePointStyle: true,
+                pointStyle: 'line'
+              }
+            }
+          },
+
+          // Next two options are needed in order to size
+          // .chart-container in CSS
+          responsive: true,
+          maintainAspectRatio: false
+        }
+    });
+
+    Promise.all(datasets.map(function(d) { return d.series; }))
+        .then(function(allseries) {
+            chart.data.labels = allseries[0].t;
+
+            // charts.js can't do auto scaling,
+            // so find the limits of everything that's plotted.
+            var lo = Infinity, hi = -Infinity;
+            datasets.forEach(function(d, i) {
+                var vals = allseries[i].values[d.field];
+                chart.data.datasets[i].data = vals;
+                for (var j = 0; j < vals.length; ++j) {
+                    if (isNaN(vals[j]))
+                        continue;
+                    lo = Math.min(lo, vals[j]);
+                    hi = Math.max(hi, vals[j]);
+                }
+            });
+            if (lo > hi) {
+                lo = 0;
+                hi = 1;
+            }
+            chart.options.scales.y.min = (ymin === undefined)
+                ? Math.floor(lo / roundoff) * roundoff : ymin;
+            chart.options.scales.y.max = Math.ceil(hi / roundoff) * roundoff;
+            chart.update();
+        })
+        .catch(function(e) { console.log(e); });
+
+    return chart;
+}
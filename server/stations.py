@@ -5,17 +5,35 @@
 
 import os, sys
 import json
-import csv
+import threading
 from datetime import datetime, date, timedelta
-import re
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+
+import rollups
+import resample
+import datafiles
+import binfiles
+import timeindex
+import storage
+import compaction
+import retention
+import events
+import ingest
+import registry
+import serverconfig
+from timeparse import parse_time, parse_date, to_seconds, from_seconds
 
 
 # The order in which to show fields.
 # Read from ~/.config/watchweather/fields.
 # There's one version with blanks in it, for pretty formatting,
 # and another that's just the fields in order.
+# Each is made once, then never changed, so any thread can use them.
 field_order = None
 field_order_fmt = None
+_field_order_lock = threading.Lock()
 
 
 # A dictionary of dictionaries with various quantities we can report.
@@ -24,10 +42,15 @@ field_order_fmt = None
 # For example, station['office'] -> { 'temperature': 73, 'time': <datetime> }
 # Values may be numbers or strings, but will normally be strings
 # because that's what's sent in web requests.
-stations = {}
+# It's a registry.Registry, so it can be read from any thread
+# without locking: change it with set(), update() or remove(),
+# and replace a station's dict rather than changing it.
+# Use stations.snapshot() for anything that reads it more than once,
+# like iterating over it.
+stations = registry.Registry()
 
-# A dictionary of { "station_name": last_date }
-last_station_update = {}
+# A dictionary of { "station_name": last_date }, also a Registry
+last_station_update = registry.Registry()
 
 # How long to remember stations if they stop reporting.
 expire_after = None
@@ -38,7 +61,46 @@ expire_after = None
 # savedir will be ~/.cache/watchserver unless otherwise specified.
 savedir = None
 
+# Where the reports are saved, in savedir: see storage.py.
+# Use get_storage() rather than this.
+_storage = None
+
+# How many stations read_multi_resample() reads at once.
+read_threads = 4
+
+# Compacts each month as it ends: see start_compactor().
+compactor = None
+
+# Saves reports in the background: see start_ingest().
+ingest_queue = None
+
+# So pages can tell whether the data they show has changed since
+# a browser last fetched them (see data_version()):
+# how many reports each station has had since the server started,
+# and the Unix time of the last one,
+update_counts = {}
+update_times = {}
+
+# and how many times compaction or retention has rewritten files
+# since the server started, and when it last did.
+files_generation = 0
+files_changed = 0
+
+# When the server started, for stations that haven't reported since.
+started = datetime.now().timestamp()
+
+# Reports as they come in, for pages that update themselves
+# (see events.py and publish_report()).
+live_feed = events.EventFeed()
+
+# Functions to call as listener(stationname, day) when a station's
+# data for a day changes, e.g. to drop cached pages that show it.
+# Both are None when files any station's data comes from
+# have been rewritten.
+change_listeners = []
+
 initialized = False
+_init_lock = threading.Lock()
 
 
 def initialize(expiration=None, savedir_path=None):
@@ -46,10 +108,22 @@ def initialize(expiration=None, savedir_path=None):
        The optional expiration argument is a datetime.timedelta
        specifying how long to keep stations that stop reporting.
     """
-    global savedir, expire_after, initialized
+    global initialized
+
     if initialized:
         return
 
+    # The first requests may come in together.
+    with _init_lock:
+        if initialized:
+            return
+        _initialize(expiration, savedir_path)
+        initialized = True
+
+
+def _initialize(expiration, savedir_path):
+    global savedir, expire_after, last_snapshot
+
     if savedir_path:
         savedir = savedir_path
     else:
@@ -67,75 +141,203 @@ def initialize(expiration=None, savedir_path=None):
     else:
         expire_after = timedelta(days=30)
 
-    # Populate last_station_update with a list of anything that
-    # has an entry in the savedir.
-    # Also populate stations if the update hasn't expired.
-    now = datetime.now()
-    for csvfilename in sorted(os.listdir(savedir), reverse=True):
-        # Valid filenames are like "Stationname-2021-08-27.csv"
+    # Populate stations and last_station_update from the last snapshot,
+    # if there is one, and otherwise from the files in savedir.
+    if savedir and not load_snapshot():
+        scan_savedir()
 
-        m = re.match(r'(.*)-(\d\d\d\d-\d\d-\d\d)\.csv', csvfilename)
-        if not m:
-            # print("Ignoring file", csvfilename, file=sys.stderr)
-            continue
-        stationname = m.group(1)
+    # The next snapshot will be saved by update_station()
+    last_snapshot = datetime.now()
 
-        # Seen this station already? Because of the reverse sort,
-        # the first file seen is the most recent date, so
-        # ignore any subsequent ones.
-        if stationname in last_station_update:
-            continue
+    start_compactor()
+    start_ingest()
 
-        try:
-            # there's no date.strptime, alas
-            filedate = datetime.strptime(m.group(2), '%Y-%m-%d')
-        except Exception as e:
-            print("Exception parsing filename %s: %s" % (csvfilename, e),
-                  file=sys.stderr)
+    # To get a list of bogus stations for testing, uncomment the next line:
+    # populate_bogostations(5)
+
+
+def scan_savedir():
+    """Populate last_station_update with a list of anything that
+       has an entry in the savedir.
+       Also populate stations if the update hasn't expired.
+    """
+    for stationname, lastupdate in get_storage().list_stations().items():
+        # Seen this station already?
+        if stationname in last_station_update:
             continue
 
-        last_station_update[stationname] = filedate
+        last_station_update.set(stationname, lastupdate)
 
         if stationname in stations:
             # We've already seen this station
             continue
 
-        # Is the date too old?
-        if now - filedate >= expire_after:
-            # print(stationname, ": last update was too old",
-            #       filedate, "older than", expire_after)
-            continue
+        read_latest(stationname, lastupdate)
 
-        # set values from the last line of the file,
-        # which is the most recent update
-        with open(os.path.join(savedir, csvfilename)) as csvfp:
-            reader = csv.DictReader(csvfp)
-            for row in reader:
-                pass    # ignore everything but the last row
-                        # XXX consider rewriting this to be more efficient
-
-        # Populate with the values from the last row
-        stations[stationname] = {}
-        for field in row:
-            if field == 'time':
-                stations[stationname][field] = \
-                    datetime.strptime(row[field],
-                                      '%Y-%m-%d %H:%M:%S')
-                last_station_update[stationname] = \
-                    stations[stationname][field]
-            else:
-                try:
-                    stations[stationname][field] = float(row[field])
-                except ValueError:
-                    stations[stationname][field] = row[field]
-                except TypeError:
-                    # stations[stationname][field] = None
-                    pass
 
-    # To get a list of bogus stations for testing, uncomment the next line:
-    # populate_bogostations(5)
+def read_latest(stationname, lastupdate):
+    """Set a station's values from its most recent saved report,
+       unless lastupdate (a datetime) is too old.
+    """
+    # Is the date too old?
+    if datetime.now() - lastupdate >= expire_after:
+        # print(stationname, ": last update was too old",
+        #       lastupdate, "older than", expire_after)
+        return
+
+    report = get_storage().latest(stationname)
+    if not report:
+        return
+
+    # Populate with the values from the last report
+    stations.set(stationname, report)
+    last_station_update.set(stationname, report['time'])
+
+
+#
+# Snapshots of stations and last_station_update, so a restarted
+# server doesn't have to scan every file in savedir.
+#
+
+# Bump this if the snapshot format changes.
+SNAPSHOT_VERSION = 1
+
+# How often update_station() saves a snapshot.
+snapshot_interval = timedelta(minutes=5)
+
+# When the last snapshot was saved (or loaded).
+last_snapshot = None
+
+# Snapshots are saved by the ingest writer and by the compactor.
+_snapshot_lock = threading.Lock()
+
+
+def snapshot_file():
+    return os.path.join(savedir, "stations-snapshot.json")
+
+
+def snapshot_value(val):
+    """How to save a station value in a snapshot:
+       as it would be written to a CSV file, so parse() can restore it.
+    """
+    if isinstance(val, datetime):
+        if val.microsecond:
+            return val.strftime("%Y-%m-%d %H:%M:%S.%f")
+        return val.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(val, date):
+        return val.strftime("%Y-%m-%d")
+    return val
+
+
+def save_snapshot():
+    """Save stations and last_station_update to the snapshot file.
+       Write to a temporary file and rename it,
+       so there's never a partly written snapshot.
+    """
+    if not savedir:
+        return
+
+    with _snapshot_lock:
+        _save_snapshot()
 
-    initialized = True
+
+def _save_snapshot():
+    global last_snapshot
+
+    # Anything written after this is newer than the snapshot
+    # (see load_snapshot()).
+    now = datetime.now()
+
+    # Which days have files, so a restarted server
+    # doesn't have to scan savedir for those either.
+    store = get_storage()
+    coverage = None
+    if isinstance(store, storage.CSVStorage):
+        coverage = store.coverage.snapshot()
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "saved": now.timestamp(),
+        "stations": { stname: { field: snapshot_value(val)
+                                for field, val in vals.items() }
+                      for stname, vals in stations.snapshot().items() },
+        "last_station_update": { stname: snapshot_value(val)
+                                 for stname, val
+                                 in last_station_update.snapshot().items() }
+    }
+    if coverage is not None:
+        snapshot["coverage"] = { stname: [ d.isoformat() for d in days ]
+                                 for stname, days in coverage.items() }
+
+    tmpfile = snapshot_file() + ".tmp"
+    try:
+        with open(tmpfile, "w") as fp:
+            json.dump(snapshot, fp)
+        os.replace(tmpfile, snapshot_file())
+        last_snapshot = now
+    except Exception as e:
+        print("Couldn't save snapshot:", e, file=sys.stderr)
+
+
+def load_snapshot():
+    """Populate stations and last_station_update from the snapshot file,
+       then check for any data files that changed after it was saved.
+       Return True if it worked, False if there's no usable snapshot
+       and savedir needs to be scanned instead.
+    """
+    try:
+        with open(snapshot_file()) as fp:
+            snapshot = json.load(fp)
+        if snapshot["version"] != SNAPSHOT_VERSION:
+            return False
+        saved = snapshot["saved"]
+
+        newstations = {}
+        for stname, vals in snapshot["stations"].items():
+            newstations[stname] = { field: parse(val)
+                                    for field, val in vals.items() }
+            if not isinstance(newstations[stname].get('time'), datetime):
+                raise ValueError("No time for station %s" % stname)
+
+        newupdates = {}
+        for stname, val in snapshot["last_station_update"].items():
+            try:
+                newupdates[stname] = parse_time(val)
+            except ValueError:
+                newupdates[stname] = parse_date(val)
+
+        # Snapshots from before it was saved don't have the coverage.
+        coverage = None
+        if "coverage" in snapshot:
+            coverage = { stname: set(parse_date(d) for d in days)
+                         for stname, days in snapshot["coverage"].items() }
+
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        print("Ignoring bad snapshot %s: %s" % (snapshot_file(), e),
+              file=sys.stderr)
+        return False
+
+    stations.update(newstations)
+    last_station_update.update(newupdates)
+
+    # Files written after the snapshot are added to the coverage
+    # by updated_since().
+    store = get_storage()
+    if coverage is not None and isinstance(store, storage.CSVStorage):
+        store.coverage.seed(coverage)
+
+    # Stations that first reported after the snapshot will show up
+    # when they report again.
+    for stname in last_station_update.snapshot():
+        if store.updated_since(stname, saved):
+            stations.remove(stname)
+            # It was updated after the snapshot, so it's at least that new
+            read_latest(stname, datetime.fromtimestamp(saved))
+
+    prune_stations()
+    return True
 
 
 def populate_bogostations(nstations):
@@ -149,10 +351,10 @@ def populate_bogostations(nstations):
                      'Antarctica' ]
     nstations = min(nstations, len(stationnames))
     for st in stationnames[:nstations]:
-        stations[st] = { 'temperature': "%.1f" % (random.randint(65, 102)),
-                         'humidity':    "%.1f" % (random.randint(1, 100) / 100),
-                         'time' :       datetime.now()
-                       }
+        stations.set(st, { 'temperature': "%.1f" % (random.randint(65, 102)),
+                           'humidity': "%.1f" % (random.randint(1, 100) / 100),
+                           'time' :     datetime.now()
+                         })
 
 
 # The idiot python json module can't handle datetimes,
@@ -180,83 +382,255 @@ def parse(val):
     except:
         pass
     try:
-        return datetime.strptime(val, '%Y-%m-%d %H:%M:%S')
-    except:
-        pass
-    try:
-        return datetime.strptime(val, '%Y-%m-%d %H:%M:%S.%f')
-    except:
-        pass
-    try:
-        return datetime.strptime(val, '%Y-%m-%d %H:%M')
+        return parse_time(val)
     except:
         pass
     return val
 
 
-def update_station(station_name, station_data):
-    """Update a station, adding it if it's new.
-       station_data is a dictionary.
-       Also prune the list of stations.
+def parse_report(station_data):
+    """station_data is all strings since it came in through JSON.
+       Parse it to something more useful, in place.
     """
-    # station_data is all strings since it came in through JSON.
-    # Parse it to something more useful.
     for key in station_data:
         if type(station_data[key]) is str:
             station_data[key] = parse(station_data[key])
 
-    stations[station_name] = station_data
+
+def update_station(station_name, station_data):
+    """Update a station, adding it if it's new, and save the report.
+       station_data is a dictionary.
+       Also prune the list of stations.
+    """
+    set_current(station_name, station_data)
+    save_reports([ (station_name, station_data) ])
+
+
+def submit_report(station_name, station_data):
+    """Like update_station(), but if the ingest queue is running
+       (see ingest.py), leave saving the report to it.
+       Raises queue.Full if too many reports are waiting to be saved,
+       in which case the report is ignored.
+    """
+    if not ingest_queue:
+        update_station(station_name, station_data)
+        return
+
+    parse_report(station_data)
+    ingest_queue.put([ (station_name, station_data) ])
+    set_current(station_name, station_data)
+
+
+def submit_reports(reports):
+    """Take several reports at once, [ (station_name, station_data) ],
+       e.g. from /report_batch, and save them together
+       (in one transaction, for SQLite): through the ingest queue
+       if it's running, as one item.
+       A report that isn't newer than the last one from its station
+       is skipped: it's probably one a station already sent, and
+       the day files have to stay in order.
+       Return the number of reports taken.
+       Raises queue.Full as for submit_report(), taking none of them.
+    """
+    for station_name, station_data in reports:
+        parse_report(station_data)
+
+    accepted = []
+    newest = {}
+    for station_name, station_data in sorted(reports,
+                                             key=lambda r: r[1]['time']):
+        last = newest.get(station_name) \
+            or stations.get(station_name, {}).get('time')
+        if last and station_data['time'] <= last:
+            continue
+        newest[station_name] = station_data['time']
+        accepted.append((station_name, station_data))
+    if not accepted:
+        return 0
+
+    if ingest_queue:
+        ingest_queue.put(accepted)
+
+    # Only the newest report from each station is its current values.
+    for station_name, station_data in accepted:
+        if station_data['time'] == newest[station_name]:
+            set_current(station_name, station_data)
+
+    if not ingest_queue:
+        save_reports(accepted)
+    return len(accepted)
+
+
+def set_current(station_name, station_data):
+    """Make a report the station's current values."""
+    parse_report(station_data)
+
+    publish_report(station_name, stations.get(station_name), station_data)
+    stations.set(station_name, station_data)
 
     # Make sure it's also in last_station_update
-    last_station_update[station_name] = to_day(stations[station_name]['time'])
+    day = to_day(station_data['time'])
+    last_station_update.set(station_name, day)
 
-    if savedir:
-        # files are named clientname-YYYY-MM-DD
-        datafilename = os.path.join(savedir,
-                                    "%s-%s.csv" % (station_name,
-                           station_data['time'].strftime("%Y-%m-%d")))
-        there_already =  os.path.exists(datafilename)
-
-        with open(datafilename, "a") as datafp:
-            # Write a header if the file was just created:
-            if not there_already:
-                print(','.join(get_field_order()), file=datafp)
-
-            csvfields = []
-            for field in field_order:
-                if field not in station_data:
-                    continue
-                if field == 'time':
-                    csvfields.append(station_data[field].strftime("%Y-%m-%d %H:%M:%S"))
-                elif field in station_data:
-                    csvfields.append(str(station_data[field]))
-                else:
-                    csvfields.append('')
-            print(','.join(csvfields), file=datafp)
+    note_changed(station_name, day)
 
-        # To write in JSONL instead:
-        # with open(datafilename, "a") as datafp:
-        #     datafp.write(json.dumps(station_data, default=json_serial))
-        #     datafp.write('\n')
+
+def save_reports(reports):
+    """Save reports, [ (station_name, station_data) ], to storage,
+       then prune the list of stations, and save a snapshot
+       if it's time for one.
+    """
+    if savedir:
+        get_storage().append_many(reports)
+        # Now they can be read back.
+        for station_name, station_data in reports:
+            note_changed(station_name, to_day(station_data['time']))
 
     prune_stations()
 
+    # Save a snapshot every so often
+    if savedir and last_snapshot \
+       and datetime.now() - last_snapshot > snapshot_interval:
+        save_snapshot()
+
+
+def start_ingest():
+    """Start saving reports from submit_report() and submit_reports()
+       in the background,
+       unless [ingest] queue_size = 0.
+    """
+    global ingest_queue
+
+    queue_size = serverconfig.getint("ingest", "queue_size", 1000)
+    if ingest_queue or not savedir or queue_size <= 0:
+        return
+    # Each item on the queue is a list of reports.
+    ingest_queue = ingest.IngestQueue(
+        lambda items: save_reports([ report for reports in items
+                                     for report in reports ]),
+        queue_size,
+        serverconfig.getint("ingest", "batch_size", 100))
+    ingest_queue.start()
+
+
+def publish_report(station_name, old_data, station_data):
+    """Put a report on the live feed: only the values that are
+       different from the station's last report, old_data,
+       or all of them if it's a new station.
+    """
+    changed = { key: val for key, val in station_data.items()
+                if not old_data or old_data.get(key) != val }
+    live_feed.publish("report",
+                      json.dumps({ "station": station_name,
+                                   "new": not old_data,
+                                   "values": changed },
+                                 default=json_serial, separators=(',', ':')))
+
+
+def note_changed(stationname=None, day=None):
+    """A station's data for a day (a date, or None if it isn't known)
+       has changed, or if stationname is None, files that any station's
+       data comes from have been rewritten.
+    """
+    global files_generation, files_changed
+
+    now = datetime.now().timestamp()
+    if stationname:
+        update_counts[stationname] = update_counts.get(stationname, 0) + 1
+        update_times[stationname] = now
+    else:
+        files_generation += 1
+        files_changed = now
+        day = None
+
+    for listener in change_listeners:
+        listener(stationname, day)
+
+
+def data_version(stationnames):
+    """Something that changes whenever any of stationnames' data does,
+       for pages to use as an ETag.
+       It starts over when the server restarts, so it includes
+       the start time.
+    """
+    return (started, files_generation,
+            tuple((st, update_counts.get(st, 0))
+                  for st in sorted(stationnames)))
+
+
+def known_stations():
+    """Every station that's reporting, or has changed since the server
+       started, for pages of all the stations: so a station being pruned
+       changes their data_version() and data_modified() too.
+    """
+    return set(stations.snapshot()) | set(update_counts)
+
+
+def data_modified(stationnames):
+    """The Unix time when any of stationnames' data last changed,
+       or when the server started if none has since.
+    """
+    return max([ started, files_changed ]
+               + [ update_times.get(st, 0) for st in stationnames ])
+
+
+def get_storage():
+    """The storage backend for savedir (see storage.py),
+       or None if there's no savedir.
+    """
+    global _storage
+
+    if _storage and _storage.savedir != savedir:
+        _storage.close()
+        _storage = None
+    if not _storage and savedir:
+        _storage = storage.open_storage(savedir, get_field_order)
+    return _storage
+
+
+def flush_storage(stationname=None):
+    """Make sure any buffered reports, for one station or all of them,
+       have been saved.
+    """
+    if _storage:
+        _storage.flush(stationname)
+
+
+def close_storage():
+    global _storage, compactor, ingest_queue
+
+    # Save anything that's still waiting first.
+    if ingest_queue:
+        ingest_queue.stop()
+        ingest_queue = None
+    if compactor:
+        compactor.stop()
+        compactor = None
+    if _storage:
+        _storage.close()
+        _storage = None
+
 
 def prune_stations():
     """Remove any station that hasn't reported in a while.
     """
     now = datetime.now()
     deleted_stations = []
-    for stname in stations:
+    for stname, vals in stations.snapshot().items():
         try:
-            if now - stations[stname]['time'] > expire_after:
+            if now - vals['time'] > expire_after:
                 deleted_stations.append(stname)
         except KeyError:
             print("No 'time' in station", stname, sys.stderr)
             pass
 
+    if not deleted_stations:
+        return
+    stations.remove(*deleted_stations)
     for d in deleted_stations:
-        del stations[d]
+        # Pages that listed it are out of date now.
+        note_changed(d)
+        live_feed.publish("remove", json.dumps({ "station": d }))
 
 
 class StatField:
@@ -301,6 +675,15 @@ high:    %.2f""" % (self.total, self.n, self.average(), self.low, self.high)
         except ValueError:
             pass
 
+    def add_stats(self, n, total, low, high):
+        """Add stats that were accumulated elsewhere,
+           e.g. from a rollup bucket.
+        """
+        self.total += total
+        self.n += n
+        self.low = min(self.low, low)
+        self.high = max(self.high, high)
+
     def average(self):
         if not self.n:
             return None
@@ -417,6 +800,13 @@ def station_historic(stationname, days, chunkdays=1):
     reset_fields(day)
     daychunk = 0
 
+    # Summaries (highs, lows and last values) for the days in the range
+    # that have data
+    store = get_storage()
+    summaries = store.day_summaries(stationname,
+                                    store.days_with_data(stationname,
+                                                         day, lastdate))
+
     while day <= lastdate:
         if chunkdays == 'month':
             if day.day == 1:
@@ -430,26 +820,19 @@ def station_historic(stationname, days, chunkdays=1):
             reset_fields(yesterday)
             daychunk = 0
 
-        # Data files are named clientname-YYYY-MM-DD
-        daystr = day.strftime("%Y-%m-%d")
-        datafilename = os.path.join(savedir,
-                                    "%s-%s.csv" % (stationname, daystr))
-        try:
-            with open(datafilename, "r") as datafp:
-                reader = csv.DictReader(datafp)
-                for row in reader:
-                    for f in row:
-                        try:
-                            row[f] = float(row[f])
-                            if f in highlowfields:
-                                highlowfields[f].accumulate(row[f])
-                        except:
-                            continue
-        except FileNotFoundError:
-            # print("No file on", datafilename, file=sys.stderr)
+        # The day's summary has the highs and lows for the day,
+        # and the last value of each field.
+        daystats = summaries.get(day)
+        if not daystats:
+            # print("No data on", day, file=sys.stderr)
             day += timedelta(days=1)
             continue
 
+        for f in highlowfields:
+            if f in daystats:
+                highlowfields[f].add_stats(*daystats[f][:rollups.LAST])
+        row = { f: daystats[f][rollups.LAST] for f in daystats }
+
         # The last row contains the rainfall for the day
         if 'rain_daily' in row and row['rain_daily']:
             row['rain_daily'] = float(row['rain_daily'])
@@ -537,6 +920,13 @@ def to_day(dt):
     return dt.date()
 
 
+def datafile_path(stationname, day):
+    """Data files are named {savedir}/clientname-YYYY-MM-DD.csv.
+       day may be a date or a datetime.
+    """
+    return datafiles.day_path(savedir, stationname, day)
+
+
 def to_datetime(d):
     """Given datetime or date, return datetime"""
     if type(d) is datetime:
@@ -560,36 +950,20 @@ def read_daily_data(stationname, valtypes, start_date, end_date):
     for vt in valtypes:
         retdata[vt] = []
 
-    day = to_day(start_date)
-    end_date = to_day(end_date)
-    csvreader = None
-    oneday = timedelta(days=1)
-
-    while day <= end_date:
-        daystr = day.strftime("%Y-%m-%d")
-        datafilename = os.path.join(savedir,
-                                    "%s-%s.csv" % (stationname, daystr))
+    # Only the days that have data
+    store = get_storage()
+    days = store.days_with_data(stationname,
+                                to_day(start_date), to_day(end_date))
+    lastvals = store.day_last_values(stationname, days)
 
-        try:
-            datafp = open(datafilename)
-            csvreader = csv.DictReader(datafp)
-            for row in csvreader:
-                continue
-            datafp.close()
-
-            # Now row is the last row.
+    for day in days:
+        # Values from the day's last row
+        daystats = lastvals[day]
+        if daystats:
             retdata['t'].append(day)
             for vt in valtypes:
-                try:
-                    retdata[vt].append(float(row[vt]))
-                except KeyError:
-                    pass
-
-        except FileNotFoundError:
-            print("Skipping", day, ": no daily data file", file=sys.stderr)
-            csvreader = None
-
-        day += oneday
+                if vt in daystats:
+                    retdata[vt].append(daystats[vt])
 
     # Were there any keys not found?
     for vt in valtypes:
@@ -608,98 +982,298 @@ def read_csv_data_resample(stationname, valtypes,
            'valtype1': [list of floats], ...
        }
     """
-    retdata = { 't': [] }
-    statdata = {}
-    for vt in valtypes:
-        retdata[vt] = []
-        statdata[vt] = StatField()   # has n, total, low, high
-
-    def average_this_interval():
-        retdata["t"].append(t0)
+    return get_storage().resample(stationname, valtypes,
+                                  to_datetime(start_time),
+                                  to_datetime(end_time), time_incr)
+
+
+def read_series(stationname, valtypes, start_time, end_time,
+                time_incr=None, grid=False):
+    """Read valtypes for /api/series: resampled to time_incr, as from
+       read_csv_data_resample(), or onto a fixed grid as from
+       read_multi_resample() if grid is true, or if time_incr is None,
+       the days' last values as from read_daily_data().
+       Unlike those, every valtype has an entry for every time,
+       None if it's missing.
+       Return: {
+           't':        [list of datetimes],
+           'valtype1': [list of floats or None], ...
+       }
+    """
+    if time_incr is None:
+        store = get_storage()
+        days = store.days_with_data(stationname,
+                                    to_day(start_time), to_day(end_time))
+        lastvals = store.day_last_values(stationname, days)
+        days = [ day for day in days if lastvals[day] ]
+        retdata = { 't': [ to_datetime(day) for day in days ] }
         for vt in valtypes:
-            if statdata[vt]:
-                retdata[vt].append(statdata[vt].average())
-            else:
-                retdata[vt].append(None)
-
-            statdata[vt].reset()
-
+            retdata[vt] = [ lastvals[day].get(vt) for day in days ]
+        return retdata
+
+    if grid:
+        rsdata = read_multi_resample([ stationname ], valtypes,
+                                     start_time, end_time, time_incr)
+        retdata = { 't': rsdata['t'] }
+        retdata.update(rsdata['stations'][stationname])
+        return retdata
+
+    return read_csv_data_resample(stationname, valtypes,
+                                  start_time, end_time, time_incr)
+
+
+def read_multi_resample(stationnames, valtypes,
+                        start_time, end_time, time_incr):
+    """Resample valtypes for several stations onto one time axis,
+       buckets of time_incr from start_time (see resample.resample_grid),
+       reading the stations in parallel. Like read_csv_data_resample(),
+       that includes days that have been compacted or expired.
+       Return: {
+           't':        [list of datetimes],
+           'stations': { stationname: { 'valtype1': [list of floats or
+                                                     None], ... } }
+       }
+       with a value for every time for each station and valtype.
+    """
     start_time = to_datetime(start_time)
     end_time = to_datetime(end_time)
-    t0 = to_datetime(start_time)
-    t = t0
-    t1 = t0 + time_incr
-    end_day = to_day(end_time)
-
-    csvreader = None
-    day = None
-    datafp = None
-
-    while t <= end_time:
-        if not csvreader:
-            if datafp:
-                datafp.close()
-
-            # Prepare to read the next day's data
-            if not day:
-                day = to_day(start_time)
-            # If day (from the previous iteration) >= end_day,
-            # then the last file has already been read.
-            elif day >= end_day:
-                break
-            else:
-                day += timedelta(days=1)
+    store = get_storage()
 
-            # Otherwise, try to open the next day's file.
-            daystr = day.strftime("%Y-%m-%d")
-            datafilename = os.path.join(savedir,
-                                        "%s-%s.csv" % (stationname, daystr))
-            try:
-                datafp = open(datafilename)
-                csvreader = csv.DictReader(datafp)
-                t0 = to_datetime(max(to_datetime(day), start_time))
-            except FileNotFoundError:
-                # That means there's no data for this day,
-                # so skip to the next day
-                print("Skipping", day, ": no data file", file=sys.stderr)
-                csvreader = None
-                continue
+    def read_station(stationname):
+        return store.resample_grid(stationname, valtypes,
+                                   start_time, end_time, time_incr)
+
+    nthreads = max(1, min(len(stationnames), read_threads))
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        results = list(pool.map(read_station, stationnames))
+
+    if results:
+        times = results[0]['t']
+    else:
+        times = resample.resample_grid([], [], start_time, end_time,
+                                       time_incr)['t']
+    retdata = { 't': times, 'stations': {} }
+    for stationname, rsdata in zip(stationnames, results):
+        retdata['stations'][stationname] = { vt: rsdata[vt]
+                                             for vt in valtypes }
+    return retdata
+
+# Headers in the original 30-second data that get summarized:
+COMPACT_HDRS = [ "time", "temperature", "humidity",
+                 "average_wind", "gust_speed", "max_gust", "wind_direction",
+                 "rain",
+                 # "rain_hourly", "rain_daily",
+                 # "rain_weekly", "rain_monthly", "rain_yearly",
+                 "absolute_pressure", # "relative_pressure",
+                 "uv", "solar_radiation" ]
+
+# Headers for the summary files:
+SUMMARY_HDRS = [ "time", "min_temperature", "max_temperature",
+                 "min_humidity", "max_humidity", "max_wind", "max_gust",
+                 # "av_wind_direction", "stdev_wind_direction",
+                 "rain",
+                 "min_pressure", "max_pressure",
+                 "max_uv", "max_solar_radiation" ]
+
+# The columns the summaries need: rain comes from the
+# hourly and daily totals.
+COMPACT_FIELDS = [ f for f in COMPACT_HDRS if f not in ("time", "rain") ] \
+    + [ "rain_hourly", "rain_daily" ]
+
+
+def _summary_stats(t):
+    """New stats for the hour or day starting with a report at datetime t.
+    """
+    stats = { colname: StatField() for colname in COMPACT_HDRS
+              if colname != "time" }
+    stats["time"] = "%04d-%02d-%02d %02d" % (t.year, t.month, t.day, t.hour)
+    return stats
+
+
+def _summary_row(stats):
+    """A summary file line for a dictionary of StatFields."""
+    outdata = []
+    # time
+    outdata.append(stats["time"])
+
+    # min_temperature
+    outdata.append(f'{stats["temperature"].low}')
+    # max_temperature
+    outdata.append(f'{stats["temperature"].high}')
+    # min_humidity
+    outdata.append(f'{stats["humidity"].low}')
+    # max_humidity
+    outdata.append(f'{stats["humidity"].high}')
+
+    # max_wind
+    outdata.append(f'{stats["gust_speed"].high}')
+    # max_gust
+    outdata.append(f'{stats["max_gust"].high}')
+    # av_wind_direction
+    # outdata.append(f'{stats["wind_direction"].average(}'))
+    # stdev_wind_direction
+    # outdata.append(f'{stats["wind_direction"].std_dev(}'))
+
+    # rain: daily vs. hourly has already been accounted for
+    outdata.append(f'{stats["rain"].total}')
+
+    # min_pressure
+    outdata.append(f'{stats["absolute_pressure"].low}')
+    # max_pressure
+    outdata.append(f'{stats["absolute_pressure"].high}')
+    # max_uv
+    outdata.append(f'{stats["uv"].high}')
+    # max_solar_radiation
+    outdata.append(f'{stats["solar_radiation"].high}')
+
+    return ','.join(outdata)
+
+
+def compact_month(savedir, stationname, days):
+    """Summarize a station's day files for days (dates in one month):
+       write the month's hourly summary file, replacing any rows
+       it already has for those days, and return (days, lines for
+       the daily summary), where days are the ones that had files.
+       This is one unit of work for compact_stations(), and may run
+       in another process, so it only reads the day files.
+    """
+    hourly_rows = []
+    daily_rows = []
+    days_read = []
 
-        # Now there's definitely a csvreader object
+    for day in days:
+        filename = datafiles.day_path(savedir, stationname, day)
         try:
-            row = next(csvreader)
-        except StopIteration:
-            csvreader = None
-            t0 += time_incr
-            # Loop around and try again
+            times, columns = resample.load_day_columns(filename,
+                                                       COMPACT_FIELDS)
+        except FileNotFoundError:
+            # e.g. it expired (see retention.py) after it was listed:
+            # leave any summary rows it already has alone.
             continue
+        days_read.append(day)
+        print("Compacting", os.path.basename(filename), file=sys.stderr)
+
+        # Loop over the rows, typically every 30 seconds,
+        # in just this day.
+        start = to_seconds(storage.day_start(day))
+        keep = (times >= start) & (times < start + 24 * 60 * 60)
+        values = [ columns[f][keep].tolist() for f in COMPACT_FIELDS ]
+        hourlystats = None
+        dailystats = None
+        last_hour = -1
+        for t, *vals in zip(map(from_seconds, times[keep].tolist()),
+                            *values):
+            # NaN (missing) -> None
+            row = { f: None if v != v else v
+                    for f, v in zip(COMPACT_FIELDS, vals) }
+
+            if not dailystats:
+                dailystats = _summary_stats(t)
+
+            if t.hour != last_hour:
+                # Done with an hour, time to summarize the last hour
+                if hourlystats:
+                    hourly_rows.append(_summary_row(hourlystats))
+                hourlystats = _summary_stats(t)
+
+            for colname in COMPACT_HDRS:
+                if colname == "time":
+                    continue
+                try:
+                    # Rainfall comes as hourly or daily chunks;
+                    # accumulating more often than that results in
+                    # multiple adds, so it's treated specially.
+                    # Don't actually accumulate it, just replace it
+                    # each time so at the end of the time period
+                    # (day or hour) it will be the correct value.
+                    if colname == "rain":
+                        val = float(row["rain_hourly"])
+                        hourlystats["rain"].set(val)
+                        val = float(row["rain_daily"])
+                        dailystats["rain"].set(val)
+                    else:
+                        val = float(row[colname])
+                        hourlystats[colname].accumulate(val)
+                        dailystats[colname].accumulate(val)
+                except:
+                    pass
 
-        t = datetime.strptime(row['time'], "%Y-%m-%d %H:%M:%S")
-        if t < t0:
-            continue
+            last_hour = t.hour
 
-        if t >= t1:
-            # end of interval:
-            # compute averages and save the new data items
-            average_this_interval()
+        # Done with reading all the rows in the day.
+        if hourlystats:
+            hourly_rows.append(_summary_row(hourlystats))
+        if dailystats:
+            daily_rows.append(_summary_row(dailystats))
 
-            t0 += time_incr
-            t1 = t0 + time_incr
-            if not t1 or t1 > end_time:
-                t1 = end_time
+    if days_read:
+        monthfile = "%s-%04d-%02d-hourly.csv" % (stationname,
+                                                 days_read[0].year,
+                                                 days_read[0].month)
+        compaction.merge_summary(os.path.join(savedir, monthfile),
+                                 SUMMARY_HDRS, hourly_rows, days_read)
+    return days_read, daily_rows
 
-        # Whether a new interval or old, accumulate this row.
-        for vt in valtypes:
-            statdata[vt].accumulate(row[vt])
 
-    # Save the final averages
-    if statdata[valtypes[0]]:
-        average_this_interval()
+def finish_compaction(stationname, days, daily_rows):
+    """After compact_month(), add daily_rows to the daily summary file
+       for days, and record the days in the manifest.
+    """
+    if not days:
+        return
+    yearfile = "%s-%04d-daily.csv" % (stationname, days[0].year)
+    compaction.merge_summary(os.path.join(savedir, yearfile),
+                             SUMMARY_HDRS, daily_rows, days)
+    compaction.finish_unit(savedir,
+                           compaction.unit_key(stationname, days[0].year,
+                                               days[0].month),
+                           days)
+
+
+def compact_days(stationname, days):
+    """Compact some of a station's days, all in one month,
+       leaving the day files where they are:
+       this is what the rolling compactor (see compaction.py) runs.
+    """
+    flush_storage(stationname)
+    finish_compaction(stationname, *compact_month(savedir, stationname, days))
 
-    if datafp:
-        datafp.close()
 
-    return retdata
+def start_compactor():
+    """Start compacting months of the current year as they end,
+       in the background, unless [compaction] rolling = no,
+       compressing closed day files, and expiring old data
+       (see retention.py).
+    """
+    global compactor
+
+    if compactor or not savedir \
+       or not serverconfig.getboolean("compaction", "rolling", True) \
+       or not isinstance(get_storage(), storage.CSVStorage):
+        return
+
+    # It also compresses closed day files that weren't compressed
+    # as their day ended, and enforces the retention tiers,
+    # if there are any.
+    store = get_storage()
+
+    def housekeeping(rest):
+        if store.compress_closed_days:
+            store.compress_closed(rest)
+        if not retention.enabled():
+            return 0
+        nexpired = retention.expire(store, compact_days, rest=rest)
+        if nexpired:
+            # Some days are read from coarser files now.
+            note_changed()
+            save_snapshot()
+        return nexpired
+
+    compactor = compaction.RollingCompactor(
+        savedir, compact_days,
+        serverconfig.getfloat("compaction", "rolling_duty", 0.1),
+        housekeeping)
+    compactor.start()
 
 
 def compact_stations(whichstations):
@@ -707,33 +1281,30 @@ def compact_stations(whichstations):
        Write two sets of summary files:
        hourly, covering a month by hours, and daily, covering a year by days.
        Keep everything from the current year.
-       Move summarized files to savedir/archived.
+       Move summarized files to savedir/archived, compressed with gzip.
        whichstations can be a single station name, or "all".
 
        Input datafiles are named servername-yyyy-mm-dd.csv
        Output datafiles are servername-yyyy-mm-hourly.csv
        and servername-yyyy-daily.csv
+
+       Each station's month is compacted separately (compact_month()),
+       in up to [compaction] processes at once (default 1, meaning
+       in this process, without a pool),
+       and recorded in a manifest when it's done, so an interrupted run
+       can be run again and will pick up where it left off:
+       see compaction.py.
     """
     if not savedir:
         initialize()
 
-    today = date.today()
-
-    # Headers in the original 30-second data:
-    orig_hdrs = [ "time", "temperature", "humidity",
-                  "average_wind", "gust_speed", "max_gust", "wind_direction",
-                  "rain",
-                  # "rain_hourly", "rain_daily",
-                  # "rain_weekly", "rain_monthly", "rain_yearly",
-                  "absolute_pressure", # "relative_pressure",
-                  "uv", "solar_radiation" ]
-    # Headers for the summary files:
-    stat_hdrs = [ "time", "min_temperature", "max_temperature",
-                  "min_humidity", "max_humidity", "max_wind", "max_gust",
-                  # "av_wind_direction", "stdev_wind_direction",
-                  "rain",
-                  "min_pressure", "max_pressure",
-                  "max_uv", "max_solar_radiation" ]
+    if not isinstance(get_storage(), storage.CSVStorage):
+        print("Compaction only applies to CSV day files", file=sys.stderr)
+        return
+    flush_storage()
+    store = get_storage()
+
+    thisyear = date.today().year
 
     # Save the summary files in savedir, and
     # move the summarized files to this directory:
@@ -741,222 +1312,111 @@ def compact_stations(whichstations):
     if not os.path.exists(archivedir):
         os.mkdir(archivedir)
 
-    # Keep a list of files to move, but don't move them til the end
-    files_summarized = []
-
-    thisyear = date.today().year
-
-    datafiles = os.listdir(savedir)
-    datafiles.sort()
-
-    # Accumulate hourly stats over the course of a month
-    hourlystats = { "time": None }
-    monthfp = None
-    # and daily stats over the course of a year
-    dailystats = { "time": None }
-    yearfp = None
-
-    # The date of the last file processed
-    last_file_date = date(1970, 1, 1)
-
-    def zero_stats(whichstats):
-        # Starting a new chunk; initialize stat fields for every column
-        # except time.
-        for colname in orig_hdrs:
-            if colname == 'time':
-                whichstats[colname] = None
-            else:
-                whichstats[colname] = StatField()
-
-    def write_stats(stats, fp):
-        """Writes a dictionary of StatFields to the given file."""
-        outdata = []
-        # time
-        outdata.append(stats["time"])
-
-        # min_temperature
-        outdata.append(f'{stats["temperature"].low}')
-        # max_temperature
-        outdata.append(f'{stats["temperature"].high}')
-        # min_humidity
-        outdata.append(f'{stats["humidity"].low}')
-        # max_humidity
-        outdata.append(f'{stats["humidity"].high}')
-
-        # max_wind
-        outdata.append(f'{stats["gust_speed"].high}')
-        # max_gust
-        outdata.append(f'{stats["max_gust"].high}')
-        # av_wind_direction
-        # outdata.append(f'{stats["wind_direction"].average(}'))
-        # stdev_wind_direction
-        # outdata.append(f'{stats["wind_direction"].std_dev(}'))
-
-        # rain: daily vs. hourly has already been accounted for
-        # outdata.append(f'{stats["rain_hourly"].total}')
-        # outdata.append(f'{stats["rain_daily"].total}')
-        outdata.append(f'{stats["rain"].total}')
-
-        # min_pressure
-        outdata.append(f'{stats["absolute_pressure"].low}')
-        # max_pressure
-        outdata.append(f'{stats["absolute_pressure"].high}')
-        # max_uv
-        outdata.append(f'{stats["uv"].high}')
-        # max_solar_radiation
-        outdata.append(f'{stats["solar_radiation"].high}')
-
-        print(','.join(outdata), file=fp)
-
-
-    stationstart = whichstations + '-'
-    yearfp = None
-    monthfp = None
-    for f in datafiles:
-        if not f.endswith(".csv"):
+    # Day files to compact, by unit: { (stationname, year, month): [ day ] }
+    # Day files may have been compressed already.
+    units = {}
+    for f in sorted(os.listdir(savedir)):
+        parsed = datafiles.parse_day_filename(f)
+        if not parsed:
             continue
-
-        filenameparts = f.split('.')[0].split('-')
-
-        # hourly or daily files are already compacted
-        if filenameparts[-1] == 'hourly' or filenameparts[-1] == 'daily':
-            continue
-
-        # Get the station name.
-        # The date is the last 3 elements of filenameparts;
-        # the station name is the part preceding that,
-        # which might contain a dash, so allow for that.
-        stationname = '-'.join(filenameparts[:len(filenameparts)-3])
-
+        stationname, day = parsed
         if whichstations.lower() != "all" and stationname != whichstations:
             continue
-
-        # filenameparts should be [ stationname, year, month, day ] as strings
-        try:
-            file_date = date(*map(int, filenameparts[-3:]))
-        except (TypeError, ValueError) as e:
-            # skip filenames in the wrong format
-            print(f"Can't compact filename {f}: {e}", file=sys.stderr)
-            continue
-
         # Don't compact current year
-        if file_date.year == today.year:
+        if day.year >= thisyear:
             continue
+        units.setdefault((stationname, day.year, day.month), []).append(day)
+
+    with compaction.work_lock:
+        _compact_units(units, archivedir, store)
+    note_changed()
+    # So a restart doesn't look for the archived files.
+    save_snapshot()
 
-        # New year? Close the current year output file and open a new one.
-        if file_date.year != last_file_date.year:
-            if yearfp:
-                if dailystats["time"]:
-                    write_stats(dailystats, yearfp)
-                    write_stats(hourlystats, yearfp)
-                yearfp.close()
-                yearfp = None
-                zero_stats(dailystats)
-        if not yearfp:
-            yearfile = "%s-%04d-daily.csv" % (stationname, file_date.year)
-            yearpath = os.path.join(savedir, yearfile)
-            yearfp = open(yearpath, 'w+')
-            print(','.join(stat_hdrs), file=yearfp)
-
-        # New month? Close the current month output file and open a new one.
-        if file_date.month != last_file_date.month:
-            if monthfp:
-                monthfp.close()
-                monthfp = None
-
-        if not monthfp:
-            monthfile = "%s-%04d-%02d-hourly.csv" % (stationname,
-                                                     file_date.year,
-                                                     file_date.month)
-            zero_stats(hourlystats)
-            monthfp = open(os.path.join(savedir, monthfile), 'w')
-            print(','.join(stat_hdrs), file=monthfp)
-
-        # Loop over the daily files that typically store data every 30 seconds.
-        # (Tried to use numpy, but np.genfromtxt is just too braindead
-        # about reading data from CSV files and including a date field.)
-        last_hour = -1
-        with open(os.path.join(savedir, f)) as infp:
-            print("Compacting", f, file=sys.stderr)
-            reader = csv.DictReader(infp)
-            for row in reader:
-                if not row["time"]:
-                    continue
-                try:
-                    t = datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    # Sigh, there's no strptime variant that's agnostic
-                    # about whether the date has decimal seconds,
-                    # and some historic files did that.
-                    t = datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S.%f")
-                except Exception as e:
-                    print(f"{f}: Couldn't parse time from row {row}",
-                          file=sys.stderr)
-
-                # New day? Write and reset daily stats
-                if t.date() != last_file_date:
-                    if dailystats["time"]:
-                        write_stats(dailystats, yearfp)
-                    zero_stats(dailystats)
-                    dailystats["time"] = "%04d-%02d-%02d %02d" % (
-                        t.year, t.month, t.day, t.hour)
-
-                if t.hour != last_hour:
-                    # Done with an hour, time to summarize the last hour
-                    if hourlystats["time"]:
-                        write_stats(hourlystats, monthfp)
-                    zero_stats(hourlystats)
-                    hourlystats["time"] = "%04d-%02d-%02d %02d" % (
-                        t.year, t.month, t.day, t.hour)
-
-                for colname in orig_hdrs:
-                    if colname == "time":
-                        continue
-                    try:
-                        # Rainfall comes as hourly or daily chunks;
-                        # accumulating more often than that results in
-                        # multiple adds, so it's treated specially.
-                        # Don't actually accumulate it, just replace it
-                        # each time so at the end of the time period
-                        # (day or hour) it will be the correct value.
-                        if colname == "rain":
-                            val = float(row["rain_hourly"])
-                            hourlystats["rain"].set(val)
-                            val = float(row["rain_daily"])
-                            dailystats["rain"].set(val)
-                        else:
-                            val = float(row[colname])
-                            hourlystats[colname].accumulate(val)
-                            dailystats[colname].accumulate(val)
-                    except:
-                        # print("No value for", colname, "on", row["time"],
-                        #       "in", f, ":", row[colname])
-                        pass
-
-                last_hour = t.hour
-                last_file_date = file_date
-
-            # Done with reading all the rows in day file f.
-            if dailystats['time']:
-                write_stats(dailystats, yearfp)
-            if hourlystats['time']:
-                write_stats(hourlystats, monthfp)
-
-            infp.close()
-            files_summarized.append(f)
-
-    monthfp.close()
-    yearfp.close()
-
-    # Move files summarized to the archive
-    for f in files_summarized:
-        os.rename(os.path.join(savedir, f),
-                  os.path.join(archivedir, f))
+
+def _compact_units(units, archivedir, store):
+    """The rest of compact_stations(), for the day files in units,
+       { (stationname, year, month): [ day ] }.
+    """
+    manifest = compaction.load_manifest(savedir)
+
+    def archive(stationname, days):
+        """Move summarized files to the archive, compressed."""
+        store.coverage.remove_days(stationname, days)
+        for day in days:
+            path = datafiles.day_path(savedir, stationname, day)
+            timeindex.forget(path)
+            if not os.path.exists(path):
+                path += datafiles.GZ_EXT
+            f = os.path.basename(path)
+            os.rename(path, os.path.join(archivedir, f))
+            if f.endswith(".csv"):
+                datafiles.compress_day_file(os.path.join(archivedir, f))
+            binfile = binfiles.binfile_path(f)
+            if os.path.exists(os.path.join(savedir, binfile)):
+                os.rename(os.path.join(savedir, binfile),
+                          os.path.join(archivedir, binfile))
+
+    def finish(unit, days, daily_rows):
+        finish_compaction(unit[0], days, daily_rows)
+        archive(unit[0], days)
+
+    # compact_month() returns the days it found files for,
+    # and the daily summary lines.
+
+    # Days that were compacted by an earlier, interrupted run
+    # only need archiving.
+    todo = {}
+    for unit, days in units.items():
+        done = manifest.get(compaction.unit_key(*unit), set())
+        finished = [ d for d in days if d.isoformat() in done ]
+        if finished:
+            archive(unit[0], finished)
+        days = [ d for d in days if d.isoformat() not in done ]
+        if days:
+            todo[unit] = days
+
+    nprocs = min(len(todo),
+                 serverconfig.getint("compaction", "processes", 1))
+
+    # Spawning needs sys.executable to be a Python interpreter,
+    # which it isn't when Python is embedded, e.g. under mod_wsgi.
+    if nprocs > 1 and "mod_wsgi" in sys.modules:
+        print("Can't compact in separate processes under mod_wsgi",
+              file=sys.stderr)
+        nprocs = 1
+
+    if nprocs <= 1:
+        for unit, days in todo.items():
+            finish(unit, *compact_month(savedir, unit[0], days))
+        return
+
+    # Start processes fresh rather than forking this one,
+    # which may have other threads running.
+    with ProcessPoolExecutor(
+            max_workers=nprocs,
+            mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = { pool.submit(compact_month, savedir, unit[0], days):
+                    (unit, days) for unit, days in todo.items() }
+        for future in as_completed(futures):
+            unit, days = futures[future]
+            try:
+                days, daily_rows = future.result()
+            except Exception as e:
+                # Leave it for the next run.
+                print("Couldn't compact %s: %s"
+                      % (compaction.unit_key(*unit), e), file=sys.stderr)
+                continue
+            finish(unit, days, daily_rows)
 
 
 def get_field_order_fmt():
+    global field_order_fmt
+
     if not field_order_fmt:
-        read_field_order_file()
+        with _field_order_lock:
+            if not field_order_fmt:
+                field_order_fmt = read_field_order_file()
 
     return field_order_fmt
 
@@ -971,41 +1431,44 @@ def get_field_order():
 
 
 def read_field_order_file():
-    global field_order_fmt
-
+    """Return the field order, with blanks, from the fields file,
+       or the default plus any fields the stations have.
+    """
     configfile = os.path.expanduser("~/.config/watchweather/fields")
 
     try:
+        fields = []
         with open(configfile) as fp:
             for line in fp:
                 line = line.strip()
                 if line.startswith('#'):
                     continue
-                field_order_fmt.append(line)
-        return field_order_fmt
+                fields.append(line)
+        return fields
 
     except:
         # Default field order
-        field_order_fmt = [ "time",
-                            "",
-                            "temperature", "humidity",
-                            "",
-                            "average_wind", "gust_speed",
-                            "max_gust", "wind_direction",
-                            "",
-                            "rain_hourly", "rain_daily", "rain_weekly",
-                            "rain_monthly", "rain_yearly",
-                            "",
-                            "absolute_pressure", "relative_pressure",
-                            "",
-                            "uv", "solar_radiation"
-                           ]
+        fields = [ "time",
+                   "",
+                   "temperature", "humidity",
+                   "",
+                   "average_wind", "gust_speed",
+                   "max_gust", "wind_direction",
+                   "",
+                   "rain_hourly", "rain_daily", "rain_weekly",
+                   "rain_monthly", "rain_yearly",
+                   "",
+                   "absolute_pressure", "relative_pressure",
+                   "",
+                   "uv", "solar_radiation"
+                  ]
 
         # Add any extra fields that might be found in any stations
-        for stname in stations:
-            for f in stations[stname]:
-                if f not in field_order_fmt:
-                    field_order_fmt.append(f)
+        for vals in stations.snapshot().values():
+            for f in vals:
+                if f not in fields:
+                    fields.append(f)
+        return fields
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1006 @@
+#!/usr/bin/env python3
+
+# Where station reports are kept.
+#
+# Storage is the interface stations.py uses: append a report,
+# read a station's fields over a time range, get a station's latest
+# report, and list the stations. There are two implementations:
+#
+# CSVStorage is the original layout, a CSV file per station per day,
+# savedir/Stationname-YYYY-MM-DD.csv, along with everything built
+# on those files: buffered writing (daywriter.py), binary copies
+# (binfiles.py), compression of finished days (datafiles.py),
+# rollups (rollups.py), cached day summaries (daycache.py),
+# the index of which days have files (coverage.py), and reading
+# the summaries compact_stations() leaves for past years (planner.py).
+#
+# SQLiteStorage keeps every report in one database,
+# savedir/watchweather.db, in WAL mode with an index on (station, time),
+# so reading a range of any length is a single indexed scan
+# instead of opening a file per day.
+#
+# Which one to use is set in the server config file:
+#     [storage]
+#     backend = csv   (the default) or sqlite
+#
+# To copy existing CSV day files into the SQLite database:
+#     python3 server/storage.py import ~/.cache/watchserver
+
+import os, sys
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, date, timedelta
+
+import numpy as np
+
+import resample
+import rollups
+import daycache
+import datafiles
+import daywriter
+import binfiles
+import coverage
+import planner
+import serverconfig
+from timeparse import to_seconds, from_seconds, parse_time
+
+
+ONEDAY = timedelta(days=1)
+
+
+def day_start(day):
+    """Midnight at the start of a date, as a datetime."""
+    return datetime(day.year, day.month, day.day)
+
+
+def day_end(day):
+    """The last moment of a date, as a datetime."""
+    return datetime.combine(day, datetime.max.time())
+
+
+def report_value(val):
+    """A value read back from storage, as update_station() would have
+       it: a float if it's numeric, otherwise the string.
+    """
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        return val
+
+
+class Storage:
+    """The interface to wherever reports are kept.
+       fields is a function returning the fields to save, in order,
+       e.g. stations.get_field_order.
+       Times are naive local datetimes, as everywhere else.
+    """
+
+    def __init__(self, savedir, fields):
+        self.savedir = savedir
+        self.fields = fields
+
+    def append(self, stationname, station_data):
+        """Save a report: station_data is a dict with 'time' (a datetime)
+           and whatever values it has.
+        """
+        raise NotImplementedError
+
+    def append_many(self, reports):
+        """Save several reports, [ (stationname, station_data) ]."""
+        for stationname, station_data in reports:
+            self.append(stationname, station_data)
+
+    def flush(self, stationname=None):
+        """Make sure anything buffered is saved."""
+        pass
+
+    def close(self):
+        self.flush()
+
+    def read_range(self, stationname, fields, start_time, end_time):
+        """Read fields for start_time <= t < end_time.
+           Return (times, { field: values }) like
+           resample.load_day_columns(): float64 arrays, times in
+           seconds since timeparse.EPOCH, NaN for missing values.
+           fields=None means every field.
+        """
+        raise NotImplementedError
+
+    def latest(self, stationname):
+        """The station's most recent report, as a dict with 'time'
+           a datetime and numeric values as floats, or None.
+        """
+        raise NotImplementedError
+
+    def list_stations(self):
+        """Return { stationname: datetime of its last report }.
+           The time may only be the start of the day of the last report.
+        """
+        raise NotImplementedError
+
+    def updated_since(self, stationname, since):
+        """Might the station have reports saved after since,
+           a timestamp like time.time() gives?
+        """
+        return True
+
+    def days_with_data(self, stationname, start_date, end_date):
+        """A sorted list of the dates from start_date through end_date
+           that might have reports for the station.
+           This version just lists them all.
+        """
+        days = []
+        day = start_date
+        while day <= end_date:
+            days.append(day)
+            day += ONEDAY
+        return days
+
+    def extent(self, stationname):
+        """(first, last) datetimes of the station's reports, or None
+           if there aren't any. Backends may round first down and
+           last down to the start of a day.
+        """
+        raise NotImplementedError
+
+    #
+    # These are built on read_range(); backends can do better.
+    #
+
+    def iter_columns(self, stationname, fields, start_time, end_time):
+        """Yield (day, times, { field: values }) for each day from
+           start_time through end_time that has data, in order, like
+           resample.load_day_columns() on that day's file, so only
+           a day's worth of rows is in memory at a time.
+           Each day has at least its rows from start_time through
+           the first one after end_time, but may have more on either
+           side, so callers that care should clip.
+           Every field in fields is there, NaN if it's missing;
+           fields=None means every field.
+           This version does a read_range() for each day.
+        """
+        for day in self.days_with_data(stationname, start_time.date(),
+                                       end_time.date()):
+            times, columns = self.read_range(stationname, fields,
+                                             max(day_start(day), start_time),
+                                             day_start(day + ONEDAY))
+            if len(times):
+                yield day, times, columns
+
+    def iter_readings(self, stationname, fields, start_time, end_time):
+        """Yield a tuple (time, value, value, ...) for each report
+           with start_time <= time < end_time, in order,
+           with a value for each of fields (a list):
+           time is a datetime, values are floats or None if missing.
+        """
+        start = to_seconds(start_time)
+        end = to_seconds(end_time)
+        for day, times, columns in self.iter_columns(stationname, fields,
+                                                     start_time, end_time):
+            yield from resample.readings(times, columns, fields, start, end)
+
+    def resample(self, stationname, valtypes,
+                 start_time, end_time, time_incr):
+        """Resample valtypes to time_incr buckets:
+           see stations.read_csv_data_resample().
+        """
+        return resample.resample_days(self.iter_columns(stationname,
+                                                        valtypes,
+                                                        start_time,
+                                                        end_time),
+                                      valtypes,
+                                      start_time, end_time, time_incr)
+
+    def resample_grid(self, stationname, valtypes,
+                      start_time, end_time, time_incr):
+        """Resample valtypes onto a fixed grid of time_incr buckets
+           from start_time: see resample.resample_grid().
+        """
+        return resample.resample_grid(self.iter_columns(stationname,
+                                                        valtypes,
+                                                        start_time,
+                                                        end_time),
+                                      valtypes,
+                                      start_time, end_time, time_incr)
+
+    def day_summaries(self, stationname, days):
+        """Return { day: { field: [ count, sum, low, high, last ] } }
+           (see rollups.py) for a list of days, None if no data.
+        """
+        summaries = { day: None for day in days }
+        if not days:
+            return summaries
+        for day, times, columns in self.iter_columns(
+                stationname, None,
+                day_start(min(days)), day_end(max(days))):
+            if day not in summaries:
+                continue
+            for start, fields in rollups.summarize_columns(times, columns,
+                                                           'day'):
+                if from_seconds(start).date() == day:
+                    summaries[day] = fields
+        return summaries
+
+    def day_last_values(self, stationname, days):
+        """The values in the last report of each day, e.g. the day's
+           total for fields like rain_daily.
+           Return { day: { field: float } }, None for days with no data.
+        """
+        lastvals = { day: None for day in days }
+        if not days:
+            return lastvals
+        for day, times, columns in self.iter_columns(
+                stationname, None,
+                day_start(min(days)), day_end(max(days))):
+            if day in lastvals:
+                lastvals[day] = { f: float(columns[f][-1]) for f in columns
+                                  if not np.isnan(columns[f][-1]) }
+        return lastvals
+
+
+class CSVStorage(Storage):
+    """A CSV file per station per day: see the comments at the top."""
+
+    def __init__(self, savedir, fields):
+        super().__init__(savedir, fields)
+
+        # Appends the reports to the day files.
+        self.datawriter = daywriter.DayFileWriter()
+
+        # With binary_dayfiles = yes in [storage], also write binary
+        # day files (see binfiles.py) alongside the CSV files.
+        # The readers use them when they're there, since they're
+        # much faster to read.
+        self.binwriter = None
+        if serverconfig.getboolean("storage", "binary_dayfiles", False):
+            self.binwriter = daywriter.DayFileWriter(binary=True)
+
+        # The binary file each station is writing, and its fields:
+        # { stationname: (path, [ fields ]) }
+        self.binfile_fields = {}
+
+        # Compress each station's CSV day files with gzip
+        # (see datafiles.py) once the station has gone on to the next day:
+        # the day that just ended when the first report of a new day
+        # comes in, and any others (e.g. from before the server started)
+        # in the background (see compress_closed()).
+        self.compress_closed_days = serverconfig.getboolean(
+            "storage", "compress_closed_days", True)
+
+        # The day of each station's last report in this process:
+        # { stationname: date }
+        self.lastday = {}
+
+        # Which days have files, so readers don't have to try
+        # every day in a range (see coverage.py),
+        self.coverage = coverage.Coverage(savedir)
+        # and which have rollups, which are all that's left of a day
+        # once its raw file has expired (see retention.py).
+        self.rollup_coverage = coverage.Coverage(
+            rollups.rollup_dir(savedir), rollups.parse_rollup_filename)
+
+    def path(self, stationname, day):
+        return datafiles.day_path(self.savedir, stationname, day)
+
+    def append(self, stationname, station_data):
+        datafilename = self.path(stationname, station_data['time'])
+
+        fields = self.fields()
+        csvfields = []
+        for field in fields:
+            if field not in station_data:
+                continue
+            if field == 'time':
+                csvfields.append(station_data[field].strftime("%Y-%m-%d %H:%M:%S"))
+            elif field in station_data:
+                csvfields.append(str(station_data[field]))
+            else:
+                csvfields.append('')
+
+        # The writer keeps the file open and buffers a few lines;
+        # it writes the header if the file is new.
+        self.datawriter.append(stationname, datafilename,
+                               ','.join(fields), ','.join(csvfields))
+        if self.binwriter:
+            self.write_binary(stationname, datafilename, station_data)
+
+        # To write in JSONL instead:
+        # with open(datafilename, "a") as datafp:
+        #     datafp.write(json.dumps(station_data, default=json_serial))
+        #     datafp.write('\n')
+
+        # Keep the minute/hour/day rollups up to date too.
+        # If they're going to be rebuilt from the raw file,
+        # the file needs to be up to date first.
+        self.coverage.add_report(stationname, station_data['time'])
+
+        day = station_data['time'].date()
+        if not rollups.is_open(stationname, day):
+            self.flush(stationname)
+        rollups.add_report(self.savedir, stationname, station_data,
+                           datafilename)
+
+        # First report of a new day? Then the last day's file
+        # is finished. It's only the one file: anything older
+        # is left for compress_closed(), so the first report after
+        # the server starts doesn't wait for a station's whole history.
+        lastday = self.lastday.get(stationname)
+        if lastday != day:
+            self.lastday[stationname] = day
+            if self.compress_closed_days and lastday and lastday < day:
+                lastpath = self.path(stationname, lastday)
+                if os.path.exists(lastpath):
+                    datafiles.compress_day_file(lastpath)
+
+    def compress_closed(self, rest=None):
+        """Compress the CSV day files for days before today, other than
+           any that are still open for writing (a station that hasn't
+           reported since midnight), a file at a time; after each,
+           call rest(time.monotonic() when it started), and stop if
+           that returns False (see compaction.RollingCompactor.rest()).
+           Return how many files were compressed.
+        """
+        today = date.today()
+        ncompressed = 0
+        for filename in sorted(os.listdir(self.savedir)):
+            if not filename.endswith(".csv"):
+                continue
+            parsed = datafiles.parse_day_filename(filename)
+            if not parsed or parsed[1] >= today:
+                continue
+
+            started = time.monotonic()
+            path = os.path.join(self.savedir, filename)
+            # So a report can't open the file while it's being compressed.
+            with self.datawriter.lock:
+                if self.datawriter.is_open(path) \
+                   or not os.path.exists(path):
+                    continue
+                datafiles.compress_day_file(path)
+            ncompressed += 1
+            if rest and not rest(started):
+                break
+        return ncompressed
+
+    def write_binary(self, stationname, csvpath, station_data):
+        """Add a report to the station's binary day file.
+           Call this after giving the report to datawriter.
+        """
+        binpath = binfiles.binfile_path(csvpath)
+        # The binary file always has the configured fields, in order,
+        # whatever this report (or the first one of the day) has.
+        fields = [ f for f in self.fields() if f != 'time' ]
+        if self.binfile_fields.get(stationname) != (binpath, fields):
+            # First report to this file from this process,
+            # or the field order has changed.
+            filefields = None
+            if binfiles.current_binfile(csvpath):
+                try:
+                    filefields = binfiles.read_header(binpath)[0]
+                except (OSError, ValueError):
+                    pass
+
+            if filefields != fields:
+                # No usable binary file: it's a new day, binary files
+                # were just turned on, the fields have changed, or
+                # the CSV file came from elsewhere. Make one from
+                # the CSV file, which includes this report.
+                self.datawriter.flush(stationname)
+                self.binwriter.close(stationname)
+                try:
+                    binfiles.convert(csvpath, fields)
+                except (OSError, ValueError) as e:
+                    print("Couldn't write %s: %s" % (binpath, e),
+                          file=sys.stderr)
+                    return
+                self.binfile_fields[stationname] = (binpath, fields)
+                return
+
+            self.binfile_fields[stationname] = (binpath, fields)
+
+        self.binwriter.append(stationname, binpath,
+                              binfiles.make_header(fields),
+                              binfiles.make_record(fields, station_data))
+
+    def flush(self, stationname=None):
+        self.datawriter.flush(stationname)
+        if self.binwriter:
+            self.binwriter.flush(stationname)
+
+    def close(self):
+        self.datawriter.close()
+        if self.binwriter:
+            self.binwriter.close()
+
+    def read_range(self, stationname, fields, start_time, end_time):
+        start = to_seconds(start_time)
+        end = to_seconds(end_time)
+
+        chunks = []
+        for day, times, columns in self.iter_columns(stationname, fields,
+                                                     start_time, end_time):
+            if day_start(day) >= end_time:
+                break
+            keep = (times >= start) & (times < end)
+            chunks.append((times[keep],
+                           { f: columns[f][keep] for f in columns }))
+
+        if fields is None:
+            # Every field in any of the files
+            fields = []
+            for times, columns in chunks:
+                fields += [ f for f in columns if f not in fields ]
+        if not chunks:
+            return np.zeros(0), { f: np.zeros(0) for f in fields }
+
+        columns = {}
+        for f in fields:
+            columns[f] = np.concatenate([ c[1][f] if f in c[1]
+                                          else np.full(len(c[0]), np.nan)
+                                          for c in chunks ])
+        return np.concatenate([ c[0] for c in chunks ]), columns
+
+    def iter_columns(self, stationname, fields, start_time, end_time):
+        self.flush(stationname)
+        start = to_seconds(start_time)
+        end = to_seconds(end_time)
+        for day in self.coverage.days_between(stationname, start_time.date(),
+                                              end_time.date()):
+            try:
+                times, columns = resample.load_day_columns(
+                    self.path(stationname, day), fields, start, end)
+            except FileNotFoundError:
+                continue
+            if len(times):
+                yield day, times, columns
+
+    def rollups_only(self, stationname, day):
+        """Is a day's raw file gone, leaving only its rollups?"""
+        return not self.coverage.has_day(stationname, day) \
+            and self.rollup_coverage.has_day(stationname, day)
+
+    def _rollup_buckets(self, stationname, day, level):
+        return rollups.day_buckets(self.savedir, stationname, day, level,
+                                   self.path(stationname, day))
+
+    def _plan(self, stationname, start_time, end_time, time_incr):
+        """Where to read each day of a range from: return
+           (rollup level, or None for raw data, [ (source, days) ])
+           as from planner.plan().
+        """
+        # Days in compacted years come from the summary files,
+        # and days whose raw files have expired from their rollups
+        # (see planner.py).
+        summarized = planner.summary_days(self.savedir, stationname,
+                                          start_time.date(), end_time.date())
+        days = sorted(summarized.union(
+            self.coverage.days_between(stationname, start_time.date(),
+                                       end_time.date()),
+            self.rollup_coverage.days_between(stationname, start_time.date(),
+                                              end_time.date())))
+
+        # Buckets of an hour or longer can come from the rollups.
+        level = rollups.level_for(start_time, time_incr)
+        runs = planner.plan(days,
+                            lambda day: self.coverage.has_day(stationname,
+                                                              day),
+                            summarized,
+                            level or ('day' if time_incr >= ONEDAY
+                                      else 'hour'),
+                            lambda day: self.rollups_only(stationname, day))
+        return level, runs
+
+    def _run_buckets(self, stationname, source, rundays, level):
+        """Rollup-style buckets for a run of days that planner.plan()
+           said to read from source, at a rollup level.
+        """
+        for day in rundays:
+            if source in ('raw', 'rollups'):
+                yield from self._rollup_buckets(stationname, day, level)
+            else:
+                yield from planner.day_buckets(self.savedir, stationname,
+                                               day, source)
+
+    def resample(self, stationname, valtypes,
+                 start_time, end_time, time_incr):
+        self.flush(stationname)
+        level, runs = self._plan(stationname, start_time, end_time,
+                                 time_incr)
+
+        if level:
+            return rollups.resample_buckets(
+                (b for source, rundays in runs
+                 for b in self._run_buckets(stationname, source,
+                                            rundays, level)),
+                valtypes, start_time, end_time, time_incr)
+
+        parts = []
+        for i, (source, rundays) in enumerate(runs):
+            if source != 'raw':
+                parts.append(rollups.resample_buckets(
+                    self._run_buckets(stationname, source, rundays,
+                                      'minute'),
+                    valtypes, start_time, end_time, time_incr))
+                continue
+            parts.append(super().resample(
+                stationname, valtypes,
+                day_start(rundays[0]) if i else start_time,
+                day_start(rundays[-1] + ONEDAY) if i < len(runs) - 1
+                    else end_time,
+                time_incr))
+        if len(parts) == 1:
+            return parts[0]
+        return planner.stitch(parts, valtypes)
+
+    def resample_grid(self, stationname, valtypes,
+                      start_time, end_time, time_incr):
+        # Like resample(), but each part is put on the grid,
+        # so days that have been compacted or expired are there too.
+        self.flush(stationname)
+        level, runs = self._plan(stationname, start_time, end_time,
+                                 time_incr)
+
+        if level:
+            return rollups.resample_buckets(
+                (b for source, rundays in runs
+                 for b in self._run_buckets(stationname, source,
+                                            rundays, level)),
+                valtypes, start_time, end_time, time_incr, grid=True)
+
+        parts = []
+        for source, rundays in runs:
+            if source != 'raw':
+                parts.append(rollups.resample_buckets(
+                    self._run_buckets(stationname, source, rundays,
+                                      'minute'),
+                    valtypes, start_time, end_time, time_incr, grid=True))
+                continue
+            parts.append(resample.resample_grid(
+                self.iter_columns(stationname, valtypes,
+                                  max(day_start(rundays[0]), start_time),
+                                  min(day_end(rundays[-1]), end_time)),
+                valtypes, start_time, end_time, time_incr))
+        if not parts:
+            return resample.resample_grid([], valtypes, start_time,
+                                          end_time, time_incr)
+        if len(parts) == 1:
+            return parts[0]
+        return planner.overlay(parts, valtypes)
+
+    def day_summaries(self, stationname, days):
+        self.flush(stationname)
+        summaries = { day: None for day in days }
+        summaries.update(daycache.day_summaries(
+            self.savedir, stationname,
+            [ d for d in days if self.coverage.has_day(stationname, d) ],
+            lambda d: self.path(stationname, d)))
+
+        # Expired and compacted days
+        for day in days:
+            if summaries[day] is None:
+                buckets = self._expired_day_buckets(stationname, day)
+                if buckets:
+                    summaries[day] = buckets[0][1]
+        return summaries
+
+    def _expired_day_buckets(self, stationname, day):
+        """The day bucket for a day with no raw file,
+           from its rollups or the summaries.
+        """
+        if self.rollups_only(stationname, day):
+            buckets = self._rollup_buckets(stationname, day, 'day')
+            if buckets:
+                return buckets
+        return planner.day_buckets(self.savedir, stationname, day, 'day')
+
+    def day_last_values(self, stationname, days):
+        self.flush(stationname)
+        lastvals = { day: None for day in days }
+        lastvals.update(daycache.day_last_values(
+            self.savedir, stationname,
+            [ d for d in days if self.coverage.has_day(stationname, d) ],
+            lambda d: self.path(stationname, d)))
+
+        # Expired and compacted days
+        for day in days:
+            if lastvals[day] is None:
+                buckets = self._expired_day_buckets(stationname, day)
+                if buckets:
+                    lastvals[day] = { f: buckets[0][1][f][rollups.LAST]
+                                      for f in buckets[0][1] }
+        return lastvals
+
+    def days_with_data(self, stationname, start_date, end_date):
+        # Including days that have been compacted or expired
+        return sorted(set(self.coverage.days_between(stationname, start_date,
+                                                     end_date))
+                      | set(self.rollup_coverage.days_between(
+                          stationname, start_date, end_date))
+                      | planner.summary_days(self.savedir, stationname,
+                                             start_date, end_date))
+
+    def extent(self, stationname):
+        return self.coverage.extent(stationname)
+
+    def newest_day(self, stationname):
+        """The date of the station's newest day file, or None."""
+        return self.coverage.last_day(stationname)
+
+    def latest(self, stationname):
+        day = self.newest_day(stationname)
+        if not day:
+            return None
+        self.flush(stationname)
+        try:
+            header, row = datafiles.read_last_row(self.path(stationname, day))
+        except FileNotFoundError:
+            return None
+        if not row:
+            return None
+
+        report = {}
+        for field in row:
+            if field == 'time':
+                try:
+                    report[field] = parse_time(row[field])
+                except ValueError:
+                    return None
+            elif row[field] is not None:
+                report[field] = report_value(row[field])
+        return report
+
+    def list_stations(self):
+        # This is the startup scan, so look at what's there now.
+        self.coverage.rescan()
+        return { st: day_start(day)
+                 for st, day in self.coverage.stations().items() }
+
+    def updated_since(self, stationname, since):
+        # Any file written after since must be for the day of since
+        # or later, so those are the only ones to check.
+        # This checks the disk rather than the coverage, since it's
+        # for finding files written while the server wasn't running.
+        # Any it finds go into the coverage, for latest().
+        day = datetime.fromtimestamp(since).date()
+        today = date.today()
+        updated = False
+        while day <= today:
+            try:
+                if datafiles.stat_day_file(
+                        self.path(stationname, day)).st_mtime > since:
+                    self.coverage.add_day(stationname, day)
+                    updated = True
+            except FileNotFoundError:
+                pass
+            day += ONEDAY
+        return updated
+
+
+class SQLiteStorage(Storage):
+    """All the reports in one SQLite database, savedir/watchweather.db.
+       Reports are inserted in batches, using the same [writer]
+       settings as the CSV files.
+    """
+
+    DBFILE = "watchweather.db"
+
+    # How soon to try again after a failed flush, if it's not
+    # going to be flushed on a timer anyway.
+    RETRY_SECONDS = 5
+
+    def __init__(self, savedir, fields):
+        super().__init__(savedir, fields)
+        self.dbfile = os.path.join(savedir, self.DBFILE)
+
+        self.flush_lines = serverconfig.getint("writer", "flush_lines", 16)
+        self.flush_seconds = serverconfig.getfloat("writer",
+                                                   "flush_seconds", 30.)
+
+        # One connection, shared by all the server's threads.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.dbfile, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL can only lose the last few transactions
+        # in a power failure, and never corrupts the database.
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS readings "
+                              "(station TEXT NOT NULL, time REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS "
+                              "readings_station_time "
+                              "ON readings (station, time)")
+        self._reread_columns()
+
+        # Reports not yet inserted: [ (stationname, secs, { field: val }) ]
+        self.pending = []
+        self.timer = None
+
+    @staticmethod
+    def quote(field):
+        """Quote a field name to use as an SQL column name."""
+        if not re.match(r'^\w+$', field):
+            raise ValueError("Bad field name '%s'" % field)
+        return '"%s"' % field
+
+    def _pending_row(self, stationname, station_data):
+        vals = {}
+        for field in self.fields():
+            if field == 'time' or field not in station_data:
+                continue
+            # A field that can't be a column is left out here,
+            # rather than failing the whole batch when it's inserted.
+            if not re.match(r'^\w+$', field):
+                print("Not saving field '%s' from %s: bad column name"
+                      % (field, stationname), file=sys.stderr)
+                continue
+            vals[field] = station_data[field]
+        return (stationname, to_seconds(station_data['time']), vals)
+
+    def append_many(self, reports):
+        # All in one transaction, along with anything already waiting.
+        with self.lock:
+            self.pending.extend(self._pending_row(*report)
+                                for report in reports)
+            self.flush()
+
+    def append(self, stationname, station_data):
+        with self.lock:
+            self.pending.append(self._pending_row(stationname, station_data))
+            if len(self.pending) >= self.flush_lines:
+                self.flush()
+            elif not self.timer and self.flush_seconds > 0:
+                self.timer = threading.Timer(self.flush_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self, stationname=None):
+        # Batches cover all the stations, so stationname doesn't matter.
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = []
+
+            try:
+                with self.conn:
+                    for stationname, secs, vals in pending:
+                        for field in vals:
+                            if field not in self.columns:
+                                self.conn.execute(
+                                    "ALTER TABLE readings ADD COLUMN %s"
+                                    % self.quote(field))
+                                self.columns.append(field)
+
+                    # One executemany for each set of fields
+                    batches = {}
+                    for stationname, secs, vals in pending:
+                        batches.setdefault(tuple(vals), []).append(
+                            (stationname, secs) + tuple(vals.values()))
+                    for fields, rows in batches.items():
+                        cols = ', '.join([ "station", "time" ]
+                                         + [ self.quote(f) for f in fields ])
+                        self.conn.executemany(
+                            "INSERT INTO readings (%s) VALUES (%s)"
+                            % (cols, ', '.join('?' * (len(fields) + 2))),
+                            rows)
+            except sqlite3.OperationalError as e:
+                # E.g. the database is locked, or the disk is full:
+                # keep them, to try again.
+                print("Couldn't save %d reports to %s, will try again: %s"
+                      % (len(pending), self.dbfile, e), file=sys.stderr)
+                self.pending = pending + self.pending
+                if not self.timer:
+                    self.timer = threading.Timer(
+                        self.flush_seconds if self.flush_seconds > 0
+                        else self.RETRY_SECONDS, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            except (sqlite3.Error, ValueError) as e:
+                print("Couldn't save %d reports to %s: %s"
+                      % (len(pending), self.dbfile, e), file=sys.stderr)
+            else:
+                return
+
+            # In case columns were added in the transaction that failed.
+            try:
+                self._reread_columns()
+            except sqlite3.Error:
+                pass
+
+    def _reread_columns(self):
+        self.columns = [ row[1] for row
+                         in self.conn.execute("PRAGMA table_info(readings)") ]
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+    def read_range(self, stationname, fields, start_time, end_time):
+        with self.lock:
+            self.flush()
+            if fields is None:
+                fields = [ c for c in self.columns
+                           if c not in ("station", "time") ]
+            present = [ f for f in fields if f in self.columns ]
+            cols = ', '.join([ "time" ] + [ self.quote(f) for f in present ])
+            rows = self.conn.execute(
+                "SELECT %s FROM readings WHERE station = ? "
+                "AND time >= ? AND time < ? ORDER BY time" % cols,
+                (stationname, to_seconds(start_time),
+                 to_seconds(end_time))).fetchall()
+
+        times = np.array([ row[0] for row in rows ], dtype=np.float64)
+        columns = {}
+        for field in fields:
+            if field not in present:
+                columns[field] = np.full(len(rows), np.nan)
+                continue
+            i = present.index(field) + 1
+            columns[field] = resample.column_to_floats(
+                [ '' if row[i] is None else row[i] for row in rows ])
+        return times, columns
+
+    def iter_columns(self, stationname, fields, start_time, end_time):
+        # One indexed scan of the whole range, split into days here,
+        # rather than a query for each day. That does mean the whole
+        # range is in memory at once, not just a day of it.
+        times, columns = self.read_range(
+            stationname, fields, start_time,
+            day_start(end_time.date() + ONEDAY))
+        if not len(times):
+            return
+
+        # Times are naive seconds since EPOCH, so days are 86400 each.
+        daynums = np.floor(times / 86400).astype(np.int64)
+        starts = np.concatenate(([ 0 ],
+                                 np.flatnonzero(np.diff(daynums)) + 1))
+        ends = np.append(starts[1:], len(times))
+        for first, last in zip(starts.tolist(), ends.tolist()):
+            yield (from_seconds(daynums[first] * 86400).date(),
+                   times[first:last],
+                   { f: columns[f][first:last] for f in columns })
+
+    def _report(self, cursor, row):
+        names = [ d[0] for d in cursor.description ]
+        report = {}
+        for name, val in zip(names, row):
+            if name == 'station' or val is None:
+                continue
+            if name == 'time':
+                report['time'] = from_seconds(val)
+            else:
+                report[name] = report_value(val)
+        return report
+
+    def latest(self, stationname):
+        with self.lock:
+            self.flush()
+            cursor = self.conn.execute(
+                "SELECT * FROM readings WHERE station = ? "
+                "ORDER BY time DESC LIMIT 1", (stationname,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return self._report(cursor, row)
+
+    def list_stations(self):
+        with self.lock:
+            self.flush()
+            return { st: from_seconds(t) for st, t in self.conn.execute(
+                "SELECT station, MAX(time) FROM readings GROUP BY station") }
+
+    def days_with_data(self, stationname, start_date, end_date):
+        with self.lock:
+            self.flush()
+            return [ from_seconds(d * 86400).date()
+                     for d, in self.conn.execute(
+                         "SELECT DISTINCT CAST(time / 86400 AS INTEGER) "
+                         "FROM readings WHERE station = ? "
+                         "AND time >= ? AND time < ? ORDER BY 1",
+                         (stationname, to_seconds(day_start(start_date)),
+                          to_seconds(day_start(end_date + ONEDAY)))) ]
+
+    def extent(self, stationname):
+        with self.lock:
+            self.flush()
+            first, last = self.conn.execute(
+                "SELECT MIN(time), MAX(time) FROM readings "
+                "WHERE station = ?", (stationname,)).fetchone()
+        if first is None:
+            return None
+        return from_seconds(first), from_seconds(last)
+
+    def day_last_values(self, stationname, days):
+        # The last row of each day, in one grouped query: with MAX(),
+        # SQLite takes the other columns from the row with the maximum.
+        lastvals = { day: None for day in days }
+        if not days:
+            return lastvals
+        with self.lock:
+            self.flush()
+            cols = ', '.join(self.quote(c) for c in self.columns)
+            cursor = self.conn.execute(
+                "SELECT %s, MAX(time) FROM readings WHERE station = ? "
+                "AND time >= ? AND time < ? "
+                "GROUP BY CAST(time / 86400 AS INTEGER)" % cols,
+                (stationname, to_seconds(day_start(min(days))),
+                 to_seconds(day_start(max(days) + ONEDAY))))
+            rows = cursor.fetchall()
+            names = [ d[0] for d in cursor.description ][:-1]
+        for row in rows:
+            report = {}
+            for name, val in zip(names, row):
+                if name not in ('station', 'time') and val is not None:
+                    report[name] = report_value(val)
+            day = from_seconds(row[names.index('time')]).date()
+            if day in lastvals:
+                lastvals[day] = { f: report[f] for f in report
+                                  if isinstance(report[f], float) }
+        return lastvals
+
+    def import_day_files(self, savedir):
+        """Copy every CSV day file in savedir into the database.
+           Run this once, when switching from CSV storage.
+        """
+        for filename in sorted(os.listdir(savedir)):
+            parsed = datafiles.parse_day_filename(filename)
+            if not parsed:
+                continue
+            stationname, day = parsed
+            print("Importing", filename, file=sys.stderr)
+            times, columns = resample.load_day_columns(
+                datafiles.day_path(savedir, stationname, day))
+            with self.lock:
+                self.flush()
+                for f in columns:
+                    if f not in self.columns:
+                        self.conn.execute(
+                            "ALTER TABLE readings ADD COLUMN %s"
+                            % self.quote(f))
+                        self.columns.append(f)
+                fields = list(columns)
+                cols = ', '.join([ "station", "time" ]
+                                 + [ self.quote(f) for f in fields ])
+                rows = []
+                for i, t in enumerate(times):
+                    rows.append((stationname, float(t))
+                                + tuple(None if np.isnan(columns[f][i])
+                                        else float(columns[f][i])
+                                        for f in fields))
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT INTO readings (%s) VALUES (%s)"
+                        % (cols, ', '.join('?' * (len(fields) + 2))), rows)
+
+
+BACKENDS = { "csv": CSVStorage, "sqlite": SQLiteStorage }
+
+
+def open_storage(savedir, fields):
+    """The storage backend chosen in the config file, for savedir."""
+    backend = serverconfig.get("storage", "backend", "csv").lower()
+    if backend not in BACKENDS:
+        print("Unknown storage backend '%s', using csv" % backend,
+              file=sys.stderr)
+        backend = "csv"
+    return BACKENDS[backend](savedir, fields)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("Usage: %s import [savedir]" % os.path.basename(sys.argv[0]),
+              file=sys.stderr)
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        savedir = sys.argv[2]
+    else:
+        savedir = os.path.expanduser("~/.cache/watchserver")
+    db = SQLiteStorage(savedir, lambda: [])
+    db.import_day_files(savedir)
+    db.close()
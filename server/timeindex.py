@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# Time indexes for the CSV day files, so reading a short time range
+# (e.g. an hour for a zoomed-in plot) can seek straight to it
+# instead of parsing the whole day from the top.
+#
+# Stationname-YYYY-MM-DD.idx sits next to Stationname-YYYY-MM-DD.csv
+# and holds JSON:
+#     { "version": 1, "size": bytes of the CSV indexed so far,
+#       "mtime": the CSV's modification time then,
+#       "last": time of the last row indexed, "sorted": true,
+#       "slots": [ [ slot start, byte offset ], ... ] }
+# where each slot is SLOT_SECONDS long, and its offset is that of the
+# first row in the slot. Slots with no rows aren't listed.
+#
+# The index is kept up to date as rows are appended: the day file
+# writer (daywriter.py) calls update() after each write, which indexes
+# only the new rows and saves the .idx. Reading never writes an index:
+# a file with no .idx (e.g. one copied in from elsewhere), or one
+# that's grown since its .idx was saved, is indexed in memory only.
+# If the file was replaced rather than appended to (it shrank,
+# or the last indexed line doesn't end where it did), it's reindexed.
+# Files whose times aren't in order get "sorted": false,
+# and are always read in full.
+# Compressed day files aren't indexed, and are always read in full.
+
+import os, sys
+import json
+import threading
+
+import numpy as np
+
+from timeparse import parse_times_epoch
+
+
+INDEX_VERSION = 1
+
+# How far apart the index entries are.
+SLOT_SECONDS = 300
+
+EXT = ".idx"
+
+# Indexes in memory: { csvpath: index }
+_cache = {}
+MAX_CACHED = 256
+
+# Files whose index in memory is ahead of their .idx
+_unsaved = set()
+
+_lock = threading.Lock()
+
+
+def index_path(csvpath):
+    return os.path.splitext(csvpath)[0] + EXT
+
+
+def _load(csvpath):
+    try:
+        with open(index_path(csvpath)) as fp:
+            index = json.load(fp)
+        if index.get("version") == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _save(csvpath, index):
+    path = index_path(csvpath)
+    tmppath = path + ".tmp"
+    try:
+        with open(tmppath, "w") as fp:
+            json.dump(index, fp)
+        os.replace(tmppath, path)
+    except OSError as e:
+        print("Couldn't save time index %s: %s" % (path, e), file=sys.stderr)
+
+
+def _extend(index, fp, size):
+    """Index the rows from index["size"] to the last complete line
+       before size.
+    """
+    fp.seek(index["size"])
+    data = fp.read(size - index["size"])
+    end = data.rfind(b'\n') + 1
+    if not end:
+        return
+    data = data[:end]
+
+    lines = data.split(b'\n')[:-1]
+    offsets = np.cumsum([ 0 ] + [ len(l) + 1 for l in lines[:-1] ]) \
+        + index["size"]
+    if index["size"] == 0:
+        # The header
+        lines = lines[1:]
+        offsets = offsets[1:]
+    index["size"] += end
+
+    times = parse_times_epoch([ l.split(b',', 1)[0] for l in lines ])
+    good = ~np.isnan(times)
+    times = times[good]
+    offsets = offsets[good]
+    if not len(times):
+        return
+
+    if times[0] < index["last"] or np.any(times[1:] < times[:-1]):
+        index["sorted"] = False
+        index["slots"] = []
+        return
+    index["last"] = float(times[-1])
+
+    slots = times // SLOT_SECONDS * SLOT_SECONDS
+    newslot = np.r_[True, slots[1:] != slots[:-1]]
+    lastslot = index["slots"][-1][0] if index["slots"] else None
+    for slot, offset in zip(slots[newslot], offsets[newslot]):
+        if slot != lastslot:
+            index["slots"].append([ float(slot), int(offset) ])
+
+
+def _still_valid(index, fp, st):
+    """Is index for this version of the file, or an earlier one
+       that it's been appended to since?
+    """
+    if index["size"] > st.st_size:
+        return False
+    if index["size"] == st.st_size:
+        return index["mtime"] == st.st_mtime
+    if index["size"]:
+        fp.seek(index["size"] - 1)
+        return fp.read(1) == b'\n'
+    return True
+
+
+def _index(csvpath, fp, save=False):
+    """The up-to-date index for an open CSV file, or None if it's
+       no use for this file. With save, write it to the .idx
+       if it changed.
+    """
+    st = os.fstat(fp.fileno())
+
+    with _lock:
+        index = _cache.get(csvpath)
+        if not index:
+            index = _load(csvpath)
+        if index and not _still_valid(index, fp, st):
+            index = None
+        if not index:
+            index = { "version": INDEX_VERSION, "size": 0, "mtime": 0,
+                      "last": float("-inf"), "sorted": True, "slots": [] }
+
+        if index["size"] < st.st_size and index["sorted"]:
+            _extend(index, fp, st.st_size)
+            index["mtime"] = st.st_mtime
+            _unsaved.add(csvpath)
+        if save and csvpath in _unsaved:
+            _save(csvpath, index)
+            _unsaved.discard(csvpath)
+
+        if len(_cache) >= MAX_CACHED:
+            _cache.clear()
+            _unsaved.clear()
+        _cache[csvpath] = index
+
+    if not index["sorted"] or not index["slots"]:
+        return None
+    return index
+
+
+def read_lines(csvpath, start=None, end=None):
+    """Read the header line plus the rows of a CSV day file that are
+       needed for start <= t <= end (seconds since timeparse.EPOCH;
+       either may be None): that's at least every row in that range
+       and the first row after end, and maybe a few rows either side.
+       Return a list of lines (str, without newlines),
+       or None if the file can't be read this way,
+       e.g. because it's compressed or doesn't exist.
+    """
+    try:
+        fp = open(csvpath, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with fp:
+        index = _index(csvpath, fp)
+        if not index:
+            return None
+
+        fp.seek(0)
+        header = fp.readline()
+        slots = index["slots"]
+        starts = [ s[0] for s in slots ]
+
+        # The last slot starting at or before start
+        if start is None:
+            startoff = len(header)
+        else:
+            i = np.searchsorted(starts, start, side='right') - 1
+            startoff = slots[i][1] if i >= 0 else len(header)
+
+        # The first slot that starts after end; then one more line,
+        # in case the first row after end is past that.
+        fp.seek(startoff)
+        if end is None:
+            data = fp.read(index["size"] - startoff)
+        else:
+            i = np.searchsorted(starts, end, side='right')
+            stopoff = slots[i][1] if i < len(slots) else index["size"]
+            data = fp.read(stopoff - startoff)
+            if stopoff < index["size"]:
+                data += fp.readline()
+
+    return [ header.decode().rstrip('\r\n') ] \
+        + data.decode().splitlines()
+
+
+def update(csvpath):
+    """Index any rows appended to a CSV day file since it was last
+       indexed, and save the index. Called after writing to the file.
+    """
+    try:
+        fp = open(csvpath, 'rb')
+    except FileNotFoundError:
+        return
+    with fp:
+        _index(csvpath, fp, save=True)
+
+
+def forget(csvpath):
+    """Remove a CSV file's index, e.g. when the file is compressed."""
+    with _lock:
+        _cache.pop(csvpath, None)
+        _unsaved.discard(csvpath)
+    try:
+        os.unlink(index_path(csvpath))
+    except FileNotFoundError:
+        pass
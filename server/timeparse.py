@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Fast parsing of the timestamps in the watchweather CSV files.
+#
+# Times are always written as "YYYY-MM-DD HH:MM:SS", though some
+# historic files have decimal seconds ("YYYY-MM-DD HH:MM:SS.ffffff").
+# Since the layout is fixed, the fields can be sliced out directly,
+# which is much faster than datetime.strptime.
+# Anything that doesn't fit the fixed layout falls back to strptime.
+
+from datetime import datetime, date, timedelta
+
+import numpy as np
+
+
+# Naive times (the CSV files are in local time) are converted
+# to seconds since this, with no timezone conversion.
+EPOCH = datetime(1970, 1, 1)
+
+# Formats accepted, in the order they're tried for the strptime fallback.
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M')
+
+
+def to_seconds(dt):
+    """Convert a naive datetime to float seconds since EPOCH."""
+    return (dt - EPOCH).total_seconds()
+
+
+def from_seconds(secs):
+    """Convert float seconds since EPOCH back to a naive datetime."""
+    return EPOCH + timedelta(seconds=float(secs))
+
+
+def parse_date(s):
+    """Parse "YYYY-MM-DD" into a date. Raises ValueError if it can't."""
+    if len(s) == 10 and s[4] == '-' and s[7] == '-' \
+       and (s[:4] + s[5:7] + s[8:10]).isdigit():
+        return date(int(s[:4]), int(s[5:7]), int(s[8:10]))
+    return datetime.strptime(s, '%Y-%m-%d').date()
+
+
+def parse_time(s):
+    """Parse "YYYY-MM-DD HH:MM:SS", "YYYY-MM-DD HH:MM:SS.ffffff"
+       or "YYYY-MM-DD HH:MM" into a datetime.
+       Raises ValueError if it can't.
+    """
+    n = len(s)
+    # int() would take " 1" or "+3", which strptime won't,
+    # so the fast path is only for fields that are all digits.
+    if n >= 16 and s[4] == '-' and s[7] == '-' and s[10] == ' ' \
+       and s[13] == ':' \
+       and (s[:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16]
+            + s[17:19] + s[20:]).isdigit():
+        try:
+            if n == 19 and s[16] == ':':
+                return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]),
+                                int(s[11:13]), int(s[14:16]), int(s[17:19]))
+            if n == 16:
+                return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]),
+                                int(s[11:13]), int(s[14:16]))
+            if 21 <= n <= 26 and s[16] == ':' and s[19] == '.':
+                frac = s[20:]
+                return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]),
+                                int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                                int(frac) * 10 ** (6 - len(frac)))
+        except ValueError:
+            pass
+
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Can't parse time '%s'" % s)
+
+
+# Byte positions in "YYYY-MM-DD HH:MM:SS.ffffff"
+_DIGITS = (0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18)
+_SEPARATORS = ((4, b'-'), (7, b'-'), (10, b' '), (13, b':'), (16, b':'))
+_WIDTH = 26
+
+# Days in each month (index 1-12) of a non-leap year
+_MONTH_DAYS = np.array([ 0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31 ])
+
+
+def parse_times_epoch(strings):
+    """Parse a whole column of time strings at once.
+       Return a float64 numpy array of seconds since EPOCH,
+       with NaN for empty or unparseable entries.
+    """
+    nstrings = len(strings)
+    if not nstrings:
+        return np.zeros(0)
+
+    # Wide enough for the longest string, so nothing gets cut off:
+    # anything longer than the fixed layout goes to the slow path.
+    try:
+        raw = np.array(strings, dtype='S')
+    except UnicodeEncodeError:
+        raw = None
+    if raw is None:
+        return np.array([ _parse_one_epoch(s) for s in strings ])
+    width = max(raw.dtype.itemsize, _WIDTH)
+    raw = raw.astype('S%d' % width)
+
+    b = raw.view(np.uint8).reshape(nstrings, width).astype(np.int64)
+    lengths = np.char.str_len(raw)
+
+    good = (lengths == 19) | ((lengths >= 21) & (lengths <= _WIDTH))
+    for pos, ch in _SEPARATORS:
+        good &= (b[:, pos] == ord(ch))
+    digits = b - ord('0')
+    for pos in _DIGITS:
+        good &= (digits[:, pos] >= 0) & (digits[:, pos] <= 9)
+
+    def num(first, last):
+        val = np.zeros(nstrings, dtype=np.int64)
+        for pos in range(first, last):
+            val = val * 10 + digits[:, pos]
+        return val
+
+    year = num(0, 4)
+    month = num(5, 7)
+    day = num(8, 10)
+    good &= (month >= 1) & (month <= 12) & (day >= 1)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    good &= day <= _MONTH_DAYS[np.clip(month, 0, 12)] \
+        + ((month == 2) & leap)
+    good &= (num(11, 13) <= 23) & (num(14, 16) <= 59) & (num(17, 19) <= 59)
+
+    # Days since 1970-01-01 from the civil calendar date,
+    # from Howard Hinnant's days_from_civil algorithm.
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+
+    secs = (days * 86400 + num(11, 13) * 3600 + num(14, 16) * 60
+            + num(17, 19)).astype(np.float64)
+
+    # Decimal seconds, if any
+    hasfrac = lengths > 19
+    if np.any(hasfrac & good):
+        good &= ~hasfrac | (b[:, 19] == ord('.'))
+        frac = np.zeros(nstrings)
+        scale = 0.1
+        for pos in range(20, _WIDTH):
+            isdigit = (pos < lengths) & (digits[:, pos] >= 0) \
+                & (digits[:, pos] <= 9)
+            good &= isdigit | (pos >= lengths)
+            frac += np.where(isdigit, digits[:, pos], 0) * scale
+            scale /= 10
+        secs += frac
+
+    secs[~good] = np.nan
+
+    # Anything that didn't fit the fixed layout gets a second chance
+    # through the slow path, unless it's just empty.
+    for i in np.flatnonzero(~good & (lengths > 0)):
+        secs[i] = _parse_one_epoch(strings[i])
+
+    return secs
+
+
+def _parse_one_epoch(s):
+    try:
+        return to_seconds(parse_time(s))
+    except (ValueError, TypeError):
+        return np.nan
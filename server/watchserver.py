@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 from time import mktime
-from math import ceil, floor
 
 import os, sys
+import json
+import hashlib
+import math
+import threading
+import time
+import queue
+import zlib
 
-from flask import Flask, request, url_for, render_template, redirect, flash
+import numpy as np
+
+from flask import Flask, request, url_for, render_template, redirect, flash, \
+    jsonify, session
 
 # The code to keep track of the reporting stations:
 import stations
+import pagecache
+import serverconfig
+from timeparse import parse_time
 
 
 # set the project root directory as the static folder, you can set others.
@@ -31,6 +43,153 @@ except KeyError:
 Set WATCHWEATHER_KEY in your env to a better one.""", file=sys.stderr)
 
 
+# Pages made from station data carry validators (an ETag and
+# Last-Modified) saying which version of the data they show,
+# so a browser reloading one can be told it hasn't changed
+# (304 Not Modified) without the page being made again.
+# See stations.data_version().
+# They're also kept in a cache (see pagecache.py), so other browsers
+# loading them don't need them made again either, until a report
+# comes in that they cover.
+
+# The PageCache, once get_page_cache() has made it, or False if
+# it's turned off.
+page_cache = None
+
+
+def get_page_cache():
+    global page_cache
+
+    if page_cache is None:
+        max_mb = serverconfig.getfloat("pagecache", "max_mb", 32)
+        if max_mb <= 0:
+            page_cache = False
+            return page_cache
+        page_cache = pagecache.PageCache(
+            int(max_mb * 1024 * 1024),
+            serverconfig.getint("pagecache", "ttl", 300))
+        stations.change_listeners.append(page_cache.invalidate)
+    return page_cache
+
+
+def last_modified(modified):
+    """The Last-Modified header for data last changed at modified,
+       a Unix time. HTTP dates are in whole seconds, so that's rounded
+       up if the second is over, otherwise down: and since the data
+       is newer than that, If-Modified-Since won't match it,
+       in case there's another change in the same second.
+    """
+    rounded = math.ceil(modified)
+    if rounded > time.time():
+        rounded = math.floor(modified)
+    return datetime.fromtimestamp(rounded, timezone.utc)
+
+
+def conditional(stationnames, render, *extra, as_of=None, days=None):
+    """Return render(), a page showing stationnames' data (None for
+       all stations), with its validators, or 304 if the browser
+       already has it.
+       extra is anything else the page depends on that isn't in
+       its URL, like times relative to now.
+       as_of is the datetime the page shows data up to, if it might be
+       later than the last change (e.g. a plot that ends now).
+       days is the (first, last) dates the page shows data for, if it
+       doesn't just show the latest: a page that ends before today
+       can be cached until it's pushed out by others.
+    """
+    cache = get_page_cache()
+    key = (request.full_path, extra)
+    cached = cache.get(key) if cache else None
+
+    if cached:
+        body, headers, etag, modified = cached
+    else:
+        names = list(stations.known_stations() if stationnames is None
+                     else stationnames)
+        etag = hashlib.sha1(repr((request.full_path,
+                                  stations.data_version(names),
+                                  extra)).encode()).hexdigest()
+        modified = stations.data_modified(names)
+        if as_of:
+            modified = max(modified, as_of.timestamp())
+
+    # If-None-Match wins if there's both. If-Modified-Since has to be
+    # no earlier than the exact time of the change, not just its second.
+    if request.if_none_match:
+        unchanged = request.if_none_match.contains(etag)
+    else:
+        unchanged = request.if_modified_since \
+            and modified <= request.if_modified_since.timestamp()
+
+    if unchanged:
+        response = app.response_class(status=304)
+    elif cached:
+        response = app.response_class(body, headers=headers)
+    else:
+        # A page showing a flashed message is only for this once.
+        cacheable = cache and '_flashes' not in session
+        response = app.make_response(render())
+        if cacheable and response.status_code == 200:
+            body = response.get_data()
+            cache.put(key, (body, list(response.headers), etag, modified),
+                      len(body), stationnames, days,
+                      historic=bool(days and days[1]
+                                    and days[1] < date.today()))
+    response.set_etag(etag)
+    response.last_modified = last_modified(modified)
+    # Make browsers check every time: that's cheap now.
+    response.cache_control.no_cache = True
+    return response
+
+
+# Static files are linked with a hash of their contents
+# (see static_url()), so browsers can keep them for a long time
+# and still get a new version as soon as there is one.
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# { filename: (mtime, hash) }
+_static_hashes = {}
+
+
+def static_hash(filename):
+    """A short hash of a static file's contents, or None if it's missing.
+    """
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cached = _static_hashes.get(filename)
+    if not cached or cached[0] != mtime:
+        with open(path, 'rb') as fp:
+            cached = (mtime, hashlib.sha1(fp.read()).hexdigest()[:12])
+        _static_hashes[filename] = cached
+    return cached[1]
+
+
+@app.template_global()
+def static_url(filename):
+    """URL for a static file, e.g. {{ static_url('basic.css') }}
+       in a template: /basic.css?v=HASH
+    """
+    return url_for('static', filename=filename, v=static_hash(filename))
+
+
+@app.after_request
+def cache_static(response):
+    """Let browsers keep static files linked by static_url()
+       as long as they like.
+    """
+    if request.endpoint == 'static' and response.status_code in (200, 304) \
+       and request.args.get('v') \
+       and request.args['v'] == static_hash(request.view_args['filename']):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
 @app.route('/')
 def home_page():
     stations.initialize()
@@ -39,7 +198,7 @@ def home_page():
 
     return render_template('index.html',
                            title="Watch Weather: Menu",
-                           stations=stations.stations)
+                           stations=stations.stations.snapshot())
 
 
 @app.route('/stations')
@@ -48,11 +207,115 @@ def show_stations():
     """
     stations.initialize()
 
-    return render_template('stations.html',
-                           title="Watchweather: Stations Reporting",
-                           refresh=60,
-                           showkeys=[ 'temperature', 'humidity', 'rain_daily' ],
-                           showstations=stations.stations)
+    return conditional(
+        None,
+        lambda: render_template('stations.html',
+                                title="Watchweather: Stations Reporting",
+                                live=True,
+                                refresh=60,
+                                lastevent=stations.live_feed.last_id,
+                                showkeys=[ 'temperature', 'humidity',
+                                           'rain_daily' ],
+                                showstations=stations.stations.snapshot()))
+
+
+# Under WSGI, each /events stream holds a server thread while
+# it's open (mod_wsgi has threads=5 in the example in README.md),
+# so only [events] max_streams can be open at once, by default half
+# the threads, leaving the rest for /report and everything else;
+# pages that can't get a stream fall back to reloading.
+# And each stream ends after a while,
+# so threads get a chance to be recycled: the browser reconnects
+# and carries on where it left off.
+EVENT_STREAM_SECONDS = 5 * 60
+
+# Send something this often even when nothing's happening,
+# so a stream whose browser has gone away gets noticed and closed.
+EVENT_KEEPALIVE_SECONDS = 15
+
+# A BoundedSemaphore, once there's been an /events request.
+event_streams = None
+_event_streams_lock = threading.Lock()
+
+
+def server_threads():
+    """How many threads the server has for requests: from mod_wsgi
+       if it's running under that, otherwise [server] threads (default 5).
+    """
+    try:
+        import mod_wsgi
+        return mod_wsgi.threads_per_process
+    except (ImportError, AttributeError):
+        return serverconfig.getint("server", "threads", 5)
+
+
+def max_event_streams():
+    """How many /events streams can be open at once:
+       [events] max_streams, by default half the server's threads,
+       and never so many that there's no thread left for reports.
+    """
+    threads = server_threads()
+    max_streams = serverconfig.getint("events", "max_streams", threads // 2)
+    if max_streams >= threads:
+        print("[events] max_streams = %d would leave no threads for reports;"
+              " using %d" % (max_streams, threads - 1), file=sys.stderr)
+        max_streams = threads - 1
+    return max(max_streams, 0)
+
+
+@app.route('/events')
+def event_stream():
+    """A Server-Sent Events stream of reports as they come in
+       (see events.py): "report" events are JSON,
+           { "station": STATION, "new": true if it's a new station,
+             "values": { field: value, ... } }
+       with just the values that have changed since the last report,
+       and "remove" events, { "station": STATION }, when a station
+       stops being shown. A "reset" event means some events were missed,
+       so the page should be reloaded.
+       ?after=ID starts after event ID (the browser's Last-Event-ID
+       when it reconnects overrides that); by default, from now.
+    """
+    stations.initialize()
+
+    feed = stations.live_feed
+    try:
+        last_id = int(request.headers.get('Last-Event-ID',
+                                          request.args.get('after')))
+    except (TypeError, ValueError):
+        last_id = feed.last_id
+
+    global event_streams
+    with _event_streams_lock:
+        if not event_streams:
+            event_streams = threading.BoundedSemaphore(
+                max_event_streams())
+
+    if not event_streams.acquire(blocking=False):
+        return "Too many event streams\n", 503, { "Retry-After": "60" }
+
+    def stream(last_id):
+        # How long the browser should wait before reconnecting.
+        yield "retry: 5000\n\n"
+        end = time.monotonic() + EVENT_STREAM_SECONDS
+        while time.monotonic() < end:
+            evs = feed.wait(last_id, EVENT_KEEPALIVE_SECONDS)
+            if evs is None:
+                last_id = feed.last_id
+                yield "id: %d\nevent: reset\ndata: {}\n\n" % last_id
+            elif not evs:
+                yield ": keepalive\n\n"
+            for last_id, kind, data in evs or ():
+                yield "id: %d\nevent: %s\ndata: %s\n\n" % (last_id, kind, data)
+
+    response = app.response_class(stream(last_id),
+                                  mimetype='text/event-stream',
+                                  headers={ 'Cache-Control': 'no-cache',
+                                            # Don't let nginx buffer it
+                                            'X-Accel-Buffering': 'no' })
+    # Even if the browser goes away before the stream starts
+    response.call_on_close(event_streams.release)
+    return response
 
 
 @app.route('/details/<stationname>')
@@ -61,18 +324,23 @@ def details(stationname):
     """
     stations.initialize()
 
+    # The same stations all the way down the page,
+    # whatever reports come in while it's being made.
+    snapshot = stations.stations.snapshot()
     if stationname == "all":
         title = "All Stations"
-        showstations = stations.stations
+        showstations = snapshot
     else:
         title = "%s Details" % stationname
-        showstations = { stationname : stations.stations[stationname] }
+        showstations = { stationname : snapshot[stationname] }
 
-    return render_template('details.html',
-                           title=title,
-                           stationname=stationname,
-                           field_order = stations.get_field_order_fmt(),
-                           showstations=showstations)
+    return conditional(
+        None if stationname == "all" else showstations,
+        lambda: render_template('details.html',
+                                title=title,
+                                stationname=stationname,
+                                field_order = stations.get_field_order_fmt(),
+                                showstations=showstations))
 
 
 @app.route('/weekly/<stationname>', methods=['POST', 'GET'])
@@ -81,16 +349,20 @@ def weekly(stationname):
     """
     stations.initialize()
 
-    try:
-        data = stations.station_weekly(stationname)
-    except KeyError as e:
-        data = "No station named %s: %s" % (stationname, e)
-    # XXX maybe add a case that catches other exceptions
+    def render():
+        try:
+            data = stations.station_weekly(stationname)
+        except KeyError as e:
+            data = "No station named %s: %s" % (stationname, e)
+        # XXX maybe add a case that catches other exceptions
+
+        return render_template('timereport.html',
+                               title="Weekly report for %s station"
+                                     % stationname,
+                               stationname=stationname,
+                               data=data)
 
-    return render_template('timereport.html',
-                           title="Weekly report for %s station" % stationname,
-                           stationname=stationname,
-                           data=data)
+    return conditional([ stationname ], render)
 
 
 @app.route('/cumulative/<stationname>/<days>', methods=['POST', 'GET'])
@@ -114,17 +386,20 @@ def cumulative(stationname, days, chunkdays=1):
     elif chunkdays != 1:
         title += ", %s days at a time" % chunkdays
 
-    try:
-        data = stations.station_historic(stationname, days, chunkdays)
-    except KeyError as e:
-        data = "No station named %s: %s" % (stationname, e)
-    # XXX maybe add a case that catches other exceptions
+    def render():
+        try:
+            data = stations.station_historic(stationname, days, chunkdays)
+        except KeyError as e:
+            data = "No station named %s: %s" % (stationname, e)
+        # XXX maybe add a case that catches other exceptions
+
+        return render_template('timereport.html',
+                               title=title,
+                               stationname=stationname,
+                               field_order = stations.get_field_order(),
+                               data=data)
 
-    return render_template('timereport.html',
-                           title=title,
-                           stationname=stationname,
-                           field_order = stations.get_field_order(),
-                           data=data)
+    return conditional([ stationname ], render)
 
 
 # Some Jinja formatting filters
@@ -166,12 +441,18 @@ def report(stationname):
     # lists of strings instead of just strings, though this doesn't
     # seem to be documented anywhere.
     # Turn it into a normal dictionary like we use in stations.py:
+    # A report with no values (a heartbeat) is still a report.
     vals = request.form.to_dict()
 
     # If it doesn't have a last-updated time, add one:
     vals['time'] = datetime.now()
 
-    stations.update_station(stationname, vals)
+    try:
+        stations.submit_report(stationname, vals)
+    except queue.Full:
+        # Reports are coming in faster than they can be saved.
+        return "Too busy, try again later\n", 503, \
+            { "Retry-After": str(REPORT_RETRY_SECONDS) }
 
     retstr = 'Content-type: text/plain\n\n'
     for key in request.form:
@@ -179,21 +460,86 @@ def report(stationname):
     return retstr
 
 
-@app.route('/plot/<stationname>')
-@app.route('/plot/<stationname>/<starttime>')
-@app.route('/plot/<stationname>/<starttime>/<endtime>')
-def plot(stationname, starttime=None, endtime=None):
-    """Plot weather for a station.
-       By default, print the last 30 days, unless starttime and endtime are set.
-       If only startime is specified, run from starttime to now.
-       All times specified as yyyy-mm-dd or yyyy-mm-ddTHH:MM
+# How long to tell stations to wait when the ingest queue is full
+REPORT_RETRY_SECONDS = 30
+
+# The most /report_batch will take, uncompressed
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+
+@app.route('/report_batch', methods=['POST'])
+def report_batch():
+    """Accept several reports at once, from one station or several,
+       as a JSON list of
+           { "station": STATION, "time": "YYYY-MM-DD HH:MM:SS[.ffffff]",
+             "values": { field: value, ... } }
+       optionally gzipped (with Content-Encoding: gzip).
+       time is optional, defaulting to now; a report that's older than
+       the last one from its station is skipped (e.g. a reading
+       the station already sent). The reports are saved together.
+       A report that can't be read is left out, without holding up
+       the rest of the batch.
+       Returns JSON, { "accepted": N, "skipped": N,
+                       "rejected": [ { "index": N, "error": why }, ... ] }
+       where index is the report's position in the batch.
     """
     stations.initialize()
 
+    body = request.get_data()
+    try:
+        if request.headers.get('Content-Encoding') == 'gzip':
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decomp.decompress(body, MAX_BATCH_BYTES)
+            if decomp.unconsumed_tail:
+                return "Batch is too big\n", 413
+        records = json.loads(body)
+    except (zlib.error, ValueError) as e:
+        return "Can't read batch: %s\n" % e, 400
+
+    if type(records) is not list:
+        return "Batch should be a list of reports\n", 400
+    reports = []
+    rejected = []
+    for i, record in enumerate(records):
+        try:
+            stationname = record['station']
+            vals = dict(record['values'])
+            if type(stationname) is not str or not stationname \
+               or '/' in stationname or not vals \
+               or any(type(v) not in (str, int, float) for v in vals.values()):
+                raise ValueError(record)
+            vals['time'] = parse_time(record['time']) \
+                if record.get('time') else datetime.now()
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            rejected.append({ "index": i,
+                              "error": "%s: %s" % (type(e).__name__, e) })
+            continue
+        reports.append((stationname, vals))
+
+    try:
+        accepted = stations.submit_reports(reports)
+    except queue.Full:
+        return "Too busy, try again later\n", 503, \
+            { "Retry-After": str(REPORT_RETRY_SECONDS) }
+
+    if rejected:
+        print("Rejected %d of %d reports in a batch, e.g. %s"
+              % (len(rejected), len(records), rejected[0]["error"]),
+              file=sys.stderr)
+
+    return jsonify({ "accepted": accepted,
+                     "skipped": len(reports) - accepted,
+                     "rejected": rejected })
+
+
+def plot_times(starttime, endtime):
+    """Start and end datetimes for a plot from the strings in its URL:
+       yyyy-mm-dd or yyyy-mm-ddTHH:MM, or 'week' for the past week.
+       By default, the last 30 days.
+    """
     today = date.today()
     now = datetime.now()
 
-    # Set start and end times to what JavaScript needs: unix time * 1000.
     if endtime == 'week':
         et = today
     else:
@@ -204,7 +550,6 @@ def plot(stationname, starttime=None, endtime=None):
                 et = datetime.strptime(endtime, '%Y-%m-%d')
             except:
                 et = now
-    endtime = mktime(et.timetuple()) * 1000
 
     if starttime == 'week':
         st = et - timedelta(days=7)
@@ -216,66 +561,195 @@ def plot(stationname, starttime=None, endtime=None):
                 st = datetime.strptime(starttime, '%Y-%m-%d')
             except:
                 st = today - timedelta(days=30)
-    starttime = mktime(st.timetuple()) * 1000
-    # Now st and et are datetimes, starttime and endtime are unix time.
 
-    # Plotting a daily value is easy
-    try:
-        dailydata = stations.read_daily_data(stationname, ['rain_daily'],
-                                             st, et)
-    except:
-        flash("Sorry, don't have data to plot %s from %s to %s"
-              % (stationname, st, et))
+    return st, et
+
+
+@app.route('/plot/<stationname>')
+@app.route('/plot/<stationname>/<starttime>')
+@app.route('/plot/<stationname>/<starttime>/<endtime>')
+def plot(stationname, starttime=None, endtime=None):
+    """Plot weather for a station.
+       By default, print the last 30 days, unless starttime and endtime are set.
+       If only startime is specified, run from starttime to now.
+       All times specified as yyyy-mm-dd or yyyy-mm-ddTHH:MM
+       The page fetches the data to plot from /api/series (see series.js).
+    """
+    stations.initialize()
+
+    lastreport = stations.last_station_update.get(stationname)
+    if not lastreport:
+        flash("Sorry, don't have data to plot %s" % stationname)
         return home_page()
 
-    # More granular values may need resampling
-    hourlydata = stations.read_csv_data_resample(stationname,
-                                                 ['temperature',
-                                                  'humidity',
-                                                  'gust_speed',
-                                                  'max_gust'],
-                                                 st, et,
-                                                 timedelta(hours=1))
-
-    # chart.js needs Unix times * 1000 to feed to JavaScript's Date class.
-    # I know it's tempting to give start and end time and let
-    # the JS calculate it. But then the data can get out of sync
-    # with the time. It's much easier to generate them from the
-    # same function (in this case, read_csv_data_resample).
-    dailydata['unixtimes'] = [ mktime(d.timetuple()) * 1000
-                               for d in dailydata['t'] ]
-    hourlydata['unixtimes'] = [ mktime(d.timetuple()) * 1000
-                                for d in hourlydata['t'] ]
-
-    # charts.js can't do auto scaling, and jinja can't do max, so
-    # calculate it here, rounded up to multiples of roundoff.
-    def set_chart_maxmin(data, key, roundoff=1):
-        if not data[key]:
-            data[f'{key}_max'] = 1
-            data[f'{key}_min'] = 0
-            return
-
-        data[f'{key}_max'] = ceil(max([x for x in data[key] if x])
-                                  / roundoff) * roundoff
-        data[f'{key}_min'] = floor(min([x for x in data[key] if x])
-                                  / roundoff) * roundoff
-
-    # Set min and max for anything we want plotted.
-    set_chart_maxmin(dailydata, 'rain_daily', .1)
-    set_chart_maxmin(hourlydata, 'temperature', 1)
-    set_chart_maxmin(hourlydata, 'humidity', 1)
-    # set_chart_maxmin(hourlydata, 'gust_speed', 1)
-    set_chart_maxmin(hourlydata, 'max_gust', 1)
-    hourlydata['gust_speed_min'] = hourlydata['max_gust_min']
-    hourlydata['gust_speed_max'] = hourlydata['max_gust_max']
-
-    return render_template('plots.html',
-                           stationname=stationname,
-                           title="Weather Data for %s Station" % stationname,
-                           lastreport=stations.last_station_update[stationname],
-                           starttime=starttime, endtime=endtime,
-                           dailydata=dailydata,
-                           hourlydata=hourlydata)
+    st, et = plot_times(starttime, endtime)
+    starttime = st.strftime(SERIES_TIME_FMT)
+    endtime = et.strftime(SERIES_TIME_FMT)
+
+    return conditional(
+        [ stationname ],
+        lambda: render_template(
+            'plots.html',
+            stationname=stationname,
+            title="Weather Data for %s Station" % stationname,
+            lastreport=lastreport,
+            starttime=starttime,
+            endtime=endtime,
+            fields=[ 'temperature', 'humidity', 'gust_speed' ]),
+        starttime, endtime, lastreport,
+        as_of=min(et, datetime.now()), days=(st.date(), et.date()))
+
+
+@app.route('/compare/<stationlist>')
+@app.route('/compare/<stationlist>/<starttime>')
+@app.route('/compare/<stationlist>/<starttime>/<endtime>')
+def compare(stationlist, starttime=None, endtime=None):
+    """Plot several stations together, e.g. /compare/Outdoor,Indoor/week
+       stationlist is a comma-separated list of station names;
+       times are as for plot().
+    """
+    stations.initialize()
+
+    stationnames = [ s for s in stationlist.split(',') if s ]
+    st, et = plot_times(starttime, endtime)
+    starttime = st.strftime(SERIES_TIME_FMT)
+    endtime = et.strftime(SERIES_TIME_FMT)
+
+    return conditional(
+        stationnames,
+        lambda: render_template(
+            'compare.html',
+            title="Comparing %s" % ', '.join(stationnames),
+            stationlist=stationlist,
+            stationnames=stationnames,
+            fields=[ 'temperature', 'humidity', 'gust_speed' ],
+            starttime=starttime,
+            endtime=endtime),
+        starttime, endtime,
+        as_of=min(et, datetime.now()), days=(st.date(), et.date()))
+
+
+# Times in /api/series URLs, as plot_times() reads them
+SERIES_TIME_FMT = '%Y-%m-%dT%H:%M'
+
+SERIES_UNITS = { 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60 }
+
+
+def parse_resolution(res):
+    """A timedelta for a resolution like 30m, 1h, 1d or 600 (seconds),
+       or None for "daily", the days' last values.
+       Raises ValueError if it doesn't make sense.
+    """
+    if res == 'daily':
+        return None
+    unit = 's'
+    if res and res[-1] in SERIES_UNITS:
+        res, unit = res[:-1], res[-1]
+    secs = int(res) * SERIES_UNITS[unit]
+    if secs <= 0:
+        raise ValueError("resolution must be positive")
+    return timedelta(seconds=secs)
+
+
+@app.route('/api/series/<stationlist>')
+def series(stationlist):
+    """A station's data over a time range, as columns:
+       /api/series/STATION?fields=temperature,humidity
+                           &start=2022-06-01&end=2022-06-08&res=1h
+       start and end are as for plot() (the last 30 days by default);
+       res is a resolution like 30m, 1h, 1d or 600 (seconds),
+       or "daily" for values like rain_daily that add up over the day,
+       which are read at the end of each day. The default is 1h.
+       With grid=1, there's a value for every res from start,
+       so series for different stations line up.
+
+       By default the result is JSON,
+           { "station": STATION, "fields": [ field, ... ],
+             "t": [ unix time in milliseconds, ... ],
+             "values": { field: [ value or null, ... ], ... } }
+       With format=f32 it's packed little-endian binary,
+       the times as float64 milliseconds followed by each field's values
+       as float32, NaN where missing, with the fields in order
+       in the X-Series-Fields header.
+
+       STATION may be a comma-separated list of stations
+       (e.g. for /compare), which are read together onto one grid,
+       as with grid=1 (res=daily isn't allowed). Then the JSON has
+       "stations": [ STATION, ... ] instead of "station", and
+           "values": { STATION: { field: [ ... ], ... }, ... },
+       and the binary has each station's fields in turn,
+       in the order they're listed.
+    """
+    stations.initialize()
+
+    stationnames = [ s for s in stationlist.split(',') if s ]
+    if not stationnames:
+        return "No stations\n", 400
+    fields = [ f for f in request.args.get('fields', 'temperature').split(',')
+               if f ]
+    st, et = plot_times(request.args.get('start'), request.args.get('end'))
+    try:
+        time_incr = parse_resolution(request.args.get('res', '1h'))
+    except (ValueError, KeyError) as e:
+        return "Bad res %s: %s\n" % (request.args.get('res'), e), 400
+    if len(stationnames) > 1 and time_incr is None:
+        return "res=daily is only for one station at a time\n", 400
+
+    return conditional(stationnames,
+                       lambda: series_response(stationnames, fields,
+                                               st, et, time_incr),
+                       st.strftime(SERIES_TIME_FMT),
+                       et.strftime(SERIES_TIME_FMT),
+                       as_of=min(et, datetime.now()),
+                       days=(st.date(), et.date()))
+
+
+def series_response(stationnames, fields, st, et, time_incr):
+    """The response for series()."""
+    if len(stationnames) == 1:
+        data = stations.read_series(stationnames[0], fields, st, et,
+                                    time_incr,
+                                    grid=request.args.get('grid') == '1')
+        times = data['t']
+        values = { stationnames[0]: data }
+    else:
+        data = stations.read_multi_resample(stationnames, fields,
+                                            st, et, time_incr)
+        times = data['t']
+        values = data['stations']
+
+    # JavaScript's Date needs Unix times * 1000.
+    unixtimes = [ mktime(d.timetuple()) * 1000 for d in times ]
+
+    if request.args.get('format') == 'f32':
+        body = np.array(unixtimes, dtype='<f8').tobytes()
+        for stationname in stationnames:
+            for f in fields:
+                body += np.array([ np.nan if v is None else v
+                                   for v in values[stationname][f] ],
+                                 dtype='<f4').tobytes()
+        return app.response_class(body, mimetype='application/octet-stream',
+                                  headers={ 'X-Series-Fields':
+                                            ','.join(fields) })
+
+    def roundoff(val):
+        # The plots don't need more than this, and it's a lot shorter.
+        return None if val is None else round(val, 3)
+
+    def columns(stationname):
+        return { f: [ roundoff(v) for v in values[stationname][f] ]
+                 for f in fields }
+
+    if len(stationnames) == 1:
+        js = { "station": stationnames[0], "fields": fields,
+               "t": [ int(t) for t in unixtimes ],
+               "values": columns(stationnames[0]) }
+    else:
+        js = { "stations": stationnames, "fields": fields,
+               "t": [ int(t) for t in unixtimes ],
+               "values": { s: columns(s) for s in stationnames } }
+    return app.response_class(json.dumps(js, separators=(',', ':')),
+                              mimetype='application/json')
 
 
 @app.route('/api/compact/<stationname>/<key>')
@@ -295,3 +769,25 @@ def compact_data(stationname, key):
     stations.compact_stations(stationname)
 
     return f"Compacted station(s) {stationname}"
+
+
+@app.route('/api/pagecache')
+def page_cache_stats():
+    """How well the page cache (see pagecache.py) is doing, as JSON.
+    """
+    cache = get_page_cache()
+    if not cache:
+        return jsonify({ "state": "off" })
+    return jsonify(cache.stats())
+
+
+@app.route('/api/compaction')
+def compaction_progress():
+    """How the background compaction of this year's months
+       (see compaction.py) is going, as JSON.
+    """
+    stations.initialize()
+
+    if not stations.compactor:
+        return jsonify({ "state": "off" })
+    return jsonify(stations.compactor.status())
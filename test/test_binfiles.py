@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import stations
+import storage
+import binfiles
+import datafiles
+import daywriter
+import resample
+import rollups
+
+from datetime import datetime, timedelta
+
+import csv
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class BinFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csvpath = os.path.join(self.tmpdir, "Outdoor-2022-06-26.csv")
+        shutil.copy("test/files/rawdata/Outdoor-2022-06-26.csv",
+                    self.csvpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertColumnsMatch(self, got, want):
+        np.testing.assert_array_equal(got[0], want[0])
+        self.assertEqual(sorted(got[1]), sorted(want[1]))
+        for field in want[1]:
+            np.testing.assert_array_equal(got[1][field], want[1][field])
+
+    def test_convert(self):
+        fromcsv = resample.load_day_columns(self.csvpath)
+        header, lastrow = datafiles.read_last_row(self.csvpath)
+
+        binfiles.backfill(self.tmpdir)
+        self.assertEqual(binfiles.current_binfile(self.csvpath),
+                         binfiles.binfile_path(self.csvpath))
+
+        self.assertColumnsMatch(resample.load_day_columns(self.csvpath),
+                                fromcsv)
+        self.assertEqual(datafiles.read_last_row(self.csvpath),
+                         (header, lastrow))
+        with open(self.csvpath) as fp:
+            self.assertEqual(list(datafiles.read_rows(self.csvpath))[-1],
+                             list(csv.DictReader(fp))[-1])
+
+        # A newer CSV file means the binary one is out of date.
+        st = os.stat(self.csvpath)
+        os.utime(self.csvpath, (st.st_atime, st.st_mtime + 10))
+        self.assertIsNone(binfiles.current_binfile(self.csvpath))
+
+    def test_ingest(self):
+        orig = (stations.savedir, stations.expire_after)
+        stations.savedir = os.path.join(self.tmpdir, "save")
+        os.mkdir(stations.savedir)
+        stations.expire_after = timedelta(days=365000)
+        stations.get_storage().binwriter = \
+            daywriter.DayFileWriter(binary=True)
+        try:
+            with open(self.csvpath) as fp:
+                for row in list(csv.DictReader(fp))[:500]:
+                    stations.update_station("BinTest",
+                                            { k: row[k]
+                                              for k in row if row[k] })
+            stations.flush_storage()
+
+            csvpath = os.path.join(stations.savedir,
+                                   "BinTest-2022-06-26.csv")
+            binpath = binfiles.current_binfile(csvpath)
+            self.assertIsNotNone(binpath)
+            self.assertColumnsMatch(binfiles.load_columns(binpath),
+                                    resample.load_csv_columns(csvpath))
+            self.assertEqual(binfiles.read_header(binpath)[0],
+                             [ f for f in stations.get_field_order()
+                               if f != 'time' ])
+        finally:
+            stations.close_storage()
+            stations.savedir, stations.expire_after = orig
+            rollups._open.clear()
+            stations.stations.remove("BinTest")
+            stations.last_station_update.remove("BinTest")
+
+    def test_field_order(self):
+        """The binary file has the configured fields, whatever
+           the reports have, and is rewritten if they change.
+        """
+        fields = [ "time", "temperature", "humidity" ]
+        savedir = os.path.join(self.tmpdir, "save")
+        os.mkdir(savedir)
+        store = storage.CSVStorage(savedir, lambda: fields)
+        store.binwriter = daywriter.DayFileWriter(binary=True)
+        csvpath = store.path("St", datetime(2022, 6, 26))
+        try:
+            store.append("St", { "time": datetime(2022, 6, 26, 1),
+                                 "temperature": 21.2, "humidity": 40.1,
+                                 "rain": 0 })
+            store.append("St", { "time": datetime(2022, 6, 26, 2),
+                                 "temperature": 21.3, "humidity": 40.2 })
+            store.flush()
+            binpath = binfiles.current_binfile(csvpath)
+            self.assertEqual(binfiles.read_header(binpath)[0],
+                             [ "temperature", "humidity" ])
+            times, columns = binfiles.load_columns(binpath)
+            self.assertEqual(columns["temperature"][1], 21.3)
+            self.assertEqual(columns["humidity"].tolist(), [ 40.1, 40.2 ])
+
+            fields.append("rain")
+            store.append("St", { "time": datetime(2022, 6, 26, 3),
+                                 "temperature": 21.4, "humidity": 40.3,
+                                 "rain": 0.1 })
+            store.flush()
+            binpath = binfiles.current_binfile(csvpath)
+            self.assertEqual(binfiles.read_header(binpath)[0],
+                             [ "temperature", "humidity", "rain" ])
+            times, columns = binfiles.load_columns(binpath)
+            self.assertEqual(len(times), 3)
+            self.assertEqual(columns["temperature"][2], 21.4)
+        finally:
+            store.close()
+            rollups._open.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import compaction
+import stations
+import rollups
+
+from datetime import datetime, date, timedelta
+
+import os
+import shutil
+import tempfile
+
+
+class RollingCompactionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_state = (stations.savedir, stations.expire_after)
+        stations.savedir = tempfile.mkdtemp()
+        stations.expire_after = timedelta(days=365000)
+        for day in ("2022-05-31", "2022-06-26", "2022-06-27"):
+            shutil.copy("test/files/rawdata/Outdoor-%s.csv" % day,
+                        stations.savedir)
+        rollups._open.clear()
+
+    def tearDown(self):
+        stations.close_storage()
+        shutil.rmtree(stations.savedir)
+        stations.savedir, stations.expire_after = self.saved_state
+
+    def test_pending(self):
+        # June only just ended, so it waits.
+        self.assertEqual(
+            compaction.pending_units(stations.savedir,
+                                     datetime(2022, 7, 1, 1, 0)),
+            { ("Outdoor", 2022, 5): [ date(2022, 5, 31) ] })
+        self.assertEqual(
+            compaction.pending_units(stations.savedir,
+                                     datetime(2022, 7, 1, 3, 0)),
+            { ("Outdoor", 2022, 5): [ date(2022, 5, 31) ],
+              ("Outdoor", 2022, 6): [ date(2022, 6, 26),
+                                      date(2022, 6, 27) ] })
+        # Nothing from the year before.
+        self.assertEqual(
+            compaction.pending_units(stations.savedir,
+                                     datetime(2023, 2, 1, 3, 0)),
+            {})
+
+    def test_rolling(self):
+        before = stations.read_csv_data_resample(
+            "Outdoor", [ "temperature" ],
+            datetime(2022, 6, 26), datetime(2022, 6, 27), timedelta(hours=6))
+
+        compactor = compaction.RollingCompactor(stations.savedir,
+                                                stations.compact_days,
+                                                duty=1)
+        self.assertEqual(compactor.run_once(datetime(2022, 7, 1, 3, 0)), 3)
+
+        status = compactor.status()
+        self.assertEqual(status["state"], "idle")
+        self.assertEqual(status["compacted"], 3)
+        self.assertEqual(status["pending"], {})
+
+        # The summaries are there, and so are the day files.
+        files = sorted(os.listdir(stations.savedir))
+        for f in ("Outdoor-2022-05-hourly.csv", "Outdoor-2022-06-hourly.csv",
+                  "Outdoor-2022-daily.csv", "Outdoor-2022-06-26.csv",
+                  "Outdoor-2022-06-27.csv", "compacted.json"):
+            self.assertIn(f, files)
+        with open(os.path.join(stations.savedir,
+                               "Outdoor-2022-daily.csv")) as fp:
+            self.assertEqual([ line[:13] for line in fp ][1:],
+                             [ "2022-05-31 00", "2022-06-26 00",
+                               "2022-06-27 00" ])
+
+        # Reads still come from the day files while they're there.
+        self.assertEqual(stations.read_csv_data_resample(
+            "Outdoor", [ "temperature" ],
+            datetime(2022, 6, 26), datetime(2022, 6, 27), timedelta(hours=6)),
+                         before)
+
+        # and nothing's left to do.
+        self.assertEqual(compactor.run_once(datetime(2022, 7, 1, 3, 0)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
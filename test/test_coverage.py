@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import coverage
+import stations
+import rollups
+
+from datetime import datetime, date, timedelta
+
+import io
+import shutil
+import tempfile
+from contextlib import redirect_stderr
+
+
+class CoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_state = (stations.savedir, stations.expire_after)
+        stations.savedir = tempfile.mkdtemp()
+        stations.expire_after = timedelta(days=365000)
+        # A sparse station: two days a year apart
+        for day in ("2022-01-05", "2022-06-26"):
+            shutil.copy("test/files/rawdata/Outdoor-%s.csv" % day,
+                        stations.savedir)
+        rollups._open.clear()
+
+    def tearDown(self):
+        stations.close_storage()
+        shutil.rmtree(stations.savedir)
+        stations.savedir, stations.expire_after = self.saved_state
+        stations.stations.remove("Outdoor")
+        stations.last_station_update.remove("Outdoor")
+
+    def test_coverage(self):
+        cov = coverage.Coverage(stations.savedir)
+        self.assertEqual(cov.days_between("Outdoor"),
+                         [ date(2022, 1, 5), date(2022, 6, 26) ])
+        self.assertEqual(cov.days_between("Outdoor", date(2022, 2, 1),
+                                          date(2022, 12, 31)),
+                         [ date(2022, 6, 26) ])
+        self.assertEqual(cov.days_between("Nowhere"), [])
+        self.assertEqual(cov.stations(), { "Outdoor": date(2022, 6, 26) })
+        self.assertEqual(cov.extent("Outdoor"),
+                         (datetime(2022, 1, 5), datetime(2022, 6, 26)))
+
+        cov.add_report("Outdoor", datetime(2022, 6, 27, 0, 0, 10))
+        self.assertTrue(cov.has_day("Outdoor", date(2022, 6, 27)))
+        self.assertEqual(cov.extent("Outdoor")[1],
+                         datetime(2022, 6, 27, 0, 0, 10))
+
+        cov.remove_days("Outdoor", [ date(2022, 1, 5) ])
+        self.assertEqual(cov.last_day("Outdoor"), date(2022, 6, 27))
+        self.assertEqual(cov.extent("Outdoor")[0], datetime(2022, 6, 26))
+
+    def test_sparse_reads(self):
+        # Reading the whole year only looks at the days that exist,
+        # and doesn't complain about the rest.
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            daily = stations.read_daily_data("Outdoor", [ "temperature" ],
+                                             date(2022, 1, 1),
+                                             date(2022, 12, 31))
+            rsdata = stations.read_csv_data_resample(
+                "Outdoor", [ "temperature" ],
+                datetime(2022, 1, 1), datetime(2022, 12, 31),
+                timedelta(minutes=30))
+        self.assertEqual(daily['t'], [ date(2022, 1, 5), date(2022, 6, 26) ])
+        self.assertEqual(set(t.month for t in rsdata['t']), { 1, 6 })
+        self.assertEqual(stderr.getvalue(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
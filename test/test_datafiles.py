@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import datafiles
+import resample
+import storage
+
+import csv
+import os
+import tempfile
+import shutil
+from shutil import rmtree
+from datetime import datetime
+
+
+class DataFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def last_row(self, contents):
+        filename = os.path.join(self.tmpdir, "test.csv")
+        with open(filename, "w") as fp:
+            fp.write(contents)
+        return datafiles.read_last_row(filename)
+
+    def test_last_row(self):
+        filename = "test/files/rawdata/Outdoor-2022-06-26.csv"
+        with open(filename) as fp:
+            rows = list(csv.DictReader(fp))
+        header, row = datafiles.read_last_row(filename)
+        self.assertEqual(header[:3], [ "time", "temperature", "humidity" ])
+        self.assertEqual(row, rows[-1])
+
+    def test_partial_lines(self):
+        # A final line that's still being written is ignored
+        self.assertEqual(self.last_row("time,temp\nt1,50\nt2,51\nt3,5"),
+                         ([ "time", "temp" ], { "time": "t2", "temp": "51" }))
+        self.assertEqual(self.last_row("time,temp\nt1,50\n\n"),
+                         ([ "time", "temp" ], { "time": "t1", "temp": "50" }))
+        self.assertEqual(self.last_row("time,temp\nt1,5"),
+                         ([ "time", "temp" ], None))
+        self.assertEqual(self.last_row("time,temp\n"),
+                         ([ "time", "temp" ], None))
+        # Short rows get None, like DictReader
+        self.assertEqual(self.last_row("time,temp\nt1\n"),
+                         ([ "time", "temp" ], { "time": "t1", "temp": None }))
+
+    def test_small_blocks(self):
+        blocksize = datafiles.TAIL_BLOCKSIZE
+        datafiles.TAIL_BLOCKSIZE = 3
+        try:
+            self.assertEqual(self.last_row("time,temp\nt1,50\nt2,51\nt3,5"),
+                             ([ "time", "temp" ],
+                              { "time": "t2", "temp": "51" }))
+        finally:
+            datafiles.TAIL_BLOCKSIZE = blocksize
+
+    def test_compressed(self):
+        filename = os.path.join(self.tmpdir, "Outdoor-2022-06-26.csv")
+        shutil.copy("test/files/rawdata/Outdoor-2022-06-26.csv", filename)
+        mtime = os.stat(filename).st_mtime
+        lastrow = datafiles.read_last_row(filename)
+        times, columns = resample.load_day_columns(filename)
+
+        datafiles.compress_closed(self.tmpdir)
+        self.assertEqual(os.listdir(self.tmpdir),
+                         [ "Outdoor-2022-06-26.csv.gz" ])
+        self.assertEqual(datafiles.stat_day_file(filename).st_mtime, mtime)
+
+        # Readers given the .csv path read the .csv.gz
+        self.assertEqual(datafiles.read_last_row(filename), lastrow)
+        self.assertEqual(list(datafiles.read_rows(filename))[-1], lastrow[1])
+        gztimes, gzcolumns = resample.load_day_columns(filename)
+        self.assertEqual(list(gztimes), list(times))
+        self.assertEqual(sorted(gzcolumns), sorted(columns))
+
+        datafiles.uncompress_day_file(filename)
+        self.assertEqual(os.listdir(self.tmpdir),
+                         [ "Outdoor-2022-06-26.csv" ])
+        self.assertEqual(datafiles.read_last_row(filename), lastrow)
+
+    def test_compress_closed(self):
+        for day in (26, 27):
+            shutil.copy("test/files/rawdata/Outdoor-2022-06-%02d.csv" % day,
+                        self.tmpdir)
+        store = storage.CSVStorage(self.tmpdir,
+                                   lambda: [ "time", "temperature" ])
+        try:
+            # The first report after starting doesn't compress anything,
+            store.append("Outdoor",
+                         { "time": datetime(2022, 6, 27, 23, 59, 59),
+                           "temperature": 60 })
+            self.assertEqual(sorted(f for f in os.listdir(self.tmpdir)
+                                    if f.endswith(".csv")),
+                             [ "Outdoor-2022-06-26.csv",
+                               "Outdoor-2022-06-27.csv" ])
+
+            # that's left for the background, which skips the open file.
+            self.assertEqual(store.compress_closed(), 1)
+            self.assertTrue(os.path.exists(os.path.join(
+                self.tmpdir, "Outdoor-2022-06-26.csv.gz")))
+
+            # The first report of a new day compresses the day before.
+            store.append("Outdoor", { "time": datetime(2022, 6, 28),
+                                      "temperature": 59 })
+            self.assertTrue(os.path.exists(os.path.join(
+                self.tmpdir, "Outdoor-2022-06-27.csv.gz")))
+            self.assertEqual(store.compress_closed(), 0)
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import daycache
+import datafiles
+
+from datetime import date
+
+import os
+import gzip
+import shutil
+import tempfile
+
+
+class DayCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.savedir = tempfile.mkdtemp()
+        for day in (25, 26):
+            shutil.copy("test/files/rawdata/Outdoor-2022-06-%02d.csv" % day,
+                        self.savedir)
+        daycache._cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.savedir)
+        daycache._cache.clear()
+
+    def rawfile(self, day):
+        return os.path.join(self.savedir,
+                            day.strftime("Outdoor-%Y-%m-%d.csv"))
+
+    def test_day_summaries(self):
+        days = [ date(2022, 6, 24), date(2022, 6, 25), date(2022, 6, 26) ]
+        summaries = daycache.day_summaries(self.savedir, "Outdoor", days,
+                                           self.rawfile)
+        self.assertIsNone(summaries[date(2022, 6, 24)])
+        self.assertEqual(summaries[date(2022, 6, 25)]["rain_daily"][-1],
+                         0.559)
+        self.assertEqual(summaries[date(2022, 6, 26)]["rain_daily"][-1],
+                         1.232)
+        temp = summaries[date(2022, 6, 26)]["temperature"]
+        self.assertEqual(temp[0], 2864)
+        self.assertEqual((temp[2], temp[3]), (52.0, 59.4))
+
+        self.assertTrue(os.path.exists(daycache.cache_path(self.savedir,
+                                                           "Outdoor")))
+
+        # Forget the in-memory copy, and change one of the files:
+        # its summary should be recomputed, the other read from disk.
+        daycache._cache.clear()
+        with open(self.rawfile(date(2022, 6, 26)), "a") as fp:
+            print("2022-06-26 23:59:59,99.5", file=fp)
+        summaries = daycache.day_summaries(self.savedir, "Outdoor", days,
+                                           self.rawfile)
+        self.assertEqual(summaries[date(2022, 6, 26)]["temperature"][3], 99.5)
+        self.assertEqual(summaries[date(2022, 6, 25)]["rain_daily"][-1],
+                         0.559)
+
+        # A day file that's compressed keeps its summary: if it were
+        # summarized again, this one would have no data.
+        rawfile = self.rawfile(date(2022, 6, 25))
+        datafiles.compress_day_file(rawfile)
+        mtime = os.stat(rawfile + ".gz").st_mtime
+        with gzip.open(rawfile + ".gz", "wt") as fp:
+            print("time,temperature", file=fp)
+        os.utime(rawfile + ".gz", (mtime, mtime))
+        summaries = daycache.day_summaries(self.savedir, "Outdoor", days,
+                                           self.rawfile)
+        self.assertEqual(summaries[date(2022, 6, 25)]["rain_daily"][-1],
+                         0.559)
+        self.assertEqual(daycache.day_last_values(
+            self.savedir, "Outdoor", days, self.rawfile)[date(2022, 6, 25)]
+                         ["rain_daily"], 0.559)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import daywriter
+import timeindex
+
+import json
+import os
+import tempfile
+from shutil import rmtree
+
+
+class DayWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.writer = daywriter.DayFileWriter(flush_lines=3,
+                                              flush_seconds=0)
+
+    def tearDown(self):
+        self.writer.close()
+        rmtree(self.tmpdir)
+
+    def read(self, filename):
+        with open(os.path.join(self.tmpdir, filename)) as fp:
+            return fp.read()
+
+    def test_buffering(self):
+        path = os.path.join(self.tmpdir, "St-2022-06-26.csv")
+        self.writer.append("St", path, "time,temperature", "00:00,50")
+        # Header plus one line: not written yet
+        self.assertEqual(self.read("St-2022-06-26.csv"), "")
+
+        self.writer.append("St", path, "time,temperature", "00:01,51")
+        self.assertEqual(self.read("St-2022-06-26.csv"),
+                         "time,temperature\n00:00,50\n00:01,51\n")
+
+        self.writer.append("St", path, "time,temperature", "00:02,52")
+        self.writer.flush("St")
+        self.assertEqual(self.read("St-2022-06-26.csv"),
+                         "time,temperature\n00:00,50\n00:01,51\n00:02,52\n")
+
+    def test_index(self):
+        """Writing keeps the day file's time index up to date."""
+        path = os.path.join(self.tmpdir, "St-2022-06-26.csv")
+        self.writer.append("St", path, "time,temperature",
+                           "2022-06-26 00:00:00,50")
+        self.writer.append("St", path, "time,temperature",
+                           "2022-06-26 00:10:00,51")
+        self.writer.append("St", path, "time,temperature",
+                           "2022-06-26 00:20:00,52")
+        self.writer.flush("St")
+        with open(timeindex.index_path(path)) as fp:
+            index = json.load(fp)
+        self.assertEqual(index["size"], os.path.getsize(path))
+        self.assertEqual(len(index["slots"]), 3)
+        timeindex.forget(path)
+
+    def test_rollover(self):
+        path1 = os.path.join(self.tmpdir, "St-2022-06-26.csv")
+        path2 = os.path.join(self.tmpdir, "St-2022-06-27.csv")
+        self.writer.append("St", path1, "time,temperature", "23:59,50")
+        self.writer.append("St", path2, "time,temperature", "00:00,49")
+        self.assertEqual(self.read("St-2022-06-26.csv"),
+                         "time,temperature\n23:59,50\n")
+
+        # Appending to an existing file doesn't repeat the header
+        self.writer.close()
+        self.writer.append("St", path2, "time,temperature", "00:01,48")
+        self.writer.close()
+        self.assertEqual(self.read("St-2022-06-27.csv"),
+                         "time,temperature\n00:00,49\n00:01,48\n")
+
+    def test_failed_write(self):
+        path1 = os.path.join(self.tmpdir, "St-2022-06-26.csv")
+        path2 = os.path.join(self.tmpdir, "St-2022-06-27.csv")
+        self.writer.append("St", path1, "time,temperature", "23:58,50")
+
+        # A file that can't be written to keeps its lines
+        f = self.writer.files["St"]
+        f['fp'].close()
+        f['fp'] = open(path1)
+        self.writer.flush()
+        self.assertEqual(self.read("St-2022-06-26.csv"), "")
+        self.assertEqual(len(f['lines']), 2)
+
+        # for the next try.
+        self.writer.append("St", path1, "time,temperature", "23:59,51")
+        self.assertEqual(self.read("St-2022-06-26.csv"),
+                         "time,temperature\n23:58,50\n23:59,51\n")
+
+        # The same when it fails at the end of the day.
+        self.writer.append("St", path1, "time,temperature", "23:59,52")
+        f = self.writer.files["St"]
+        f['fp'].close()
+        f['fp'] = open(path1)
+        self.writer.append("St", path2, "time,temperature", "00:00,49")
+        self.writer.flush()
+        self.assertEqual(self.read("St-2022-06-26.csv"),
+                         "time,temperature\n23:58,50\n23:59,51\n"
+                         "23:59,52\n")
+        self.assertEqual(self.writer.unwritten, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import events
+
+import threading
+
+
+class EventFeedTest(unittest.TestCase):
+
+    def test_feed(self):
+        feed = events.EventFeed(size=3)
+        self.assertEqual(feed.wait(0, timeout=0), [])
+
+        self.assertEqual(feed.publish("report", "one"), 1)
+        feed.publish("report", "two")
+        self.assertEqual(feed.wait(0), [ (1, "report", "one"),
+                                         (2, "report", "two") ])
+        self.assertEqual(feed.wait(1), [ (2, "report", "two") ])
+        self.assertEqual(feed.wait(2, timeout=0), [])
+
+        # A reader that's fallen behind the buffer has to start over,
+        feed.publish("report", "three")
+        feed.publish("remove", "four")
+        self.assertEqual(len(feed.wait(1)), 3)
+        self.assertIsNone(feed.wait(0))
+
+        # and so does one from before a restart.
+        self.assertIsNone(feed.wait(10))
+
+    def test_wakeup(self):
+        feed = events.EventFeed()
+        got = []
+        readers = [ threading.Thread(target=lambda: got.append(feed.wait(0)))
+                    for i in range(5) ]
+        for reader in readers:
+            reader.start()
+        feed.publish("report", "data")
+        for reader in readers:
+            reader.join(5)
+        self.assertEqual(got, [ [ (1, "report", "data") ] ] * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import ingest
+
+import queue
+import threading
+
+
+class IngestTest(unittest.TestCase):
+
+    def test_batches(self):
+        batches = []
+        # Hold up the writer until everything's queued.
+        go = threading.Event()
+
+        def save_batch(items):
+            go.wait(5)
+            batches.append(items)
+
+        q = ingest.IngestQueue(save_batch, queue_size=4, batch_size=3)
+        self.assertRaises(RuntimeError, q.put, 0)
+        q.start()
+
+        q.put(1)
+        # Wait for the writer to take it and get stuck.
+        while q.queue.qsize():
+            threading.Event().wait(.01)
+        for i in range(2, 6):
+            q.put(i)
+        # That's as many as it will hold.
+        self.assertRaises(queue.Full, q.put, 6)
+        self.assertEqual(q.status()["queued"], 4)
+
+        go.set()
+        q.join()
+        self.assertEqual(batches, [ [ 1 ], [ 2, 3, 4 ], [ 5 ] ])
+        self.assertEqual(q.status()["saved"], 5)
+        q.stop()
+
+    def test_stop(self):
+        saved = []
+
+        def save_batch(items):
+            if 3 in items:
+                raise OSError("disk full")
+            saved.extend(items)
+
+        q = ingest.IngestQueue(save_batch, batch_size=1)
+        q.start()
+        for i in range(5):
+            q.put(i)
+
+        # Everything queued gets saved (or tried) before stop() returns.
+        q.stop()
+        self.assertEqual(saved, [ 0, 1, 2, 4 ])
+        self.assertEqual(q.status()["errors"], 1)
+        self.assertFalse(q.status()["running"])
+        self.assertRaises(RuntimeError, q.put, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
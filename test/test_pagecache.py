@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import pagecache
+
+from datetime import date
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = pagecache.PageCache(300)
+        for name in "abc":
+            cache.put(name, name * 100, 100)
+        self.assertEqual(cache.get("a"), "a" * 100)
+
+        # b is the least recently used now.
+        cache.put("d", "d" * 100, 100)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a" * 100)
+        self.assertEqual(cache.get("c"), "c" * 100)
+
+        # Too big to keep at all
+        cache.put("e", "e" * 1000, 1000)
+        self.assertIsNone(cache.get("e"))
+
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["bytes"], 300)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["evictions"], 1)
+
+    def test_invalidate(self):
+        cache = pagecache.PageCache(1000)
+        cache.put("june", "june", 10, [ "Outdoor" ],
+                  (date(2022, 6, 1), date(2022, 6, 30)), historic=True)
+        cache.put("latest", "latest", 10, [ "Outdoor" ])
+        cache.put("other", "other", 10, [ "Indoor" ],
+                  (date(2022, 6, 1), date(2022, 6, 30)))
+        cache.put("all", "all", 10)
+
+        cache.invalidate("Outdoor", date(2022, 7, 4))
+        self.assertEqual(cache.get("june"), "june")
+        self.assertIsNone(cache.get("latest"))
+        self.assertEqual(cache.get("other"), "other")
+        self.assertIsNone(cache.get("all"))
+
+        cache.invalidate("Outdoor", date(2022, 6, 30))
+        self.assertIsNone(cache.get("june"))
+        self.assertEqual(cache.get("other"), "other")
+
+        # Files were rewritten, so anything could have changed.
+        cache.invalidate()
+        self.assertIsNone(cache.get("other"))
+        self.assertEqual(cache.stats()["invalidations"], 4)
+
+    def test_ttl(self):
+        cache = pagecache.PageCache(1000, ttl=3600)
+        cache.put("now", "now", 10)
+        cache.put("stale", "stale", 10, ttl=0)
+        cache.put("then", "then", 10, ttl=0, historic=True)
+        self.assertEqual(cache.get("now"), "now")
+        self.assertIsNone(cache.get("stale"))
+        self.assertEqual(cache.get("then"), "then")
+        self.assertEqual(cache.stats()["bytes"], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import registry
+
+import threading
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_registry(self):
+        reg = registry.Registry({ "a": 1 })
+        self.assertEqual(reg["a"], 1)
+        self.assertEqual(reg.version, 0)
+
+        # A snapshot doesn't change when the registry does
+        snap = reg.snapshot()
+        reg.set("b", 2)
+        reg.update({ "c": 3 }, remove=[ "a" ])
+        self.assertEqual(dict(snap), { "a": 1 })
+        self.assertEqual(dict(reg), { "b": 2, "c": 3 })
+        self.assertEqual(reg.version, 2)
+
+        reg.remove("b", "nonexistent")
+        self.assertEqual(list(reg), [ "c" ])
+        self.assertNotIn("b", reg)
+        self.assertEqual(reg.get("b"), None)
+
+        reg.replace({})
+        self.assertEqual(len(reg), 0)
+        self.assertEqual(reg.version, 4)
+
+        # and can't be changed
+        with self.assertRaises(TypeError):
+            reg.snapshot()["a"] = 1
+
+    def test_threads(self):
+        reg = registry.Registry()
+        nwriters = 4
+        nwrites = 500
+
+        def write(w):
+            for i in range(nwrites):
+                key = "%d-%d" % (w, i % 10)
+                reg.set(key, i)
+                if i % 3 == 0:
+                    reg.remove(key)
+
+        writers = [ threading.Thread(target=write, args=(w,))
+                    for w in range(nwriters) ]
+        for t in writers:
+            t.start()
+
+        # Reading while the writers are going never sees a dict
+        # changing size mid-iteration.
+        while any(t.is_alive() for t in writers):
+            snap = reg.snapshot()
+            self.assertEqual(len([ k for k in snap ]), len(snap))
+
+        for t in writers:
+            t.join()
+
+        # No writes were lost
+        self.assertEqual(reg.version, nwriters * (nwrites + nwrites // 3 + 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
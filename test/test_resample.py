@@ -6,12 +6,18 @@ import sys
 sys.path.insert(0, 'server')
 
 import stations
+import watchserver
 from watchserver import plot
 
 from datetime import datetime, date, timedelta
+from time import mktime
+
+import numpy as np
 
 from shutil import rmtree
 
+import json
+
 import os
 
 
@@ -30,7 +36,8 @@ class ResampleTest(unittest.TestCase):
 
     # executed after each test
     def tearDown(self):
-        pass
+        # Reading summaries caches them in the data directory.
+        rmtree("test/files/rawdata/summaries", ignore_errors=True)
 
     def test_resample(self):
         self.maxDiff = None
@@ -143,6 +150,111 @@ class ResampleTest(unittest.TestCase):
             'rain_daily': [0.559, 1.232, 0.472, 0.0],
         })
 
+    def test_multi_resample(self):
+        stations.savedir = "test/files/rawdata"
+
+        # A station with no data still gets a value for every time.
+        rsdata = stations.read_multi_resample([ "Outdoor", "Nowhere" ],
+                                              [ "temperature" ],
+                                              datetime(2022, 6, 26, 23, 0),
+                                              datetime(2022, 6, 27, 1, 0),
+                                              timedelta(minutes=30))
+        self.assertEqual(rsdata['t'], [ datetime(2022, 6, 26, 23, 0),
+                                        datetime(2022, 6, 26, 23, 30),
+                                        datetime(2022, 6, 27, 0, 0),
+                                        datetime(2022, 6, 27, 0, 30) ])
+        self.assertEqual(sorted(rsdata['stations']), [ "Nowhere", "Outdoor" ])
+        self.assertEqual(rsdata['stations']['Nowhere']['temperature'],
+                         [ None ] * 4)
+        temps = rsdata['stations']['Outdoor']['temperature']
+        self.assertEqual(len(temps), 4)
+        self.assertTrue(all(type(t) is float for t in temps))
+
+        # The compare page can plot them together.
+        # Keep the page from initializing stations with another savedir.
+        saved_initialized = stations.initialized
+        stations.initialized = True
+        try:
+            watchserver.app.testing = True
+            client = watchserver.app.test_client()
+            rv = client.get('/compare/Outdoor,Nowhere/2022-06-26/2022-06-27')
+            query = "fields=temperature,humidity" \
+                "&start=2022-06-26T23:00&end=2022-06-27T01:00&res=30m"
+            seriesrv = client.get('/api/series/Outdoor,Nowhere?' + query)
+            binrv = client.get('/api/series/Outdoor,Nowhere?format=f32&'
+                               + query)
+            dailyrv = client.get('/api/series/Outdoor,Nowhere?res=daily')
+        finally:
+            stations.initialized = saved_initialized
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'label: "Nowhere"', rv.data)
+        self.assertIn(b'label: "Outdoor"', rv.data)
+        # and gets both stations' data in one request.
+        self.assertEqual(rv.data.count(b'fetchStationSeries('), 1)
+
+        js = seriesrv.get_json()
+        self.assertEqual(js['stations'], [ "Outdoor", "Nowhere" ])
+        self.assertEqual(js['t'], [ mktime(t.timetuple()) * 1000
+                                    for t in rsdata['t'] ])
+        self.assertEqual(js['values']['Nowhere'],
+                         { 'temperature': [ None ] * 4,
+                           'humidity': [ None ] * 4 })
+        self.assertEqual(js['values']['Outdoor']['temperature'],
+                         [ round(t, 3) for t in temps ])
+
+        # Outdoor's fields, then Nowhere's
+        self.assertEqual(len(binrv.data), 4 * 8 + 2 * 2 * 4 * 4)
+        vals = np.frombuffer(binrv.data, dtype='<f4', offset=4 * 8)
+        np.testing.assert_allclose(vals[:4], temps, rtol=1e-6)
+        self.assertTrue(np.all(np.isnan(vals[8:])))
+
+        self.assertEqual(dailyrv.status_code, 400)
+
+    def test_series(self):
+        stations.savedir = "test/files/rawdata"
+        saved_initialized = stations.initialized
+        stations.initialized = True
+        watchserver.app.testing = True
+        client = watchserver.app.test_client()
+        try:
+            query = "fields=temperature,average_wind" \
+                "&start=2022-06-26T09:00&end=2022-06-26T10:00&res=20m"
+            rv = client.get('/api/series/Outdoor?' + query)
+            self.assertEqual(rv.status_code, 200)
+            js = rv.get_json()
+            binrv = client.get('/api/series/Outdoor?format=f32&' + query)
+            dailyrv = client.get('/api/series/Outdoor?fields=rain_daily'
+                                 '&start=2022-06-25&end=2022-06-28'
+                                 '&res=daily')
+            badrv = client.get('/api/series/Outdoor?res=often')
+        finally:
+            stations.initialized = saved_initialized
+
+        # Same as test_resample()
+        self.assertEqual(js['fields'], [ "temperature", "average_wind" ])
+        start = datetime(2022, 6, 26, 9)
+        self.assertEqual(js['t'], [ mktime((start + timedelta(minutes=m))
+                                           .timetuple()) * 1000
+                                    for m in (0, 20, 40, 60) ])
+        self.assertEqual(js['values'], {
+            'temperature': [52.935, 53.11, 53.018, 53.4],
+            'average_wind': [0.227, 0.638, 0.333, 0.0],
+        })
+
+        self.assertEqual(binrv.headers['X-Series-Fields'],
+                         "temperature,average_wind")
+        self.assertEqual(len(binrv.data), 4 * 8 + 2 * 4 * 4)
+        np.testing.assert_array_equal(
+            np.frombuffer(binrv.data, dtype='<f8', count=4), js['t'])
+        np.testing.assert_allclose(
+            np.frombuffer(binrv.data, dtype='<f4', offset=4 * 8),
+            js['values']['temperature'] + js['values']['average_wind'],
+            atol=.001)
+
+        self.assertEqual(dailyrv.get_json()['values'],
+                         { 'rain_daily': [ 0.559, 1.232, 0.472, 0.0 ] })
+        self.assertEqual(badrv.status_code, 400)
+
     def test_compaction(self):
         datadir = "test/files/rawdata"
         stations.savedir = "test/files/compact"
@@ -193,11 +305,67 @@ class ResampleTest(unittest.TestCase):
             "Outdoor-2022-06-hourly.csv",
             "Outdoor-2022-daily.csv"
         ])
+        # Archived files are compressed.
         archived_files = sorted(os.listdir(archivedir))
-        self.assertEqual(archived_files, orig_files)
+        self.assertEqual(archived_files, [ f + ".gz" for f in orig_files ])
 
         # XXX Check contents of files here
 
+        # Each month is in the manifest, so compacting again
+        # doesn't change anything.
+        with open(os.path.join(stations.savedir, "compacted.json")) as fp:
+            manifest = json.load(fp)
+        self.assertEqual(sorted(manifest), [ "Outdoor-2022-%02d" % m
+                                             for m in range(1, 7) ])
+        def summaries():
+            contents = {}
+            for f in cached_files:
+                with open(os.path.join(stations.savedir, f)) as fp:
+                    contents[f] = fp.read()
+            return contents
+        compacted = summaries()
+        stations.compact_stations(stationname)
+        self.assertEqual(summaries(), compacted)
+
+        # A run that was interrupted before it archived a day
+        # just archives it; a day that isn't in the manifest
+        # gets compacted into the summaries with the others.
+        os.rename(os.path.join(archivedir, "Outdoor-2022-06-26.csv.gz"),
+                  os.path.join(stations.savedir,
+                               "Outdoor-2022-06-26.csv.gz"))
+        manifest["Outdoor-2022-06"].remove("2022-06-27")
+        with open(os.path.join(stations.savedir, "compacted.json"),
+                  "w") as fp:
+            json.dump(manifest, fp)
+        os.rename(os.path.join(archivedir, "Outdoor-2022-06-27.csv.gz"),
+                  os.path.join(stations.savedir,
+                               "Outdoor-2022-06-27.csv.gz"))
+        stations.compact_stations(stationname)
+        self.assertEqual(summaries(), compacted)
+        self.assertEqual(sorted(os.listdir(archivedir)), archived_files)
+
+        # The compacted days can still be read, from the summaries.
+        rsdata = stations.read_csv_data_resample(stationname,
+                                                 ["temperature"],
+                                                 datetime(2022, 6, 26),
+                                                 datetime(2022, 6, 27),
+                                                 timedelta(hours=6))
+        roundoff_floats(rsdata)
+        self.assertEqual(rsdata['t'], [ datetime(2022, 6, 26, 0),
+                                        datetime(2022, 6, 26, 6),
+                                        datetime(2022, 6, 26, 12),
+                                        datetime(2022, 6, 26, 18),
+                                        datetime(2022, 6, 27, 0) ])
+        self.assertEqual(rsdata['temperature'][0], 52.9583)
+
+        rsdata = stations.read_daily_data(stationname, ['rain_daily'],
+                                          date(2022, 6, 25),
+                                          date(2022, 6, 27))
+        self.assertEqual(rsdata, {
+            't': [ date(2022, 6, 25), date(2022, 6, 26), date(2022, 6, 27) ],
+            'rain_daily': [ 0.559, 1.232, 0.472 ]
+        })
+
         # Now make sure plot() can make a plot from the archived data
         # plot(stationname, date(2022, 1, 1), date(2022, 7, 1))
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import retention
+import serverconfig
+import stations
+import rollups
+
+from datetime import datetime, date, timedelta
+
+import configparser
+import os
+import shutil
+import tempfile
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_state = (stations.savedir, stations.expire_after,
+                            serverconfig._parser)
+        stations.savedir = tempfile.mkdtemp()
+        stations.expire_after = timedelta(days=365000)
+        for day in range(24, 28):
+            shutil.copy("test/files/rawdata/Outdoor-2022-06-%d.csv" % day,
+                        stations.savedir)
+        rollups._open.clear()
+
+        serverconfig._parser = configparser.ConfigParser()
+        serverconfig._parser.read_dict({
+            "retention": { "raw_days": "2", "minute_days": "3" },
+            "retention Other": { "raw_days": "forever" },
+        })
+
+    def tearDown(self):
+        stations.close_storage()
+        shutil.rmtree(stations.savedir)
+        (stations.savedir, stations.expire_after,
+         serverconfig._parser) = self.saved_state
+
+    def test_tiers(self):
+        self.assertTrue(retention.enabled())
+        self.assertEqual(retention.tier_days("Outdoor"),
+                         { 'raw': 2, 'minute': 3 })
+        self.assertEqual(retention.tier_days("Other"),
+                         { 'raw': None, 'minute': 3 })
+
+    def test_expire(self):
+        args = ("Outdoor", [ "temperature" ],
+                datetime(2022, 6, 24), datetime(2022, 6, 28),
+                timedelta(hours=1))
+        before = stations.read_csv_data_resample(*args)
+        gridargs = ([ "Outdoor" ], [ "temperature" ],
+                    datetime(2022, 6, 24), datetime(2022, 6, 28),
+                    timedelta(minutes=20))
+        gridbefore = stations.read_multi_resample(*gridargs)
+
+        store = stations.get_storage()
+        self.assertEqual(retention.expire(store, stations.compact_days,
+                                          today=date(2022, 6, 28)), 2)
+
+        # The 24th is only in the summaries; the 25th still has
+        # its rollups.
+        files = os.listdir(stations.savedir)
+        self.assertNotIn("Outdoor-2022-06-24.csv", files)
+        self.assertNotIn("Outdoor-2022-06-25.csv", files)
+        self.assertIn("Outdoor-2022-06-26.csv", files)
+        self.assertIn("Outdoor-2022-06-hourly.csv", files)
+        rollupfiles = os.listdir(rollups.rollup_dir(stations.savedir))
+        self.assertNotIn("Outdoor-2022-06-24-minute.jsonl", rollupfiles)
+        self.assertIn("Outdoor-2022-06-25-minute.jsonl", rollupfiles)
+
+        # Reads get the same hourly values from the rollups,
+        # and something for each hour from the summaries.
+        after = stations.read_csv_data_resample(*args)
+        self.assertEqual(after['t'], before['t'])
+        n24 = len([ t for t in before['t'] if t.day == 24 ])
+        self.assertEqual(after['temperature'][n24:],
+                         before['temperature'][n24:])
+        self.assertTrue(all(after['temperature'][:n24]))
+
+        # and so do reads onto a grid, for the compare page
+        hourly = stations.read_multi_resample([ "Outdoor" ], *args[1:])
+        self.assertEqual(hourly['t'][n24:], after['t'][n24:])
+        self.assertEqual(hourly['stations']['Outdoor']['temperature'],
+                         after['temperature'])
+        gridafter = stations.read_multi_resample(*gridargs)
+        self.assertEqual(gridafter['t'], gridbefore['t'])
+        n24 = 24 * 3
+        temps = gridafter['stations']['Outdoor']['temperature']
+        self.assertTrue(any(temps[:n24]))
+        for t, want in zip(temps[n24:], gridbefore['stations']['Outdoor']
+                           ['temperature'][n24:]):
+            if want is None:
+                self.assertIsNone(t)
+            else:
+                self.assertAlmostEqual(t, want)
+
+        daily = stations.read_daily_data("Outdoor", [ "temperature" ],
+                                         date(2022, 6, 24),
+                                         date(2022, 6, 27))
+        self.assertEqual(daily['t'], [ date(2022, 6, d)
+                                       for d in range(24, 28) ])
+
+        # Nothing more to do today,
+        self.assertEqual(retention.expire(store, stations.compact_days,
+                                          today=date(2022, 6, 28)), 0)
+
+        # but two days later, the 25th's rollups go too.
+        self.assertEqual(retention.expire(store, stations.compact_days,
+                                          today=date(2022, 6, 30)), 3)
+        rollupfiles = os.listdir(rollups.rollup_dir(stations.savedir))
+        self.assertNotIn("Outdoor-2022-06-25-minute.jsonl", rollupfiles)
+        self.assertIn("Outdoor-2022-06-27-minute.jsonl", rollupfiles)
+        daily = stations.read_daily_data("Outdoor", [ "temperature" ],
+                                         date(2022, 6, 24),
+                                         date(2022, 6, 27))
+        self.assertEqual(len(daily['t']), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import stations
+import rollups
+import resample
+
+from datetime import datetime, date, timedelta
+
+import csv
+import os
+import tempfile
+from shutil import rmtree
+
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = "test/files/rawdata"
+        self.orig_savedir = stations.savedir
+        self.orig_expire = stations.expire_after
+        stations.savedir = tempfile.mkdtemp()
+        stations.expire_after = timedelta(days=365000)
+        rollups._open.clear()
+
+    def tearDown(self):
+        stations.close_storage()
+        rmtree(stations.savedir)
+        stations.savedir = self.orig_savedir
+        stations.expire_after = self.orig_expire
+        rollups._open.clear()
+        stations.stations.remove("RollupTest")
+        stations.last_station_update.remove("RollupTest")
+
+    def ingest(self, day):
+        """Feed a day's sample data through update_station()."""
+        with open(os.path.join(self.datadir,
+                               day.strftime("Outdoor-%Y-%m-%d.csv"))) as fp:
+            for row in csv.DictReader(fp):
+                stations.update_station("RollupTest",
+                                        { k: row[k] for k in row if row[k] })
+
+    def assertBucketsEqual(self, buckets, expected):
+        self.assertEqual([ b[0] for b in buckets ], [ b[0] for b in expected ])
+        for b, e in zip(buckets, expected):
+            self.assertEqual(sorted(b[1]), sorted(e[1]))
+            for f in b[1]:
+                for got, want in zip(b[1][f], e[1][f]):
+                    self.assertAlmostEqual(got, want, places=6)
+
+    def test_ingest_rollups(self):
+        self.ingest(date(2022, 6, 26))
+        self.ingest(date(2022, 6, 27))
+        stations.flush_storage()
+
+        # The 26th is finished, so it was compressed at the rollover;
+        # everything below should read it transparently.
+        if stations.get_storage().compress_closed_days:
+            self.assertTrue(os.path.exists(
+                stations.datafile_path("RollupTest",
+                                       date(2022, 6, 26)) + ".gz"))
+
+        # Both days were closed by ingest, so they should match
+        # rolling up the raw files from scratch.
+        for day in (date(2022, 6, 26), date(2022, 6, 27)):
+            rawfile = stations.datafile_path("RollupTest", day)
+            times, columns = resample.load_day_columns(rawfile)
+            for level in rollups.LEVELS:
+                buckets = rollups.read_buckets(stations.savedir, "RollupTest",
+                                               day, level, rawfile)
+                self.assertIsNotNone(buckets)
+                self.assertBucketsEqual(buckets,
+                                        rollups.summarize_columns(times,
+                                                                  columns,
+                                                                  level))
+
+        hourly = stations.read_csv_data_resample("RollupTest",
+                                                 ["temperature", "humidity"],
+                                                 datetime(2022, 6, 26, 12),
+                                                 datetime(2022, 6, 27, 12),
+                                                 timedelta(hours=1))
+        self.assertEqual(len(hourly['t']), 25)
+        self.assertEqual(hourly['t'][0], datetime(2022, 6, 26, 12))
+        self.assertEqual(hourly['t'][-1], datetime(2022, 6, 27, 12))
+
+        # Without the rollups, the raw files should give the same answer.
+        rollups._open.clear()
+        rmtree(rollups.rollup_dir(stations.savedir))
+        fromraw = stations.read_csv_data_resample("RollupTest",
+                                                  ["temperature", "humidity"],
+                                                  datetime(2022, 6, 26, 12),
+                                                  datetime(2022, 6, 27, 12),
+                                                  timedelta(hours=1))
+        self.assertEqual(hourly['t'], fromraw['t'])
+        for key in ("temperature", "humidity"):
+            for got, want in zip(hourly[key], fromraw[key]):
+                self.assertAlmostEqual(got, want, places=6)
+
+        daily = stations.read_daily_data("RollupTest", ["rain_daily"],
+                                         date(2022, 6, 26), date(2022, 6, 27))
+        self.assertEqual(daily, { 't': [ date(2022, 6, 26),
+                                         date(2022, 6, 27) ],
+                                  'rain_daily': [ 1.232, 0.472 ] })
+
+    def test_restart_midday(self):
+        """A restarted server picks up the day from the raw file."""
+        with open(os.path.join(self.datadir, "Outdoor-2022-06-26.csv")) as fp:
+            rows = list(csv.DictReader(fp))
+
+        for row in rows[:1000]:
+            stations.update_station("RollupTest",
+                                    { k: row[k] for k in row if row[k] })
+        rollups._open.clear()
+        for row in rows[1000:]:
+            stations.update_station("RollupTest",
+                                    { k: row[k] for k in row if row[k] })
+        stations.flush_storage()
+
+        day = date(2022, 6, 26)
+        rawfile = stations.datafile_path("RollupTest", day)
+        times, columns = resample.load_day_columns(rawfile)
+        self.assertBucketsEqual(rollups.read_buckets(stations.savedir,
+                                                     "RollupTest", day,
+                                                     'hour', rawfile),
+                                rollups.summarize_columns(times, columns,
+                                                          'hour'))
+
+
+if __name__ == '__main__':
+    unittest.main()
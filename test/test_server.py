@@ -2,13 +2,24 @@
 
 import sys
 import os
+import json
+import gzip
+import math
 
 import unittest
+from datetime import datetime, timedelta
 import tempfile
+import shutil
+import threading
+import configparser
+from werkzeug.http import http_date
 
 sys.path.insert(0, 'server')
 import watchserver
 import stations
+import ingest
+import rollups
+import serverconfig
 
 sys.path.insert(0, 'client')
 import stationreport
@@ -32,9 +43,14 @@ class ServerTests(unittest.TestCase):
 
     # executed after each test
     def tearDown(self):
+        stations.close_storage()
         for f in os.listdir(self.savedir):
             if f.startswith("UnitTest"):
                 os.unlink(os.path.join(self.savedir, f))
+        # Reports also write rollups
+        shutil.rmtree(os.path.join(self.savedir, "rollups"),
+                      ignore_errors=True)
+        rollups._open.clear()
 
     def test_main_page(self):
         rv = self.app.get('/', follow_redirects=True)
@@ -67,6 +83,274 @@ class ServerTests(unittest.TestCase):
         assert b'<tr><th>Temperature</th>\n      <td class="val">85.0</td>' \
             in rv.data
 
+    def test_conditional_get(self):
+        stationreport.initialize("testclient")
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+
+        rv = self.app.get('/details/UnitTest')
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        lastmod = rv.headers['Last-Modified']
+
+        rv = self.app.get('/details/UnitTest',
+                          headers={ 'If-None-Match': etag })
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+
+        # If-Modified-Since only matches once the second of the last
+        # change is over, in case there's another one in that second.
+        modified = stations.data_modified([ "UnitTest" ])
+        self.assertIn(lastmod, (http_date(math.floor(modified)),
+                                http_date(math.ceil(modified))))
+        rv = self.app.get('/details/UnitTest',
+                          headers={ 'If-Modified-Since':
+                                    http_date(math.floor(modified)) })
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/details/UnitTest',
+                          headers={ 'If-Modified-Since':
+                                    http_date(math.ceil(modified)) })
+        self.assertEqual(rv.status_code, 304)
+
+        # Another station's report doesn't change it,
+        stations.update_station("UnitTestOther",
+                                { "temperature": "50",
+                                  "time": datetime.now() })
+        rv = self.app.get('/details/UnitTest',
+                          headers={ 'If-None-Match': etag })
+        self.assertEqual(rv.status_code, 304)
+
+        # but its own does.
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+        rv = self.app.get('/details/UnitTest',
+                          headers={ 'If-None-Match': etag })
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        stations.stations.remove("UnitTestOther")
+        stations.last_station_update.remove("UnitTestOther")
+
+    def test_page_cache(self):
+        stationreport.initialize("testclient")
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+
+        before = self.app.get('/api/pagecache').get_json()
+        rv = self.app.get('/details/UnitTest')
+        rv2 = self.app.get('/details/UnitTest')
+        self.assertEqual(rv2.data, rv.data)
+        self.assertEqual(rv2.headers['ETag'], rv.headers['ETag'])
+        after = self.app.get('/api/pagecache').get_json()
+        self.assertEqual(after['hits'], before['hits'] + 1)
+
+        # A new report drops it.
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+        self.assertGreater(
+            self.app.get('/api/pagecache').get_json()['invalidations'],
+            after['invalidations'])
+        rv3 = self.app.get('/details/UnitTest')
+        self.assertNotEqual(rv3.headers['ETag'], rv.headers['ETag'])
+
+        # So does pruning a station it shows.
+        stations.stations.set("UnitTestStale",
+                              { "time": datetime.now() - timedelta(days=999),
+                                "temperature": 1 })
+        rv = self.app.get('/stations')
+        self.assertIn(b'UnitTestStale', rv.data)
+        stations.prune_stations()
+        rv2 = self.app.get('/stations',
+                           headers={ "If-None-Match": rv.headers['ETag'] })
+        self.assertEqual(rv2.status_code, 200)
+        self.assertNotIn(b'UnitTestStale', rv2.data)
+
+    def test_events(self):
+        after = stations.live_feed.last_id
+        stationreport.initialize("testclient")
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+
+        rv = self.app.get('/stations')
+        self.assertIn(b'new EventSource("/events?after=%d")'
+                      % stations.live_feed.last_id, rv.data)
+        self.assertIn(b'<noscript>', rv.data)
+
+        rv = self.app.get('/events?after=%d' % after, buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        chunks = iter(rv.response)
+        self.assertEqual(next(chunks), b'retry: 5000\n\n')
+        event = next(chunks).decode().splitlines()
+        rv.close()
+        self.assertEqual(event[0], 'id: %d' % (after + 1))
+        self.assertEqual(event[1], 'event: report')
+        data = json.loads(event[2][len('data: '):])
+        self.assertEqual(data["station"], "UnitTest")
+        self.assertEqual(data["values"]["temperature"], 85)
+
+    def test_max_event_streams(self):
+        # Streams get half the threads, and always leave one for reports.
+        saved_parser = serverconfig._parser
+        try:
+            for config, max_streams in (({}, 2),
+                                        ({ "server": { "threads": "1" } }, 0),
+                                        ({ "events": { "max_streams": "9" } },
+                                         4)):
+                serverconfig._parser = configparser.ConfigParser()
+                serverconfig._parser.read_dict(config)
+                self.assertEqual(watchserver.max_event_streams(), max_streams)
+        finally:
+            serverconfig._parser = saved_parser
+
+    def test_static_files(self):
+        rv = self.app.get('/stations')
+        self.assertEqual(rv.status_code, 200)
+        url = '/basic.css?v=' + watchserver.static_hash('basic.css')
+        self.assertIn(url.encode(), rv.data)
+
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('immutable', rv.headers['Cache-Control'])
+        self.assertIn('max-age=%d' % watchserver.STATIC_MAX_AGE,
+                      rv.headers['Cache-Control'])
+        rv.close()
+
+        # An out of date hash doesn't get kept.
+        rv = self.app.get('/basic.css?v=0123456789ab')
+        self.assertNotIn('immutable', rv.headers.get('Cache-Control', ''))
+        rv.close()
+
+    def test_ingest(self):
+        stations.start_ingest()
+        self.assertTrue(stations.ingest_queue)
+
+        stationreport.initialize("testclient")
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+        # It's there right away,
+        self.assertEqual(stations.stations["UnitTest"]["temperature"], 85)
+
+        # and saved soon after.
+        stations.ingest_queue.join()
+        stations.flush_storage()
+        self.assertTrue(any(f.startswith("UnitTest-")
+                            for f in os.listdir(self.savedir)))
+
+        # A report with no values is still taken.
+        rv = self.app.post('/report/UnitTestOther')
+        self.assertEqual(rv.status_code, 200)
+        stations.ingest_queue.join()
+        stations.stations.remove("UnitTestOther")
+        stations.last_station_update.remove("UnitTestOther")
+
+        # When reports can't be saved fast enough
+        saved_queue = stations.ingest_queue
+        go = threading.Event()
+        stations.ingest_queue = ingest.IngestQueue(lambda items: go.wait(5),
+                                                   queue_size=1)
+        stations.ingest_queue.start()
+        try:
+            codes = [ self.app.post('/report/UnitTest',
+                                    data={ "temperature": "80" }).status_code
+                      for i in range(3) ]
+        finally:
+            go.set()
+            stations.ingest_queue.stop()
+            stations.ingest_queue = saved_queue
+        self.assertIn(503, codes)
+        rv = self.app.post('/report/UnitTest', data={ "temperature": "80" })
+        self.assertEqual(rv.status_code, 200)
+
+    def test_report_batch(self):
+        # Older reports than the current ones would be skipped.
+        stations.stations.remove("UnitTest")
+        t0 = datetime.now().replace(microsecond=0) - timedelta(minutes=5)
+        t1 = t0 + timedelta(seconds=30)
+        batch = [
+            { "station": "UnitTest", "time": str(t1),
+              "values": { "temperature": 60.5 } },
+            { "station": "UnitTestOther", "values": { "temperature": "50" } },
+            { "station": "UnitTest", "time": str(t0),
+              "values": { "temperature": 60 } },
+        ]
+        rv = self.app.post('/report_batch',
+                           data=gzip.compress(json.dumps(batch).encode()),
+                           headers={ "Content-Encoding": "gzip" })
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.get_json(), { "accepted": 3, "skipped": 0,
+                                          "rejected": [] })
+        if stations.ingest_queue:
+            stations.ingest_queue.join()
+        self.assertEqual(stations.stations["UnitTest"]["temperature"], 60.5)
+        self.assertEqual(stations.stations["UnitTestOther"]["temperature"],
+                         50)
+        stations.flush_storage()
+        with open(os.path.join(self.savedir, "UnitTest-%s.csv"
+                               % t1.strftime("%Y-%m-%d"))) as fp:
+            times = [ line.split(',')[0] for line in fp ]
+        self.assertLess(times.index(str(t0)), times.index(str(t1)))
+
+        # Sent again, they're skipped.
+        rv = self.app.post('/report_batch', data=json.dumps(batch[:1]))
+        self.assertEqual(rv.get_json(), { "accepted": 0, "skipped": 1,
+                                          "rejected": [] })
+
+        for bad in (b'{', b'{}'):
+            rv = self.app.post('/report_batch', data=bad)
+            self.assertEqual(rv.status_code, 400)
+
+        # A bad report doesn't hold up the rest.
+        t2 = t1 + timedelta(seconds=30)
+        rv = self.app.post('/report_batch', data=json.dumps([
+            { "station": "UnitTest" },
+            { "station": "UnitTest", "time": "noon",
+              "values": { "temperature": 1 } },
+            { "station": "UnitTest", "time": str(t2),
+              "values": { "temperature": 61 } } ]))
+        self.assertEqual(rv.status_code, 200)
+        result = rv.get_json()
+        self.assertEqual(result["accepted"], 1)
+        self.assertEqual([ r["index"] for r in result["rejected"] ], [ 0, 1 ])
+
+        stations.stations.remove("UnitTestOther")
+        stations.last_station_update.remove("UnitTestOther")
+
+    def test_backlog(self):
+        stationreport.initialize("testclient")
+        stationreport.backlog.clear()
+
+        # The server is too busy, so the readings wait,
+        saved_queue = stations.ingest_queue
+        go = threading.Event()
+        stations.ingest_queue = ingest.IngestQueue(lambda items: go.wait(5),
+                                                   queue_size=1)
+        stations.ingest_queue.start()
+        try:
+            for i in range(3):
+                stationreport.stationreport('localhost', "UnitTest",
+                                            test_client=self.app)
+            self.assertTrue(stationreport.backlog)
+        finally:
+            go.set()
+            stations.ingest_queue.stop()
+            stations.ingest_queue = saved_queue
+
+        # and go with the next report.
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+        self.assertEqual(stationreport.backlog, [])
+
+        # Readings the server refuses aren't sent again.
+        stationreport.backlog.append("not a report")
+        stationreport.stationreport('localhost', "UnitTest",
+                                    test_client=self.app)
+        self.assertEqual(stationreport.backlog, [])
+
+    def test_compaction_progress(self):
+        rv = self.app.get('/api/compaction')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(rv.get_json()["state"],
+                      ("off", "idle", "compacting", "stopped"))
+
 
 if __name__ == '__main__':
     unittest.main()
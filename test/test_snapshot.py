@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import stations
+
+from datetime import datetime, timedelta
+
+import os
+import shutil
+import tempfile
+import time
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_state = (stations.savedir, stations.expire_after,
+                            dict(stations.stations),
+                            dict(stations.last_station_update))
+        stations.savedir = tempfile.mkdtemp()
+        stations.expire_after = timedelta(days=365000)
+        stations.stations.replace({})
+        stations.last_station_update.replace({})
+
+        for day in (26, 27):
+            shutil.copy("test/files/rawdata/Outdoor-2022-06-%02d.csv" % day,
+                        stations.savedir)
+
+    def tearDown(self):
+        shutil.rmtree(stations.savedir)
+        (stations.savedir, stations.expire_after,
+         oldstations, oldupdates) = self.saved_state
+        stations.stations.replace(oldstations)
+        stations.last_station_update.replace(oldupdates)
+
+    def test_snapshot(self):
+        stations.scan_savedir()
+        self.assertEqual(stations.stations["Outdoor"]["time"],
+                         datetime(2022, 6, 27, 23, 59, 40))
+        scanned = dict(stations.stations)
+        store = stations.get_storage()
+        days = store.coverage.days_between("Outdoor")
+        stations.save_snapshot()
+
+        stations.stations.replace({})
+        stations.last_station_update.replace({})
+        store.coverage.days = None
+        self.assertTrue(stations.load_snapshot())
+        self.assertEqual(stations.stations, scanned)
+        self.assertEqual(stations.last_station_update["Outdoor"],
+                         datetime(2022, 6, 27, 23, 59, 40))
+
+        # The day files come from the snapshot too, rather than a scan.
+        os.rename(os.path.join(stations.savedir, "Outdoor-2022-06-26.csv"),
+                  os.path.join(stations.savedir, "Outdoor-2022-06-25.csv"))
+        self.assertEqual(store.coverage.days_between("Outdoor"), days)
+        os.rename(os.path.join(stations.savedir, "Outdoor-2022-06-25.csv"),
+                  os.path.join(stations.savedir, "Outdoor-2022-06-26.csv"))
+
+        # A file written after the snapshot gets picked up
+        time.sleep(.01)
+        now = datetime.now().replace(microsecond=0)
+        with open(stations.datafile_path("Outdoor", now), "w") as fp:
+            print("time,temperature,humidity", file=fp)
+            print("%s,99.5,12" % now.strftime("%Y-%m-%d %H:%M:%S"), file=fp)
+        stations.stations.replace({})
+        self.assertTrue(stations.load_snapshot())
+        self.assertEqual(stations.stations["Outdoor"],
+                         { "time": now, "temperature": 99.5, "humidity": 12 })
+        self.assertEqual(stations.last_station_update["Outdoor"], now)
+        self.assertIn(now.date(), store.coverage.days_between("Outdoor"))
+
+        snapfile = stations.snapshot_file()
+
+        # A corrupt snapshot means scanning savedir instead
+        with open(snapfile, "w") as fp:
+            fp.write('{ "version": 1, "sta')
+        self.assertFalse(stations.load_snapshot())
+
+        os.unlink(snapfile)
+        self.assertFalse(stations.load_snapshot())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import storage
+import rollups
+import resample
+
+from datetime import datetime, date, timedelta
+
+import csv
+import sqlite3
+import os
+import tempfile
+from shutil import rmtree
+
+import numpy as np
+
+
+DATADIR = "test/files/rawdata"
+
+
+class SQLiteStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(DATADIR, "Outdoor-2022-06-26.csv")) as fp:
+            self.fields = next(csv.reader(fp))
+        self.db = storage.SQLiteStorage(self.tmpdir, lambda: self.fields)
+        self.csv = storage.CSVStorage(DATADIR, lambda: self.fields)
+        rollups._open.clear()
+
+    def tearDown(self):
+        self.db.close()
+        self.csv.close()
+        rmtree(self.tmpdir)
+        rmtree(os.path.join(DATADIR, "summaries"), ignore_errors=True)
+        rmtree(os.path.join(DATADIR, "rollups"), ignore_errors=True)
+
+    def ingest(self, day, batch=False):
+        reports = []
+        with open(os.path.join(DATADIR,
+                               day.strftime("Outdoor-%Y-%m-%d.csv"))) as fp:
+            for row in csv.DictReader(fp):
+                report = { k: float(row[k]) for k in row
+                           if row[k] and k != 'time' }
+                report['time'] = datetime.strptime(row['time'],
+                                                   "%Y-%m-%d %H:%M:%S")
+                reports.append(("Outdoor", report))
+        if batch:
+            self.db.append_many(reports)
+            return
+        for report in reports:
+            self.db.append(*report)
+
+    def test_sqlite(self):
+        days = [ date(2022, 6, 26), date(2022, 6, 27) ]
+        self.ingest(days[0])
+        # All in one transaction
+        self.ingest(days[1], batch=True)
+        self.assertEqual(self.db.pending, [])
+
+        self.assertEqual(self.db.list_stations(),
+                         { "Outdoor": datetime(2022, 6, 27, 23, 59, 40) })
+        latest = self.db.latest("Outdoor")
+        self.assertEqual(latest["time"], datetime(2022, 6, 27, 23, 59, 40))
+        self.assertEqual(latest["temperature"], 52.7)
+
+        # A range across the day boundary is one query
+        start = datetime(2022, 6, 26, 22)
+        end = datetime(2022, 6, 27, 2)
+        times, columns = self.db.read_range("Outdoor", [ "temperature" ],
+                                            start, end)
+        csvtimes, csvcolumns = self.csv.read_range("Outdoor",
+                                                   [ "temperature" ],
+                                                   start, end)
+        np.testing.assert_array_equal(times, csvtimes)
+        np.testing.assert_array_equal(columns["temperature"],
+                                      csvcolumns["temperature"])
+
+        # and so is iterating over the days.
+        dbdays = list(self.db.iter_columns("Outdoor", [ "temperature" ],
+                                           start, end))
+        self.assertEqual([ d[0] for d in dbdays ], days)
+        self.assertEqual(sum(len(d[1]) for d in dbdays),
+                         self.db.conn.execute(
+                             "SELECT COUNT(*) FROM readings "
+                             "WHERE time >= ?",
+                             (storage.to_seconds(start),)).fetchone()[0])
+
+        # Resampling gives the same answers as from the CSV files
+        args = ("Outdoor", [ "temperature", "humidity" ],
+                datetime(2022, 6, 26, 9, 10), datetime(2022, 6, 27, 9, 10),
+                timedelta(minutes=30))
+        self.assertEqual(self.db.resample(*args), self.csv.resample(*args))
+
+        self.assertEqual(self.db.day_last_values("Outdoor", days),
+                         self.csv.day_last_values("Outdoor", days))
+
+        summaries = self.db.day_summaries("Outdoor", days)
+        csvsummaries = self.csv.day_summaries("Outdoor", days)
+        for day in days:
+            self.assertEqual(sorted(summaries[day]),
+                             sorted(csvsummaries[day]))
+            for f in summaries[day]:
+                np.testing.assert_allclose(summaries[day][f],
+                                           csvsummaries[day][f])
+
+        self.assertEqual(self.db.day_last_values("Outdoor",
+                                                 [ date(2022, 7, 1) ]),
+                         { date(2022, 7, 1): None })
+
+    def test_failed_flush(self):
+        # While the database is locked, reports wait,
+        self.db.conn.execute("PRAGMA busy_timeout = 0")
+        other = sqlite3.connect(self.db.dbfile)
+        other.execute("BEGIN EXCLUSIVE")
+        t = datetime(2022, 6, 26, 12)
+        self.db.append("Outdoor", { "time": t, "temperature": 80.5,
+                                    "bad field": 1 })
+        self.db.flush()
+        self.assertEqual(len(self.db.pending), 1)
+        other.rollback()
+        other.close()
+
+        # and get saved next time, without any field that can't be a column.
+        self.db.flush()
+        self.assertEqual(self.db.pending, [])
+        self.assertEqual(self.db.latest("Outdoor"),
+                         { "time": t, "temperature": 80.5 })
+
+    def test_iter_readings(self):
+        self.ingest(date(2022, 6, 26))
+        self.ingest(date(2022, 6, 27))
+
+        # What csv.DictReader gives, for a range across the day boundary
+        start = datetime(2022, 6, 26, 23, 30)
+        end = datetime(2022, 6, 27, 0, 30)
+        fields = [ "temperature", "rain_daily" ]
+        want = []
+        for day in (26, 27):
+            with open(os.path.join(DATADIR,
+                                   "Outdoor-2022-06-%d.csv" % day)) as fp:
+                for row in csv.DictReader(fp):
+                    t = datetime.strptime(row['time'], "%Y-%m-%d %H:%M:%S")
+                    if start <= t < end:
+                        want.append((t,) + tuple(float(row[f]) if row[f]
+                                                 else None for f in fields))
+        self.assertTrue(want)
+
+        for store in (self.csv, self.db):
+            self.assertEqual(list(store.iter_readings("Outdoor", fields,
+                                                      start, end)),
+                             want)
+
+        # and without a Storage, straight from the files
+        self.assertEqual(list(resample.iter_readings(DATADIR, "Outdoor",
+                                                     fields, start, end)),
+                         want)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+import timeindex
+import resample
+from timeparse import to_seconds
+
+from datetime import datetime
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class TimeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csvpath = os.path.join(self.tmpdir, "Outdoor-2022-06-26.csv")
+        with open("test/files/rawdata/Outdoor-2022-06-26.csv") as fp:
+            self.lines = fp.readlines()
+        timeindex._cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        timeindex._cache.clear()
+
+    def assertRangeMatches(self, start, end):
+        """A bounded read has every row the full read has between
+           start and the first row after end.
+        """
+        start = to_seconds(start)
+        end = to_seconds(end)
+        alltimes, allcols = resample.load_csv_columns(self.csvpath)
+        times, columns = resample.load_csv_columns(self.csvpath,
+                                                   start=start, end=end)
+        lo = np.searchsorted(alltimes, start)
+        hi = min(np.searchsorted(alltimes, end, side='right') + 1,
+                 len(alltimes))
+        self.assertLess(len(times), len(alltimes))
+        self.assertTrue(set(alltimes[lo:hi]) <= set(times))
+        i = np.searchsorted(times, alltimes[lo])
+        for f in allcols:
+            np.testing.assert_array_equal(columns[f][i:i + hi - lo],
+                                          allcols[f][lo:hi])
+
+    def test_index(self):
+        with open(self.csvpath, "w") as fp:
+            fp.writelines(self.lines[:1000])
+
+        # Reading uses an index, but doesn't save one
+        self.assertRangeMatches(datetime(2022, 6, 26, 2, 3, 10),
+                                datetime(2022, 6, 26, 3, 0))
+        self.assertFalse(os.path.exists(timeindex.index_path(self.csvpath)))
+
+        # The writer's update does
+        timeindex.update(self.csvpath)
+        with open(timeindex.index_path(self.csvpath)) as fp:
+            index = json.load(fp)
+        self.assertTrue(index["sorted"])
+        self.assertEqual(index["size"], os.path.getsize(self.csvpath))
+
+        # Each slot points at its first row
+        with open(self.csvpath, "rb") as fp:
+            for slot, offset in index["slots"]:
+                fp.seek(offset)
+                line = fp.readline().decode()
+                t = to_seconds(datetime.strptime(line.split(',')[0],
+                                                 "%Y-%m-%d %H:%M:%S"))
+                self.assertEqual(t // timeindex.SLOT_SECONDS
+                                 * timeindex.SLOT_SECONDS, slot)
+
+        # Appending extends the index rather than rebuilding it
+        with open(self.csvpath, "a") as fp:
+            fp.writelines(self.lines[1000:])
+        self.assertRangeMatches(datetime(2022, 6, 26, 9),
+                                datetime(2022, 6, 26, 10))
+        with open(timeindex.index_path(self.csvpath)) as fp:
+            self.assertEqual(json.load(fp)["size"], index["size"])
+        timeindex.update(self.csvpath)
+        with open(timeindex.index_path(self.csvpath)) as fp:
+            newindex = json.load(fp)
+        self.assertEqual(newindex["slots"][:len(index["slots"]) - 1],
+                         index["slots"][:-1])
+        self.assertEqual(newindex["size"], os.path.getsize(self.csvpath))
+
+        # A replaced file gets a new index
+        timeindex._cache.clear()
+        with open(self.csvpath, "w") as fp:
+            fp.writelines(self.lines[:1] + self.lines[2000:])
+        self.assertRangeMatches(datetime(2022, 6, 26, 20),
+                                datetime(2022, 6, 26, 20, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import sys
+sys.path.insert(0, 'server')
+
+from timeparse import parse_time, parse_date, parse_times_epoch, to_seconds
+
+from datetime import datetime, date
+
+import math
+
+
+class TimeParseTest(unittest.TestCase):
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("2022-06-26 09:20:35"),
+                         datetime(2022, 6, 26, 9, 20, 35))
+        self.assertEqual(parse_time("2022-06-26 09:20:35.25"),
+                         datetime(2022, 6, 26, 9, 20, 35, 250000))
+        self.assertEqual(parse_time("2022-06-26 09:20"),
+                         datetime(2022, 6, 26, 9, 20))
+        # Not the fixed layout, but strptime can still handle it
+        self.assertEqual(parse_time("2022-6-26 9:20:35"),
+                         datetime(2022, 6, 26, 9, 20, 35))
+        with self.assertRaises(ValueError):
+            parse_time("2022-06-26")
+        with self.assertRaises(ValueError):
+            parse_time("72.5")
+        for bad in ("2024- 1-05 09:20:35", "2024-01-05 +9:20:35",
+                    "2024-01-05 09:20:-5", "2024-01-05 09:20:35.-5"):
+            with self.assertRaises(ValueError):
+                parse_time(bad)
+
+        self.assertEqual(parse_date("2022-06-26"), date(2022, 6, 26))
+
+    def test_parse_times_epoch(self):
+        times = [ "2022-06-26 09:20:35",
+                  "2000-02-29 23:59:59.5",
+                  "",
+                  "not a time",
+                  "1969-12-31 23:00:00" ]
+        secs = parse_times_epoch(times)
+        self.assertEqual(secs[0],
+                         to_seconds(datetime(2022, 6, 26, 9, 20, 35)))
+        self.assertEqual(secs[1],
+                         to_seconds(datetime(2000, 2, 29, 23, 59, 59, 500000)))
+        self.assertTrue(math.isnan(secs[2]))
+        self.assertTrue(math.isnan(secs[3]))
+        self.assertEqual(secs[4], -3600)
+
+        self.assertEqual(len(parse_times_epoch([])), 0)
+
+        # Days that aren't in the month, and strings longer than
+        # the fixed layout, aren't rolled over or cut short.
+        secs = parse_times_epoch([ "2022-02-30 00:00:00",
+                                   "2100-02-29 00:00:00",
+                                   "2024-02-29 12:00:00",
+                                   "2022-06-26 09:20:35.123456+02:00",
+                                   "2022-06-26 24:00:00" ])
+        self.assertTrue(math.isnan(secs[0]))
+        self.assertTrue(math.isnan(secs[1]))
+        self.assertEqual(secs[2], to_seconds(datetime(2024, 2, 29, 12)))
+        self.assertTrue(math.isnan(secs[3]))
+        self.assertTrue(math.isnan(secs[4]))
+
+
+if __name__ == '__main__':
+    unittest.main()